@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""Time and memory-profile each isaslicer subcommand on synthetic studies
+of growing sizes.
+
+    bench_isaslicer.py [--samples 1000 10000 100000] [--assays 1]
+                       [--factors 2] [--characteristics 1] [--data-files 1]
+                       [--commands PATTERN ...] [--isaslicer-args ARGS]
+                       [--repeat 1] [--timeout 600] [--output RESULTS.json]
+                       [--baseline RESULTS.json] [--tolerance 0.25]
+
+For every size tier a study is generated with synthetic_isatab.py, and
+every local subcommand runs on it in a fresh interpreter. The wall clock
+time and the peak resident set size of each run are recorded, best of
+``--repeat`` runs; the peak RSS is that of the largest process of the run,
+worker processes included. ``--isaslicer-args`` are passed before the
+subcommand, to measure e.g. ``--jobs 0`` or ``--sqlite-db``. With
+``--baseline`` the results are compared to a former ``--output`` file and
+the script fails when a subcommand got slower or bigger than the tolerance
+allows.
+"""
+
+import argparse
+import collections
+import fnmatch
+import json
+import os
+import platform
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from bench_startup import ISASLICER, make_cases
+from synthetic_isatab import make_study
+
+QUERY = {
+    'measurement_type': 'metabolite profiling',
+    'technology_type': '',
+    'factor_selection': [
+        {'factor_name': 'Genotype', 'factor_value': 'mutant'}],
+    'characteristics_selection': [
+        {'characteristic_name': 'Organism part',
+         'characteristic_value': 'leaf'}],
+    'parameter_selection': [],
+}
+
+METRICS = ('wall_time', 'peak_rss_mb')
+
+
+def run_once(args, timeout):
+    """Run isaslicer with args, returning its wall time and peak RSS, or
+    None if it timed out"""
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, '-W', 'ignore', ISASLICER] + args,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    timer = threading.Timer(timeout, process.kill)
+    timer.start()
+    # wait4 rather than Popen.wait, for the resource usage of the process
+    _, status, rusage = os.wait4(process.pid, 0)
+    wall_time = time.perf_counter() - start
+    timed_out = timer.finished.is_set()
+    timer.cancel()
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if timed_out:
+        return None
+    if process.returncode != 0:
+        raise RuntimeError("isaslicer {} failed with exit code {}".format(
+            ' '.join(args), process.returncode))
+    return {'wall_time': round(wall_time, 3),
+            # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+            'peak_rss_mb': round(rusage.ru_maxrss / (
+                1 << 20 if sys.platform == 'darwin' else 1 << 10), 1)}
+
+
+def run_case(args, tmpdir, repeat, timeout):
+    best = None
+    for _ in range(repeat):
+        for collection in ('isagdc', 'zipgdc'):
+            shutil.rmtree(os.path.join(tmpdir, collection))
+            os.mkdir(os.path.join(tmpdir, collection))
+        result = run_once(args, timeout)
+        if result is None:
+            return {'timeout': timeout}
+        if best is None or result['wall_time'] < best['wall_time']:
+            best = result
+    return best
+
+
+def compare(result, before, tolerance):
+    """The metrics of result exceeding the baseline beyond the tolerance,
+    with the relative changes of all metrics"""
+    changes, regressions = [], []
+    if 'timeout' in result or 'timeout' in before:
+        if 'timeout' in result and 'timeout' not in before:
+            regressions.append('timeout')
+        return changes, regressions
+    for metric in METRICS:
+        change = result[metric] / before[metric] - 1
+        changes.append('{} {:+.0%}'.format(metric, change))
+        if change > tolerance:
+            regressions.append(metric)
+    return changes, regressions
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--samples', type=int, nargs='+',
+                        default=[1000, 10000, 100000],
+                        help="Number of samples of each size tier")
+    parser.add_argument('--assays', type=int, default=1)
+    parser.add_argument('--factors', type=int, default=2)
+    parser.add_argument('--characteristics', type=int, default=1)
+    parser.add_argument('--data-files', type=int, default=1,
+                        help="Number of data files per sample and assay")
+    parser.add_argument('--commands', nargs='+', metavar="PATTERN",
+                        default=['*'],
+                        help="Only run the subcommands matching these "
+                             "patterns, e.g. 'isa-tab-*'")
+    parser.add_argument('--isaslicer-args', default='',
+                        help="Global isaslicer options to run with")
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=600,
+                        help="Seconds after which a run is abandoned")
+    parser.add_argument('--output', help="Write the results to this file")
+    parser.add_argument('--baseline', type=argparse.FileType('r'),
+                        help="Results of a former run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="Accepted relative slowdown or growth over the "
+                             "baseline")
+    options = parser.parse_args(args)
+
+    baseline = json.load(options.baseline) if options.baseline else {}
+    isaslicer_args = shlex.split(options.isaslicer_args)
+    results = collections.OrderedDict([
+        ('environment', collections.OrderedDict([
+            ('python', platform.python_version()),
+            ('platform', platform.platform()),
+            ('cpu_count', os.cpu_count()),
+            ('isaslicer_args', isaslicer_args),
+        ])),
+        ('study', collections.OrderedDict([
+            ('assays', options.assays),
+            ('factors', options.factors),
+            ('characteristics', options.characteristics),
+            ('data_files', options.data_files),
+        ])),
+        ('tiers', collections.OrderedDict()),
+    ])
+    if baseline and (baseline['study'] != results['study'] or
+                     baseline['environment'] != results['environment']):
+        print('WARNING: the baseline was run on other studies or in another '
+              'environment')
+    baseline = baseline.get('tiers', {})
+    regressions = []
+    for n_samples in options.samples:
+        tier = str(n_samples)
+        tier_results = results['tiers'][tier] = collections.OrderedDict()
+        tmpdir = tempfile.mkdtemp()
+        try:
+            study = os.path.join(tmpdir, 'study')
+            os.mkdir(study)
+            make_study(study, n_samples, options.assays, options.factors,
+                       options.characteristics, options.data_files,
+                       touch_data_files=True)
+            cases = make_cases(tmpdir, study, 'Genotype', QUERY)
+            del cases['--help']
+            for name, case_args in cases.items():
+                if not any(fnmatch.fnmatch(name, pattern)
+                           for pattern in options.commands):
+                    continue
+                result = tier_results[name] = run_case(
+                    isaslicer_args + case_args, tmpdir, options.repeat,
+                    options.timeout)
+                if 'timeout' in result:
+                    line = '{:>8} {:<30} timed out after {:.0f} s'.format(
+                        tier, name, options.timeout)
+                else:
+                    line = '{:>8} {:<30} {:>8.3f} s {:>8.1f} MB'.format(
+                        tier, name, result['wall_time'],
+                        result['peak_rss_mb'])
+                if name in baseline.get(tier, {}):
+                    changes, case_regressions = compare(
+                        result, baseline[tier][name], options.tolerance)
+                    if changes:
+                        line += '  ' + ', '.join(changes)
+                    if case_regressions:
+                        regressions.append('{} on {} samples ({})'.format(
+                            name, tier, ', '.join(case_regressions)))
+                print(line)
+                sys.stdout.flush()
+        finally:
+            shutil.rmtree(tmpdir)
+    if options.output:
+        with open(options.output, 'w') as fp:
+            json.dump(results, fp, indent=4)
+    if regressions:
+        print('ERROR: regressions in {}'.format('; '.join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""Benchmark the columnar query engine of isaslicer against the former
+object graph implementation, on a synthetic ISA-Tab study.
+
+    bench_query_isatab.py [--samples 50000] [--skip-reference]
+"""
+
+import argparse
+import importlib.util
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from isatools import isatab
+from isatools.model import OntologyAnnotation
+from synthetic_isatab import make_study
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ISASLICER = os.path.join(HERE, os.pardir, 'tools', 'isatools', 'isaslicer.py')
+
+QUERY = {
+    'measurement_type': 'metabolite profiling',
+    'technology_type': '',
+    'factor_selection': [
+        {'factor_name': 'Genotype', 'factor_value': 'mutant'},
+        {'factor_name': 'Treatment', 'factor_value': 'drug'}],
+    'characteristics_selection': [
+        {'characteristic_name': 'Organism part', 'characteristic_value': 'leaf'}],
+    'parameter_selection': [],
+}
+
+
+def load_isaslicer():
+    spec = importlib.util.spec_from_file_location('isaslicer', ISASLICER)
+    isaslicer = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(isaslicer)
+    return isaslicer
+
+
+def reference_query(source_dir, query):
+    """The former object graph implementation of query_isatab"""
+    investigation = isatab.load(source_dir)
+    mt = query['measurement_type']
+    assay_samples = []
+    for study in investigation.studies:
+        for assay in study.assays:
+            if not mt or assay.measurement_type.term == mt:
+                assay_samples.extend(assay.samples)
+
+    def value_of(x):
+        return x.value.term if isinstance(x.value, OntologyAnnotation) \
+            else x.value
+
+    factor_selection = {
+        x['factor_name']: x['factor_value'] for x in query['factor_selection']}
+    fv_samples = set()
+    for f, v in factor_selection.items():
+        for sample in assay_samples:
+            if any(value_of(fv) == v for fv in sample.factor_values
+                   if fv.factor_name.name == f):
+                fv_samples.add(sample)
+    fv_samples = {
+        sample for sample in fv_samples if not any(
+            value_of(fv) != factor_selection[fv.factor_name.name]
+            for fv in sample.factor_values
+            if fv.factor_name.name in factor_selection)}
+
+    characteristics = [
+        (x['characteristic_name'], x['characteristic_value'])
+        for x in query['characteristics_selection']]
+    c, v = characteristics[0]
+    cv_samples = set()
+    for sample in fv_samples:
+        materials = [sample] + list(sample.derives_from)
+        if any(value_of(x) == v for m in materials
+               for x in m.characteristics if x.category.term == c):
+            cv_samples.add(sample)
+    return sorted(sample.name for sample in cv_samples)
+
+
+def columnar_query(isaslicer, source_dir, query):
+    options = argparse.Namespace(
+        source_dir=source_dir,
+        galaxy_parameters_file=io.StringIO(json.dumps({'query': query})),
+        output=io.StringIO())
+    stdout, sys.stdout = sys.stdout, io.StringIO()
+    try:
+        isaslicer.query_isatab(options)
+    finally:
+        sys.stdout = stdout
+    results = json.loads(options.output.getvalue())['results']
+    return sorted(result['sample_name'] for result in results)
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--samples', type=int, default=50000)
+    parser.add_argument('--skip-reference', action='store_true',
+                        help="Do not run the object graph implementation")
+    options = parser.parse_args(args)
+
+    isaslicer = load_isaslicer()
+    isaslicer.logger = isaslicer.logging.getLogger()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        make_study(tmpdir, options.samples)
+        samples, columnar_time = timed(
+            columnar_query, isaslicer, tmpdir, QUERY)
+        print('columnar: {} samples selected in {:.3f} s'.format(
+            len(samples), columnar_time))
+        if not options.skip_reference:
+            expected, reference_time = timed(reference_query, tmpdir, QUERY)
+            print('object graph: {} samples selected in {:.3f} s'.format(
+                len(expected), reference_time))
+            if samples != expected:
+                print('ERROR: the two implementations disagree')
+                return 1
+            print('speedup: {:.1f}x'.format(reference_time / columnar_time))
+    finally:
+        shutil.rmtree(tmpdir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""Measure the start-up cost of each isaslicer subcommand run locally.
+
+    bench_startup.py [--repeat 3] [--output RESULTS.json]
+                     [--baseline RESULTS.json] [--tolerance 0.25]
+
+Every subcommand runs in a fresh interpreter under ``-X importtime`` on the
+MTBLS1 test study. The wall clock time and the time spent importing modules
+are recorded, best of ``--repeat`` runs. With ``--baseline`` the results are
+compared to a former ``--output`` file and the script fails when a
+subcommand got slower than the tolerance allows. The mtbls-* subcommands
+need network access to MetaboLights and are not measured.
+"""
+
+import argparse
+import collections
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ISASLICER = os.path.join(HERE, os.pardir, 'tools', 'isatools', 'isaslicer.py')
+STUDY = os.path.join(HERE, os.pardir, 'tests', 'res', 'MTBLS1-isatab')
+
+QUERY = {
+    'measurement_type': '',
+    'technology_type': '',
+    'factor_selection': [
+        {'factor_name': 'Gender', 'factor_value': 'Female'}],
+    'characteristics_selection': [],
+    'parameter_selection': [],
+}
+
+
+def make_study(tmpdir):
+    """Copy the test study along with empty stand-ins of its data files."""
+    study = os.path.join(tmpdir, 'study')
+    shutil.copytree(STUDY, study)
+    data_files = subprocess.check_output(
+        [sys.executable, '-W', 'ignore', ISASLICER, 'isagdl', study],
+        stderr=subprocess.DEVNULL)
+    for result in json.loads(data_files.decode('utf-8')):
+        for data_file in result['data_files']:
+            open(os.path.join(study, data_file), 'a').close()
+    return study
+
+
+def make_inputs(tmpdir, study, query=QUERY):
+    study_zip = shutil.make_archive(
+        os.path.join(tmpdir, 'study'), 'zip', study)
+    query_file = os.path.join(tmpdir, 'query.json')
+    with open(query_file, 'w') as fp:
+        json.dump({'query': query}, fp)
+    queries = os.path.join(tmpdir, 'queries.jsonl')
+    with open(queries, 'w') as fp:
+        fp.write(json.dumps(query) + '\n')
+    return study_zip, query_file, queries
+
+
+def make_cases(tmpdir, study, factor='Gender', query=QUERY):
+    """The arguments of each local subcommand run on study, its outputs
+    being written to tmpdir"""
+    study_zip, query, queries = make_inputs(tmpdir, study, query)
+    out = os.path.join(tmpdir, 'out')
+    for collection in ('isagdc', 'zipgdc'):
+        os.mkdir(os.path.join(tmpdir, collection))
+    return collections.OrderedDict([
+        ('--help', ['--help']),
+        ('isa-tab-get-factors', ['isagf', study, out]),
+        ('zip-get-factors', ['zipgf', study_zip, out]),
+        ('isa-tab-get-factor-values', ['isagfv', study, factor, out]),
+        ('zip-get-factor-values', ['zipgfv', study_zip, factor, out]),
+        ('isa-tab-get-data-list', ['isagdl', study, out]),
+        ('zip-get-data-list', ['zipgdl', study_zip, out]),
+        ('isa-tab-get-data-collection',
+         ['isagdc', study, os.path.join(tmpdir, 'isagdc')]),
+        ('zip-get-data-collection',
+         ['zipgdc', study_zip, os.path.join(tmpdir, 'zipgdc')]),
+        ('isa-tab-get-factors-summary', ['isasum', study, out]),
+        ('zip-get-factors-summary', ['zipsum', study_zip, out, out]),
+        ('isaslicer2-slice', [
+            'slice2', '--source_dir', study,
+            '--galaxy_parameters_file', query, '--output', out]),
+        ('isaslicer2-batch', ['batch2', study, queries, out]),
+    ])
+
+
+def parse_importtime(stderr):
+    """Sum the cumulative import times of the top-level imports, in
+    seconds, and return it with the heaviest top-level packages."""
+    top_level = collections.Counter()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if name.startswith('  ') or not cumulative.strip().isdigit():
+            continue  # nested import, or the header line
+        top_level[name.strip().split('.')[0]] += int(cumulative) / 1e6
+    return sum(top_level.values()), top_level.most_common(3)
+
+
+def run_case(args, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        process = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-W', 'ignore', ISASLICER] +
+            args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            universal_newlines=True)
+        wall_time = time.perf_counter() - start
+        if process.returncode != 0:
+            raise RuntimeError("isaslicer {} failed:\n{}".format(
+                ' '.join(args), process.stderr[-2000:]))
+        import_time, heaviest = parse_importtime(process.stderr)
+        if best is None or wall_time < best['wall_time']:
+            best = {'wall_time': round(wall_time, 3),
+                    'import_time': round(import_time, 3),
+                    'heaviest_imports': [
+                        [name, round(seconds, 3)]
+                        for name, seconds in heaviest]}
+    return best
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help="Write the results to this file")
+    parser.add_argument('--baseline', type=argparse.FileType('r'),
+                        help="Results of a former run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="Accepted relative slowdown over the baseline")
+    options = parser.parse_args(args)
+
+    baseline = json.load(options.baseline) if options.baseline else {}
+    results = collections.OrderedDict()
+    regressions = []
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cases = make_cases(tmpdir, make_study(tmpdir))
+        for name, case_args in cases.items():
+            result = results[name] = run_case(case_args, options.repeat)
+            line = '{:<30} {:>7.3f} s wall {:>7.3f} s imports  ({})'.format(
+                name, result['wall_time'], result['import_time'],
+                ', '.join('{} {:.3f}'.format(*x)
+                          for x in result['heaviest_imports']))
+            if name in baseline:
+                before = baseline[name]['wall_time']
+                line += '  {:+.0%}'.format(result['wall_time'] / before - 1)
+                if result['wall_time'] > before * (1 + options.tolerance):
+                    regressions.append(name)
+            print(line)
+    finally:
+        shutil.rmtree(tmpdir)
+    if options.output:
+        with open(options.output, 'w') as fp:
+            json.dump(results, fp, indent=4)
+    if regressions:
+        print('ERROR: start-up regressions in {}'.format(
+            ', '.join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""Generate a synthetic ISA-Tab study of a chosen size.
+
+    synthetic_isatab.py OUTPUT_DIR [--samples 10000] [--assays 1]
+                        [--factors 2] [--characteristics 1]
+                        [--data-files 1] [--levels 2] [--touch-data-files]
+
+The study has one study table and ``--assays`` assay tables covering all
+samples. Its first factors are Genotype (wild type, mutant) and Treatment
+(drug, placebo), and its first source characteristic is Organism part
+(leaf, root); further ones have ``--levels`` values each. Every sample has
+``--data-files`` raw data files, one per assay table row.
+"""
+
+import argparse
+import os
+import sys
+
+INVESTIGATION_SECTIONS = [
+    ('ONTOLOGY SOURCE REFERENCE', [
+        'Term Source Name', 'Term Source File', 'Term Source Version',
+        'Term Source Description']),
+    ('INVESTIGATION', [
+        'Investigation Identifier', 'Investigation Title',
+        'Investigation Description', 'Investigation Submission Date',
+        'Investigation Public Release Date']),
+    ('INVESTIGATION PUBLICATIONS', [
+        'Investigation PubMed ID', 'Investigation Publication DOI',
+        'Investigation Publication Author List',
+        'Investigation Publication Title', 'Investigation Publication Status',
+        'Investigation Publication Status Term Accession Number',
+        'Investigation Publication Status Term Source REF']),
+    ('INVESTIGATION CONTACTS', [
+        'Investigation Person Last Name', 'Investigation Person First Name',
+        'Investigation Person Mid Initials', 'Investigation Person Email',
+        'Investigation Person Phone', 'Investigation Person Fax',
+        'Investigation Person Address', 'Investigation Person Affiliation',
+        'Investigation Person Roles',
+        'Investigation Person Roles Term Accession Number',
+        'Investigation Person Roles Term Source REF']),
+    ('STUDY', [
+        'Study Identifier', 'Study Title', 'Study Description',
+        'Study Submission Date', 'Study Public Release Date',
+        'Study File Name']),
+    ('STUDY DESIGN DESCRIPTORS', [
+        'Study Design Type', 'Study Design Type Term Accession Number',
+        'Study Design Type Term Source REF']),
+    ('STUDY PUBLICATIONS', [
+        'Study PubMed ID', 'Study Publication DOI',
+        'Study Publication Author List', 'Study Publication Title',
+        'Study Publication Status',
+        'Study Publication Status Term Accession Number',
+        'Study Publication Status Term Source REF']),
+    ('STUDY FACTORS', [
+        'Study Factor Name', 'Study Factor Type',
+        'Study Factor Type Term Accession Number',
+        'Study Factor Type Term Source REF']),
+    ('STUDY ASSAYS', [
+        'Study Assay File Name', 'Study Assay Measurement Type',
+        'Study Assay Measurement Type Term Accession Number',
+        'Study Assay Measurement Type Term Source REF',
+        'Study Assay Technology Type',
+        'Study Assay Technology Type Term Accession Number',
+        'Study Assay Technology Type Term Source REF',
+        'Study Assay Technology Platform']),
+    ('STUDY PROTOCOLS', [
+        'Study Protocol Name', 'Study Protocol Type',
+        'Study Protocol Type Term Accession Number',
+        'Study Protocol Type Term Source REF', 'Study Protocol Description',
+        'Study Protocol URI', 'Study Protocol Version',
+        'Study Protocol Parameters Name',
+        'Study Protocol Parameters Name Term Accession Number',
+        'Study Protocol Parameters Name Term Source REF',
+        'Study Protocol Components Name', 'Study Protocol Components Type',
+        'Study Protocol Components Type Term Accession Number',
+        'Study Protocol Components Type Term Source REF']),
+    ('STUDY CONTACTS', [
+        'Study Person Last Name', 'Study Person First Name',
+        'Study Person Mid Initials', 'Study Person Email',
+        'Study Person Phone', 'Study Person Fax', 'Study Person Address',
+        'Study Person Affiliation', 'Study Person Roles',
+        'Study Person Roles Term Accession Number',
+        'Study Person Roles Term Source REF']),
+]
+
+FACTORS = [('Genotype', ['wild type', 'mutant']),
+           ('Treatment', ['drug', 'placebo'])]
+CHARACTERISTICS = [('Organism part', ['leaf', 'root'])]
+MEASUREMENTS = [('metabolite profiling', 'mass spectrometry', 'mzML'),
+                ('metabolite profiling', 'NMR spectroscopy', 'nmrML')]
+
+
+def write_investigation(path, values):
+    with open(os.path.join(path, 'i_Investigation.txt'), 'w') as fp:
+        for section, labels in INVESTIGATION_SECTIONS:
+            fp.write(section + '\n')
+            for label in labels:
+                fp.write('\t'.join(
+                    [label] + ['"{}"'.format(value)
+                               for value in values.get(label, [])]) + '\n')
+
+
+def _variables(known, name, count, levels):
+    """The first count variables: the known ones, then generic ones"""
+    return (known + [
+        ('{} {}'.format(name, i), ['level {}'.format(j)
+                                   for j in range(levels)])
+        for i in range(len(known) + 1, count + 1)])[:count]
+
+
+def _value(values, sample, rank):
+    # the variables vary at different rates, so that they cross
+    return values[sample // len(values) ** rank % len(values)]
+
+
+def assay_file_names(n_assays):
+    if n_assays == 1:
+        return ['a_assay.txt']
+    return ['a_assay_{}.txt'.format(i) for i in range(1, n_assays + 1)]
+
+
+def data_file_names(sample, n_data_files, assay=0, n_assays=1):
+    """The data files of a sample in an assay table"""
+    extension = MEASUREMENTS[assay % len(MEASUREMENTS)][2]
+    prefix = 'sample{}'.format(sample)
+    if n_assays > 1:
+        prefix += '_a{}'.format(assay + 1)
+    if n_data_files == 1:
+        return ['{}.{}'.format(prefix, extension)]
+    return ['{}_{}.{}'.format(prefix, i, extension)
+            for i in range(1, n_data_files + 1)]
+
+
+def make_study(path, n_samples, n_assays=1, n_factors=2,
+               n_characteristics=1, n_data_files=1, levels=2,
+               touch_data_files=False):
+    """Write a synthetic ISA-Tab study to the existing directory path.
+
+    :return: The names of the data files of the study
+    """
+    factors = _variables(FACTORS, 'Factor', n_factors, levels)
+    characteristics = _variables(
+        CHARACTERISTICS, 'Characteristic', n_characteristics, levels)
+    assay_files = assay_file_names(n_assays)
+    measurements = [MEASUREMENTS[i % len(MEASUREMENTS)]
+                    for i in range(n_assays)]
+    write_investigation(path, {
+        'Investigation Identifier': ['SYNTH'],
+        'Study Identifier': ['SYNTH'],
+        'Study File Name': ['s_study.txt'],
+        'Study Factor Name': [name for name, _ in factors],
+        'Study Assay File Name': assay_files,
+        'Study Assay Measurement Type': [mt for mt, _, _ in measurements],
+        'Study Assay Technology Type': [tt for _, tt, _ in measurements],
+        'Study Protocol Name': ['sample collection', 'extraction'],
+    })
+    with open(os.path.join(path, 's_study.txt'), 'w') as fp:
+        fp.write('\t'.join(
+            ['Source Name'] +
+            ['Characteristics[{}]'.format(name)
+             for name, _ in characteristics] +
+            ['Protocol REF', 'Sample Name'] +
+            ['Factor Value[{}]'.format(name) for name, _ in factors]) + '\n')
+        for i in range(n_samples):
+            fp.write('\t'.join(
+                ['source{}'.format(i)] +
+                [_value(values, i, rank)
+                 for rank, (_, values) in enumerate(characteristics)] +
+                ['sample collection', 'sample{}'.format(i)] +
+                [_value(values, i, rank + 1)
+                 for rank, (_, values) in enumerate(factors)]) + '\n')
+    data_files = []
+    for assay, assay_file in enumerate(assay_files):
+        with open(os.path.join(path, assay_file), 'w') as fp:
+            fp.write('Sample Name\tProtocol REF\tExtract Name\t'
+                     'Raw Spectral Data File\n')
+            for i in range(n_samples):
+                for data_file in data_file_names(
+                        i, n_data_files, assay, n_assays):
+                    fp.write('sample{0}\textraction\textract{0}\t{1}\n'.format(
+                        i, data_file))
+                    data_files.append(data_file)
+    if touch_data_files:
+        for data_file in data_files:
+            open(os.path.join(path, data_file), 'a').close()
+    return data_files
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('output', help="Directory to write the study to")
+    parser.add_argument('--samples', type=int, default=10000)
+    parser.add_argument('--assays', type=int, default=1)
+    parser.add_argument('--factors', type=int, default=2)
+    parser.add_argument('--characteristics', type=int, default=1)
+    parser.add_argument('--data-files', type=int, default=1,
+                        help="Number of data files per sample and assay")
+    parser.add_argument('--levels', type=int, default=2,
+                        help="Number of values of the generic factors and "
+                             "characteristics")
+    parser.add_argument('--touch-data-files', action='store_true',
+                        help="Also create the data files, empty")
+    options = parser.parse_args(args)
+
+    os.makedirs(options.output, exist_ok=True)
+    data_files = make_study(
+        options.output, options.samples, options.assays, options.factors,
+        options.characteristics, options.data_files, options.levels,
+        options.touch_data_files)
+    print('Wrote {} samples and {} data files to {}'.format(
+        options.samples, len(data_files), options.output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
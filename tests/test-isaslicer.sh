@@ -5,7 +5,7 @@
 ################################################################
 
 SCRIPT_PATH=$(dirname $BASH_SOURCE)
-ISASLICER=$SCRIPT_PATH/../tools/isaslicer/isaslicer.py
+ISASLICER=$SCRIPT_PATH/../tools/isatools/isaslicer.py
 RESDIR=$SCRIPT_PATH/res
 
 # Check data list {{{1
@@ -30,6 +30,30 @@ with open('$file') as f:
 EOF
 }
 
+# Write queries {{{1
+################################################################
+
+write_queries() {
+
+	local query_file="$1"
+	local queries_file="$2"
+
+	python3 <<EOF
+# @@@BEGIN_PYTHON@@@
+import json
+def query(gender):
+    return {'measurement_type': '', 'technology_type': '',
+            'factor_selection': [{'factor_name': 'Gender', 'factor_value': gender}],
+            'characteristics_selection': [], 'parameter_selection': []}
+with open('$query_file', 'w') as f:
+    json.dump({'query': query('Female')}, f)
+with open('$queries_file', 'w') as f:
+    for gender in ('Female', 'Male'):
+        f.write(json.dumps(query(gender)) + '\n')
+# @@@END_PYTHON@@@
+EOF
+}
+
 # Test isaslicer all data files {{{1
 ################################################################
 
@@ -50,8 +74,463 @@ test_isaslicer_all_data_files() {
 	expect_success check_data_list "$output_file" 4
 }
 
+# Test isaslicer empty data file cells {{{1
+################################################################
+
+set_assay_cell() {
+
+	local assay_file="$1"
+	local column="$2"
+	local value="$3"
+
+	python3 <<EOF
+# @@@BEGIN_PYTHON@@@
+with open('$assay_file') as f:
+    lines = f.readlines()
+cells = lines[1].rstrip('\n').split('\t')
+cells[$column] = '"$value"'
+lines[1] = '\t'.join(cells) + '\n'
+with open('$assay_file', 'w') as f:
+    f.writelines(lines)
+# @@@END_PYTHON@@@
+EOF
+}
+
+check_sample_data_files() {
+
+	local file="$1"
+	local sample="$2"
+	local nb_data_files_expected=$3
+
+	python3 <<EOF
+# @@@BEGIN_PYTHON@@@
+import json
+import sys
+with open('$file') as f:
+    data_files = {elem['sample']: elem['data_files'] for elem in json.load(f)}
+if len(data_files['$sample']) != $nb_data_files_expected or '' in data_files['$sample']:
+    print('Found data files %s for sample $sample.' % data_files['$sample'], file = sys.stderr)
+    sys.exit(1)
+# @@@END_PYTHON@@@
+EOF
+}
+
+test_isaslicer_empty_data_file_cells() {
+
+	# Blank the Free Induction Decay Data File of the first assay row
+	local study=MTBLS1-isatab
+	local tmp_dir=$(mktemp -d)
+	cp -r "$RESDIR/$study" "$tmp_dir/study"
+	set_assay_cell "$tmp_dir/study/a_mtbls1_metabolite_profiling_NMR_spectroscopy.txt" 36 ''
+
+	# Empty cells are not listed as data files
+	$ISASLICER 'isa-tab-get-data-list' "$tmp_dir/study" "$tmp_dir/data-files.json"
+	expect_success check_sample_data_files "$tmp_dir/data-files.json" ADG10003u_007 3
+
+	rm -r "$tmp_dir"
+}
+
+# Test isaslicer table cache {{{1
+################################################################
+
+poison_cache_entries() {
+
+	local cache_dir="$1"
+
+	python3 <<EOF
+# @@@BEGIN_PYTHON@@@
+import glob
+# A pickle of a class pandas no longer has
+for entry in glob.glob('$cache_dir/*.pkl'):
+    with open(entry, 'wb') as f:
+        f.write(b'cpandas.core.indexes.numeric\nInt64Index\n.')
+# @@@END_PYTHON@@@
+EOF
+}
+
+test_isaslicer_table_cache() {
+
+	local study_path="$RESDIR/MTBLS1-isatab"
+	local tmp_dir=$(mktemp -d)
+	$ISASLICER 'isa-tab-get-data-list' "$study_path" "$tmp_dir/uncached.json"
+
+	# Fill the cache, then read from it
+	$ISASLICER --table-cache-dir "$tmp_dir/cache" 'isa-tab-get-data-list' "$study_path" "$tmp_dir/filled.json"
+	$ISASLICER --table-cache-dir "$tmp_dir/cache" 'isa-tab-get-data-list' "$study_path" "$tmp_dir/cached.json"
+	expect_same_files "$tmp_dir/uncached.json" "$tmp_dir/filled.json"
+	expect_same_files "$tmp_dir/uncached.json" "$tmp_dir/cached.json"
+
+	# Unreadable entries are parsed again
+	poison_cache_entries "$tmp_dir/cache"
+	$ISASLICER --table-cache-dir "$tmp_dir/cache" 'isa-tab-get-data-list' "$study_path" "$tmp_dir/poisoned.json"
+	expect_same_files "$tmp_dir/uncached.json" "$tmp_dir/poisoned.json"
+
+	# A cache directory others can write to is refused
+	chmod g+w "$tmp_dir/cache"
+	expect_failure $ISASLICER --table-cache-dir "$tmp_dir/cache" 'isa-tab-get-data-list' "$study_path" "$tmp_dir/shared.json"
+
+	rm -r "$tmp_dir"
+}
+
+# Test isaslicer data files in subdirectories {{{1
+################################################################
+
+make_nested_study() {
+
+	local study_dir="$1"
+	local output_zip="$2"
+
+	python3 <<EOF
+# @@@BEGIN_PYTHON@@@
+import glob
+import os
+import shutil
+# Move every data file of the assay tables under FILES/
+os.mkdir(os.path.join('$study_dir', 'FILES'))
+for assay_file in glob.glob(os.path.join('$study_dir', 'a_*.txt')):
+    with open(assay_file) as f:
+        rows = [line.rstrip('\n').split('\t') for line in f]
+    columns = [i for i, label in enumerate(rows[0]) if label.strip('"').endswith(' File')]
+    for row in rows[1:]:
+        for i in columns:
+            data_file = row[i].strip('"')
+            if data_file:
+                row[i] = '"FILES/{}"'.format(data_file)
+                with open(os.path.join('$study_dir', 'FILES', data_file), 'w') as f:
+                    f.write(data_file)
+    with open(assay_file, 'w') as f:
+        f.writelines('\t'.join(row) + '\n' for row in rows)
+shutil.make_archive('$output_zip'[:-4], 'zip', '$study_dir')
+# @@@END_PYTHON@@@
+EOF
+}
+
+test_isaslicer_nested_data_files() {
+
+	local tmp_dir=$(mktemp -d)
+	cp -r "$RESDIR/MTBLS1-isatab" "$tmp_dir/study"
+	make_nested_study "$tmp_dir/study" "$tmp_dir/study.zip"
+
+	# Data files are collected flat into the output directory
+	mkdir "$tmp_dir/isagdc" "$tmp_dir/zipgdc"
+	expect_success $ISASLICER 'isa-tab-get-data-collection' "$tmp_dir/study" "$tmp_dir/isagdc"
+	expect_success $ISASLICER 'zip-get-data-collection' "$tmp_dir/study.zip" "$tmp_dir/zipgdc"
+	expect_non_empty_file "$tmp_dir/zipgdc/ADG10003u_007.nmrML"
+	expect_success diff -r "$tmp_dir/isagdc" "$tmp_dir/zipgdc"
+
+	rm -r "$tmp_dir"
+}
+
+# Test isaslicer server {{{1
+################################################################
+
+test_isaslicer_server() {
+
+	local study_path="$RESDIR/MTBLS1-isatab"
+	local tmp_dir=$(mktemp -d)
+	local socket="$tmp_dir/isaslicer.sock"
+	write_queries "$tmp_dir/query.json" "$tmp_dir/queries.jsonl"
+	$ISASLICER 'isa-tab-get-factors' "$study_path" "$tmp_dir/factors.json"
+	$ISASLICER 'isa-tab-get-data-list' "$study_path" "$tmp_dir/data-files.json"
+	$ISASLICER 'isaslicer2-batch' "$study_path" "$tmp_dir/queries.jsonl" "$tmp_dir/batch.jsonl"
+
+	# Answers of the server
+	$ISASLICER 'serve' "$socket" >/dev/null 2>&1 &
+	local server_pid=$!
+	for i in $(seq 50) ; do [ -S "$socket" ] && break ; sleep 0.2 ; done
+	$ISASLICER --server "$socket" 'isa-tab-get-factors' "$study_path" "$tmp_dir/served-factors.json"
+	$ISASLICER --server "$socket" 'isa-tab-get-data-list' "$study_path" "$tmp_dir/served-data-files.json"
+	kill $server_pid
+	expect_same_files "$tmp_dir/factors.json" "$tmp_dir/served-factors.json"
+	expect_same_files "$tmp_dir/data-files.json" "$tmp_dir/served-data-files.json"
+
+	# Without server, the study is loaded locally once for all queries
+	$ISASLICER --server "$tmp_dir/none.sock" 'isaslicer2-batch' "$study_path" "$tmp_dir/queries.jsonl" "$tmp_dir/local-batch.jsonl" 2>"$tmp_dir/stderr.txt"
+	expect_same_files "$tmp_dir/batch.jsonl" "$tmp_dir/local-batch.jsonl"
+	expect_success test $(grep -c 'Could not reach isaslicer server' "$tmp_dir/stderr.txt") -eq 1
+
+	rm -r "$tmp_dir"
+}
+
+# Test isaslicer study index {{{1
+################################################################
+
+test_isaslicer_study_index() {
+
+	local study_path="$RESDIR/MTBLS1-isatab"
+	local tmp_dir=$(mktemp -d)
+	write_queries "$tmp_dir/query.json" "$tmp_dir/queries.jsonl"
+	$ISASLICER 'isa-tab-build-index' "$study_path" "$tmp_dir/index.zip"
+
+	# Slices and lists through the index are those of the study
+	$ISASLICER 'isaslicer2-slice' --source_dir "$study_path" --galaxy_parameters_file "$tmp_dir/query.json" --output "$tmp_dir/slice.json" >/dev/null
+	$ISASLICER 'isaslicer2-slice' --source_dir "$tmp_dir/index.zip" --galaxy_parameters_file "$tmp_dir/query.json" --output "$tmp_dir/indexed-slice.json" >/dev/null
+	expect_same_files "$tmp_dir/slice.json" "$tmp_dir/indexed-slice.json"
+	$ISASLICER 'isa-tab-get-data-list' "$study_path" "$tmp_dir/data-files.json"
+	$ISASLICER 'isa-tab-get-data-list' "$tmp_dir/index.zip" "$tmp_dir/indexed-data-files.json"
+	expect_same_files "$tmp_dir/data-files.json" "$tmp_dir/indexed-data-files.json"
+
+	# Data files cannot be collected from an index
+	mkdir "$tmp_dir/isagdc"
+	expect_failure $ISASLICER 'isa-tab-get-data-collection' "$tmp_dir/index.zip" "$tmp_dir/isagdc"
+
+	rm -r "$tmp_dir"
+}
+
+# Test isaslicer output formats {{{1
+################################################################
+
+check_output_formats() {
+
+	local json_file="$1"
+	local ndjson_file="$2"
+	local tsv_file="$3"
+
+	python3 <<EOF
+# @@@BEGIN_PYTHON@@@
+import csv
+import json
+import sys
+with open('$json_file') as f:
+    expected = json.load(f)
+with open('$ndjson_file') as f:
+    if [json.loads(line) for line in f] != expected:
+        print('The NDJSON results differ from the JSON ones.', file = sys.stderr)
+        sys.exit(1)
+# The TSV has a row per data file of each sample
+results = {}
+with open('$tsv_file') as f:
+    for row in csv.DictReader(f, delimiter = '\t'):
+        data_files = results.setdefault(row['sample'], [])
+        if row['data_files']:
+            data_files.append(row['data_files'])
+if results != {elem['sample']: elem['data_files'] for elem in expected}:
+    print('The TSV results differ from the JSON ones.', file = sys.stderr)
+    sys.exit(1)
+# @@@END_PYTHON@@@
+EOF
+}
+
+test_isaslicer_output_formats() {
+
+	# Name a data file with a comma
+	local tmp_dir=$(mktemp -d)
+	cp -r "$RESDIR/MTBLS1-isatab" "$tmp_dir/study"
+	set_assay_cell "$tmp_dir/study/a_mtbls1_metabolite_profiling_NMR_spectroscopy.txt" 36 'ADG10003u_007,fid'
+
+	$ISASLICER 'isa-tab-get-data-list' "$tmp_dir/study" "$tmp_dir/data-files.json"
+	$ISASLICER --output-format ndjson 'isa-tab-get-data-list' "$tmp_dir/study" "$tmp_dir/data-files.ndjson"
+	$ISASLICER --output-format tsv 'isa-tab-get-data-list' "$tmp_dir/study" "$tmp_dir/data-files.tsv"
+	expect_success check_output_formats "$tmp_dir/data-files.json" "$tmp_dir/data-files.ndjson" "$tmp_dir/data-files.tsv"
+	expect_success grep -q 'ADG10003u_007,fid' "$tmp_dir/data-files.json"
+
+	rm -r "$tmp_dir"
+}
+
+# Test isaslicer factor queries {{{1
+################################################################
+
+make_study_with_data_files() {
+
+	local study_dir="$1"
+	local output_zip="$2"
+
+	cp -r "$RESDIR/MTBLS1-isatab" "$study_dir"
+	$ISASLICER 'isa-tab-get-data-list' "$study_dir" "$study_dir.data-files.json"
+	python3 <<EOF
+# @@@BEGIN_PYTHON@@@
+import json
+import os
+import shutil
+# Empty stand-ins of the data files
+with open('$study_dir.data-files.json') as f:
+    for elem in json.load(f):
+        for data_file in elem['data_files']:
+            open(os.path.join('$study_dir', data_file), 'a').close()
+shutil.make_archive('$output_zip'[:-4], 'zip', '$study_dir')
+# @@@END_PYTHON@@@
+EOF
+}
+
+test_isaslicer_factor_queries() {
+
+	local tmp_dir=$(mktemp -d)
+	local study_path="$tmp_dir/study"
+	make_study_with_data_files "$study_path" "$tmp_dir/study.zip"
+	echo '{"factor_value_series": [{"factor_name": "Gender", "factor_value": "Female"}]}' >"$tmp_dir/galaxy.json"
+
+	# The JSON query and the Galaxy parameters select the same samples
+	$ISASLICER 'isa-tab-get-data-list' "$study_path" "$tmp_dir/json-query.json" --json-query '{"Gender": "Female"}'
+	$ISASLICER 'isa-tab-get-data-list' "$study_path" "$tmp_dir/galaxy-query.json" --galaxy_parameters_file "$tmp_dir/galaxy.json"
+	$ISASLICER 'zip-get-data-list' "$tmp_dir/study.zip" "$tmp_dir/zip-galaxy-query.json" --galaxy_parameters_file "$tmp_dir/galaxy.json"
+	expect_same_files "$tmp_dir/json-query.json" "$tmp_dir/galaxy-query.json"
+	expect_same_files "$tmp_dir/json-query.json" "$tmp_dir/zip-galaxy-query.json"
+	mkdir "$tmp_dir/isagdc" "$tmp_dir/zipgdc"
+	expect_success $ISASLICER 'isa-tab-get-data-collection' "$study_path" "$tmp_dir/isagdc" --json-query '{"Gender": "Female"}'
+	expect_success $ISASLICER 'zip-get-data-collection' "$tmp_dir/study.zip" "$tmp_dir/zipgdc" --galaxy_parameters_file "$tmp_dir/galaxy.json"
+	expect_file_exists "$tmp_dir/zipgdc/ADG10003u_015.nmrML"
+	expect_success diff -r "$tmp_dir/isagdc" "$tmp_dir/zipgdc"
+
+	rm -r "$tmp_dir"
+}
+
+# Test isaslicer zip archives {{{1
+################################################################
+
+test_isaslicer_zip_archives() {
+
+	local tmp_dir=$(mktemp -d)
+	local study_path="$tmp_dir/study"
+	make_study_with_data_files "$study_path" "$tmp_dir/study.zip"
+
+	# Tables read straight from the archive give the same outputs
+	$ISASLICER 'isa-tab-get-data-list' "$study_path" "$tmp_dir/isagdl.json"
+	$ISASLICER 'zip-get-data-list' "$tmp_dir/study.zip" "$tmp_dir/zipgdl.json"
+	expect_same_files "$tmp_dir/isagdl.json" "$tmp_dir/zipgdl.json"
+	$ISASLICER 'isa-tab-get-factors' "$study_path" "$tmp_dir/isagf.json"
+	$ISASLICER 'zip-get-factors' "$tmp_dir/study.zip" "$tmp_dir/zipgf.json"
+	expect_same_files "$tmp_dir/isagf.json" "$tmp_dir/zipgf.json"
+	$ISASLICER 'isa-tab-get-factor-values' "$study_path" Gender "$tmp_dir/isagfv.json"
+	$ISASLICER 'zip-get-factor-values' "$tmp_dir/study.zip" Gender "$tmp_dir/zipgfv.json"
+	expect_same_files "$tmp_dir/isagfv.json" "$tmp_dir/zipgfv.json"
+
+	rm -r "$tmp_dir"
+}
+
+# Test isaslicer batch queries {{{1
+################################################################
+
+check_batch_results() {
+
+	local batch_file="$1"
+	shift
+
+	python3 - "$@" <<EOF
+# @@@BEGIN_PYTHON@@@
+import json
+import sys
+with open('$batch_file') as f:
+    batch = [json.loads(line) for line in f]
+expected = []
+for slice_file in sys.argv[1:]:
+    with open(slice_file) as f:
+        expected.append(json.load(f))
+if batch != expected:
+    print('The batch results differ from the single queries ones.', file = sys.stderr)
+    sys.exit(1)
+# @@@END_PYTHON@@@
+EOF
+}
+
+test_isaslicer_batch_queries() {
+
+	local study_path="$RESDIR/MTBLS1-isatab"
+	local tmp_dir=$(mktemp -d)
+	write_queries "$tmp_dir/query.json" "$tmp_dir/queries.jsonl"
+
+	# Each line of the batch answers a query as isaslicer2-slice does
+	$ISASLICER 'isaslicer2-batch' "$study_path" "$tmp_dir/queries.jsonl" "$tmp_dir/batch.jsonl"
+	local i=0
+	while read -r query ; do
+		i=$((i + 1))
+		echo "{\"query\": $query}" >"$tmp_dir/query-$i.json"
+		$ISASLICER 'isaslicer2-slice' --source_dir "$study_path" --galaxy_parameters_file "$tmp_dir/query-$i.json" --output "$tmp_dir/slice-$i.json" >/dev/null
+	done <"$tmp_dir/queries.jsonl"
+	expect_success check_batch_results "$tmp_dir/batch.jsonl" "$tmp_dir/slice-1.json" "$tmp_dir/slice-2.json"
+
+	rm -r "$tmp_dir"
+}
+
+# Test isaslicer link modes {{{1
+################################################################
+
+test_isaslicer_link_modes() {
+
+	local tmp_dir=$(mktemp -d)
+	local study_path="$tmp_dir/study"
+	make_study_with_data_files "$study_path" "$tmp_dir/study.zip"
+	local data_file=ADG10003u_015.nmrML
+
+	# Every mode materializes the same data files
+	for mode in copy hardlink symlink ; do
+		mkdir "$tmp_dir/$mode"
+		expect_success $ISASLICER 'isa-tab-get-data-collection' "$study_path" "$tmp_dir/$mode" --link-mode $mode --json-query '{"Gender": "Female"}'
+	done
+	expect_file_exists "$tmp_dir/copy/$data_file"
+	expect_success diff -r "$tmp_dir/copy" "$tmp_dir/hardlink"
+	expect_success diff -r "$tmp_dir/copy" "$tmp_dir/symlink"
+
+	# As copies, hard links or symbolic links to the study files
+	expect_failure test "$tmp_dir/copy/$data_file" -ef "$study_path/$data_file"
+	expect_success test "$tmp_dir/hardlink/$data_file" -ef "$study_path/$data_file"
+	expect_success test -L "$tmp_dir/symlink/$data_file"
+
+	rm -r "$tmp_dir"
+}
+
+# Test isaslicer SQLite engine {{{1
+################################################################
+
+test_isaslicer_sqlite_engine() {
+
+	local study_path="$RESDIR/MTBLS1-isatab"
+	local tmp_dir=$(mktemp -d)
+	write_queries "$tmp_dir/query.json" "$tmp_dir/queries.jsonl"
+	$ISASLICER 'isaslicer2-slice' --source_dir "$study_path" --galaxy_parameters_file "$tmp_dir/query.json" --output "$tmp_dir/slice.json" >/dev/null
+	$ISASLICER 'isa-tab-get-data-list' "$study_path" "$tmp_dir/data-files.json"
+
+	# Answers of the SQL engine, loading the tables then reusing them
+	for run in loaded reused ; do
+		$ISASLICER --sqlite-db "$tmp_dir/isa.db" 'isaslicer2-slice' --source_dir "$study_path" --galaxy_parameters_file "$tmp_dir/query.json" --output "$tmp_dir/$run-slice.json" >/dev/null
+		$ISASLICER --sqlite-db "$tmp_dir/isa.db" 'isa-tab-get-data-list' "$study_path" "$tmp_dir/$run-data-files.json"
+		expect_same_files "$tmp_dir/slice.json" "$tmp_dir/$run-slice.json"
+		expect_same_files "$tmp_dir/data-files.json" "$tmp_dir/$run-data-files.json"
+	done
+
+	rm -r "$tmp_dir"
+}
+
+# Test MetaboLights download {{{1
+################################################################
+
+test_isaslicer_mtbls_download() {
+
+	# Serve the test study from a local HTTP server standing in for MetaboLights
+	local study=MTBLS1
+	local remote_dir=$(mktemp -d)
+	local output_dir=$(mktemp -d)
+	cp -r "$RESDIR/$study-isatab" "$remote_dir/$study"
+	local port=$(python3 -c 'import socket; s = socket.socket(); s.bind(("127.0.0.1", 0)); print(s.getsockname()[1])')
+	python3 -m http.server "$port" --bind 127.0.0.1 --directory "$remote_dir" >/dev/null 2>&1 &
+	local server_pid=$!
+	sleep 1
+
+	# Download the study, with several files in parallel
+	$ISASLICER --mtbls-url "http://127.0.0.1:$port" --study-cache-dir "$output_dir/cache" --download-jobs 2 'mtbls-get-study' "$study" "$output_dir/downloaded"
+	kill $server_pid
+	expect_success diff "$RESDIR/$study-isatab/s_$study.txt" "$output_dir/downloaded/s_$study.txt"
+
+	# Get it again from the study cache, the server being gone
+	$ISASLICER --mtbls-url "http://127.0.0.1:$port" --study-cache-dir "$output_dir/cache" 'mtbls-get-study' "$study" "$output_dir/cached"
+	expect_success diff -r "$output_dir/downloaded" "$output_dir/cached"
+
+	rm -r "$remote_dir" "$output_dir"
+}
+
 # Main {{{1
 ################################################################
 
 test_context "Testing isaslicer"
 test_that "Test that isaslicer outputs list of all data files." test_isaslicer_all_data_files
+test_that "Test that isaslicer skips empty data file cells." test_isaslicer_empty_data_file_cells
+test_that "Test that isaslicer caches parsed tables safely." test_isaslicer_table_cache
+test_that "Test that isaslicer collects data files stored in subdirectories." test_isaslicer_nested_data_files
+test_that "Test that isaslicer answers queries through its server." test_isaslicer_server
+test_that "Test that isaslicer answers from a study index." test_isaslicer_study_index
+test_that "Test that isaslicer writes data files lists in all output formats." test_isaslicer_output_formats
+test_that "Test that isaslicer reads factor queries from JSON and Galaxy parameters." test_isaslicer_factor_queries
+test_that "Test that isaslicer reads studies straight from zip archives." test_isaslicer_zip_archives
+test_that "Test that isaslicer runs batches of queries." test_isaslicer_batch_queries
+test_that "Test that isaslicer collects data files as copies or links." test_isaslicer_link_modes
+test_that "Test that isaslicer answers queries with its SQLite engine." test_isaslicer_sqlite_engine
+test_that "Test that isaslicer downloads MetaboLights studies from a local server." test_isaslicer_mtbls_download
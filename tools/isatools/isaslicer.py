@@ -1,22 +1,180 @@
 #!/usr/bin/env python3
 
 import argparse
+import builtins
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import fnmatch
+import functools
 import glob
+import hashlib
+import html
+import io
+import itertools
 import json
 import logging
 import os
+import pickle
 import re
+import resource
 import shutil
+import signal
+import socket
+import socketserver
+import sqlite3
 import sys
 import tempfile
+import threading
+import time
+import urllib.parse
 import zipfile
 
-import pandas as pd
-from isatools import isatab
-from isatools.model import OntologyAnnotation
-from isatools.net import mtbls as MTBLS
+# pandas and isatools are imported by the functions using them: importing
+# isatools alone takes seconds, which the table-level commands never need.
 
 logger = None
+table_cache = None
+server_address = None
+sqlite_db = None
+jobs = 1
+output_format = 'json'
+metrics = None
+mtbls_url = None
+download_jobs = 4
+study_cache = None
+
+
+# instrumentation
+
+class PhaseMetrics(object):
+    """Wall time and peak RSS of the phases of a run.
+
+    Time spent in a phase nested in another counts for the inner phase
+    only. Imports done while measuring count for the ``import`` phase
+    wherever they happen, so that the lazy imports of pandas and isatools
+    are not mistaken for parsing time. The times of phases running in
+    several threads at once add up.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = collections.OrderedDict()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self._import = builtins.__import__
+
+    def install(self):
+        metrics = self
+
+        def timed_import(*args, **kwargs):
+            with metrics.phase('import'):
+                return metrics._import(*args, **kwargs)
+        builtins.__import__ = timed_import
+
+    def uninstall(self):
+        builtins.__import__ = self._import
+
+    @staticmethod
+    def peak_rss_mb():
+        # the largest of the process and of its terminated workers, in
+        # kilobytes on Linux and in bytes on macOS
+        peak = max(resource.getrusage(who).ru_maxrss for who in (
+            resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+        return round(peak / (1 << 20 if sys.platform == 'darwin'
+                             else 1 << 10), 1)
+
+    def _account(self, frame, now):
+        name, resumed = frame
+        with self.lock:
+            phase = self.phases.setdefault(name, collections.OrderedDict([
+                ('wall_time', 0.0), ('calls', 0), ('peak_rss_mb', 0.0)]))
+            phase['wall_time'] += now - resumed
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def report(self, command):
+        total = time.perf_counter() - self.started
+        phases = collections.OrderedDict()
+        for name, phase in self.phases.items():
+            phases[name] = collections.OrderedDict(
+                (key, round(value, 3) if key == 'wall_time' else value)
+                for key, value in phase.items())
+        return collections.OrderedDict([
+            ('command', command),
+            ('wall_time', round(total, 3)),
+            ('other_time', round(total - sum(
+                phase['wall_time'] for phase in self.phases.values()), 3)),
+            ('peak_rss_mb', self.peak_rss_mb()),
+            ('phases', phases),
+        ])
+
+
+class _Phase(object):
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        stack = getattr(self.metrics.local, 'stack', None)
+        if stack is None:
+            stack = self.metrics.local.stack = []
+        now = time.perf_counter()
+        if stack:
+            self.metrics._account(stack[-1], now)
+        stack.append([self.name, now])
+
+    def __exit__(self, *exc_info):
+        stack = self.metrics.local.stack
+        now = time.perf_counter()
+        frame = stack.pop()
+        self.metrics._account(frame, now)
+        if frame[0] != 'import' or not stack or stack[-1][0] != 'import':
+            peak_rss_mb = self.metrics.peak_rss_mb()
+            with self.metrics.lock:
+                phase = self.metrics.phases[frame[0]]
+                phase['calls'] += 1
+                phase['peak_rss_mb'] = peak_rss_mb
+        if stack:
+            stack[-1][1] = now
+
+
+def _timed(name):
+    """Account the calls of the decorated function to the phase called
+    name, when metrics are collected"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if metrics is None:
+                return func(*args, **kwargs)
+            with metrics.phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _timed_iterations(name):
+    """Account the iterations of the decorated generator function to the
+    phase called name, when metrics are collected"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            items = func(*args, **kwargs)
+            if metrics is None:
+                yield from items
+                return
+            while True:
+                with metrics.phase(name):
+                    item = next(items, _timed_iterations)
+                if item is _timed_iterations:
+                    return
+                yield item
+        return wrapper
+    return decorator
+
 
 #    isaslicer.py <command> <study_id> [ command-specific options ]
 
@@ -27,6 +185,71 @@ def make_parser():
     parser.add_argument('--log-level', choices=[
         'DEBUG', 'INFO', 'WARN', 'ERROR', 'FATAL'],
         default='INFO', help="Set the desired logging level")
+    parser.add_argument(
+        '--metrics-out', metavar="PATH",
+        help="Write the wall time and peak RSS of the phases of the run "
+             "(import, download, extraction, parsing, filtering, output) to "
+             "this JSON file")
+    parser.add_argument(
+        '--profile', metavar="PATH",
+        help="Profile the run with cProfile and dump the statistics to this "
+             "file, for python -m pstats or snakeviz")
+    parser.add_argument(
+        '--table-cache-dir', metavar="PATH",
+        default=os.environ.get('ISASLICER_TABLE_CACHE_DIR'),
+        help="Directory used to cache parsed ISA-Tab tables between runs "
+             "(default: $ISASLICER_TABLE_CACHE_DIR, caching disabled if "
+             "unset). It must be writable by its owner only")
+    parser.add_argument(
+        '--table-cache-size', metavar="MB", type=int, default=1024,
+        help="Maximum size of the parsed tables cache, in megabytes")
+    parser.add_argument(
+        '--mtbls-url', metavar="URL",
+        default=os.environ.get('ISASLICER_MTBLS_URL', _MTBLS_URL),
+        help="ftp://, http(s):// or file:// URL of the directory holding "
+             "the MetaboLights studies (default: $ISASLICER_MTBLS_URL, or "
+             "the EBI FTP server)")
+    parser.add_argument(
+        '--download-jobs', metavar="N", type=int, default=4,
+        help="Number of files of a MetaboLights study downloaded in "
+             "parallel, each thread reusing its own connection")
+    parser.add_argument(
+        '--study-cache-dir', metavar="PATH",
+        default=os.environ.get('ISASLICER_STUDY_CACHE_DIR'),
+        help="Directory used to cache MetaboLights studies between runs "
+             "(default: $ISASLICER_STUDY_CACHE_DIR, caching disabled if "
+             "unset)")
+    parser.add_argument(
+        '--study-cache-size', metavar="MB", type=int, default=4096,
+        help="Maximum size of the MetaboLights studies cache, in megabytes")
+    parser.add_argument(
+        '--study-cache-ttl', metavar="SECONDS", type=int, default=86400,
+        help="How long a cached study is used without checking that it is "
+             "still current on the server")
+    parser.add_argument(
+        '--sqlite-db', metavar="PATH",
+        default=os.environ.get('ISASLICER_SQLITE_DB'),
+        help="Answer ISA-Tab directory queries with indexed SQL, the "
+             "tables being loaded once into this SQLite database "
+             "(default: $ISASLICER_SQLITE_DB)")
+    parser.add_argument(
+        '--jobs', metavar="N", type=int, default=1,
+        help="Number of processes parsing ISA-Tab tables, and of threads "
+             "copying data files, in parallel (0 for one per CPU core)")
+    parser.add_argument(
+        '--output-format', choices=['json', 'compact', 'ndjson', 'tsv'],
+        default='json',
+        help="Format of the JSON outputs: indented JSON (json), JSON "
+             "without whitespace (compact), one JSON document per result "
+             "(ndjson) or tab-separated rows, one per data file of each "
+             "result (tsv). Results are written as they are produced. "
+             "isaslicer2-batch always writes JSON lines")
+    parser.add_argument(
+        '--server', metavar="ADDRESS",
+        default=os.environ.get('ISASLICER_SERVER'),
+        help="Answer ISA-Tab directory queries through an isaslicer server "
+             "listening on this unix socket path or localhost port "
+             "(default: $ISASLICER_SERVER)")
 
     subparsers = parser.add_subparsers(
         title='Actions',
@@ -46,6 +269,15 @@ def make_parser():
     subparser.add_argument('--format', metavar="FMT", choices=[
         'zip', 'tar', 'gztar', 'bztar', 'xztar'], default='zip',
         help="Type of archive to create")
+    subparser.add_argument(
+        '--compression-level', metavar="N", type=int, choices=range(10),
+        help="Compression level, from 0 to 9 (default: that of the format). "
+             "0 stores zip members uncompressed, for already compressed "
+             "files")
+    subparser.add_argument(
+        '--compress-jobs', metavar="N", type=int,
+        help="Number of threads compressing gztar, bztar and xztar "
+             "archives (default: --jobs, 0 for one per CPU core)")
 
     subparser = subparsers.add_parser('mtbls-get-study', aliases=['gs'],
                                       help="Get ISA study from MetaboLights")
@@ -78,7 +310,8 @@ def make_parser():
         help="Output file")
 
     subparser = subparsers.add_parser('mtbls-get-data-list', aliases=['gd'],
-                                      help="Get data files list in json format")
+                                      help="Get data files list in json format, empty data file "
+                                           "cells skipped")
     subparser.set_defaults(func=get_data_files_command)
     subparser.add_argument('study_id')
     subparser.add_argument('output', nargs='?', type=argparse.FileType('w'), default=sys.stdout,
@@ -101,6 +334,67 @@ def make_parser():
     subparser.add_argument(
         'html_output', nargs='?', type=argparse.FileType('w'), default=sys.stdout,
         help="Output HTML file")
+    subparser.add_argument(
+        '--html-page-size', metavar="ROWS", type=int,
+        default=_HTML_PAGE_SIZE,
+        help="Split the HTML tables into pages of this many rows (0 for a "
+             "single page)")
+
+    subparser = subparsers.add_parser(
+        'mtbls-get-outputs', aliases=['go'],
+        help="Get any of the factors, factor values, data files list and "
+             "variables summary of a study, fetched once")
+    subparser.set_defaults(func=get_outputs_command)
+    subparser.add_argument('study_id')
+    subparser.add_argument(
+        '--factors', metavar="PATH", help="Write the factor names to PATH")
+    subparser.add_argument(
+        '--factor-values', nargs=2, action='append', default=[],
+        metavar=("FACTOR", "PATH"),
+        help="Write the values of FACTOR to PATH (repeatable)")
+    subparser.add_argument(
+        '--data-list', metavar="PATH",
+        help="Write the data files list to PATH")
+    subparser.add_argument(
+        '--json-query',
+        help="Factor query of the data files list in JSON (e.g., "
+             "'{\"Gender\":\"Male\"}'")
+    subparser.add_argument(
+        '--galaxy_parameters_file',
+        help="Path to JSON file containing input Galaxy JSON, for the data "
+             "files list")
+    subparser.add_argument(
+        '--summary', metavar="PATH",
+        help="Write the variables summary to PATH, in JSON")
+    subparser.add_argument(
+        '--summary-html', metavar="PATH",
+        help="Write the variables summary to PATH, in HTML")
+    subparser.add_argument(
+        '--html-page-size', metavar="ROWS", type=int,
+        default=_HTML_PAGE_SIZE,
+        help="Split the HTML tables into pages of this many rows (0 for a "
+             "single page)")
+
+    subparser = subparsers.add_parser(
+        'mtbls-get-studies', aliases=['gss'],
+        help="Get many ISA studies from MetaboLights, concurrently")
+    subparser.set_defaults(func=get_studies_command)
+    subparser.add_argument(
+        'output_dir', metavar="DIR",
+        help="Directory to write each study to, in a directory named after "
+             "its identifier. Existing study directories are replaced")
+    subparser.add_argument('study_ids', nargs='*', metavar="STUDY_ID")
+    subparser.add_argument(
+        '--study-list', type=argparse.FileType('r'),
+        help="File of study identifiers, one per line, # starting comments")
+    subparser.add_argument(
+        '--study-jobs', metavar="N", type=int, default=4,
+        help="Number of studies fetched at once, sharing the study cache "
+             "and the --download-jobs connections")
+    subparser.add_argument(
+        '--report', type=argparse.FileType('w'),
+        help="Write the status, time, file count and size, or error, of "
+             "every study to this file, in the output format")
 
     # isaslicer commands on path to unpacked ISA-Tab as input
 
@@ -149,7 +443,8 @@ def make_parser():
         help="Output file")
 
     subparser = subparsers.add_parser('isa-tab-get-data-list', aliases=['isagdl'],
-                                      help="Get data files list in json format")
+                                      help="Get data files list in json format, empty data file "
+                                           "cells skipped")
     subparser.set_defaults(func=isatab_get_data_files_list_command)
     subparser.add_argument('input_path', type=str, help="Input ISA-Tab path")
     subparser.add_argument('output', nargs='?', type=argparse.FileType('w'), default=sys.stdout,
@@ -162,7 +457,8 @@ def make_parser():
         help="Path to JSON file containing input Galaxy JSON")
 
     subparser = subparsers.add_parser('zip-get-data-list', aliases=['zipgdl'],
-                                      help="Get data files list in json format")
+                                      help="Get data files list in json format, empty data file "
+                                           "cells skipped")
     subparser.set_defaults(func=zip_get_data_files_list_command)
     subparser.add_argument('input_path', type=str, help="Input ISA-Tab zip path")
     subparser.add_argument('output', nargs='?', type=argparse.FileType('w'), default=sys.stdout,
@@ -185,6 +481,11 @@ def make_parser():
     subparser.add_argument(
         '--galaxy_parameters_file',
         help="Path to JSON file containing input Galaxy JSON")
+    subparser.add_argument(
+        '--link-mode', choices=list(_LINK_MODES), default='auto',
+        help="How data files are materialized in the output path: auto "
+             "tries a reflink, then a hard link, falling back to a copy "
+             "(default: auto)")
 
     subparser = subparsers.add_parser('zip-get-data-collection', aliases=['zipgdc'],
                                       help="Get data files collection")
@@ -194,6 +495,9 @@ def make_parser():
     subparser.add_argument(
         '--json-query',
         help="Factor query in JSON (e.g., '{\"Gender\":\"Male\"}'")
+    subparser.add_argument(
+        '--galaxy_parameters_file',
+        help="Path to JSON file containing input Galaxy JSON")
 
     subparser = subparsers.add_parser(
         'isa-tab-get-factors-summary', aliases=['isasum'],
@@ -218,6 +522,20 @@ def make_parser():
         'html_output', nargs='?', type=argparse.FileType('w'),
         default=sys.stdout,
         help="Output HTML file")
+    subparser.add_argument(
+        '--html-page-size', metavar="ROWS", type=int,
+        default=_HTML_PAGE_SIZE,
+        help="Split the HTML tables into pages of this many rows (0 for a "
+             "single page)")
+
+    subparser = subparsers.add_parser(
+        'isa-tab-build-index', aliases=['isaidx'],
+        help="Build an index of an ISA-Tab study, which the isa-tab-get-* "
+             "and isaslicer2-* commands accept in place of the study")
+    subparser.set_defaults(func=isatab_build_index_command)
+    subparser.add_argument(
+        'input_path', type=str, help="Input ISA-Tab path or zip path")
+    subparser.add_argument('output', type=str, help="Output index path")
 
     subparser = subparsers.add_parser(
         'isaslicer2-slice', aliases=['slice2'],
@@ -231,6 +549,30 @@ def make_parser():
     subparser.add_argument('--output', type=argparse.FileType(mode='w'),
                            help="Input ISA-Tab zip path")
 
+    subparser = subparsers.add_parser(
+        'isaslicer2-batch', aliases=['batch2'],
+        help="Run many slicer queries against one ISA-Tab study")
+    subparser.set_defaults(func=batch_query_isatab)
+    subparser.add_argument('input_path', type=str, help="Input ISA-Tab path")
+    subparser.add_argument(
+        'queries', type=argparse.FileType(mode='r'),
+        help="JSON lines file of queries, in the format of the query of "
+             "isaslicer2-slice")
+    subparser.add_argument(
+        'output', nargs='?', type=argparse.FileType('w'), default=sys.stdout,
+        help="Output JSON lines file, with the results of one query per line")
+
+    subparser = subparsers.add_parser(
+        'serve', help="Run a server keeping recently used ISA-Tab studies "
+                      "parsed in memory")
+    subparser.set_defaults(func=serve_command)
+    subparser.add_argument(
+        'address', metavar="ADDRESS",
+        help="Unix socket path or localhost port to listen on")
+    subparser.add_argument(
+        '--max-studies', type=int, default=16,
+        help="Number of studies kept in memory")
+
     subparser = subparsers.add_parser(
         'filter-data', aliases=['filter'],
         help="Filter out data based on slicer2")
@@ -244,6 +586,275 @@ def make_parser():
     return parser
 
 
+# ISA-Tab table loading
+
+class TableCache(object):
+    """On-disk LRU cache of parsed ISA-Tab tables.
+
+    Parsed DataFrames are pickled under the SHA-256 digest of the table
+    file content, salted with the parser and pandas versions, so that
+    identical tables are shared across Galaxy jobs whatever their path.
+    Entries are published with an atomic rename and their mtime is bumped
+    on every hit, the least recently used entries being evicted once the
+    cache grows over ``max_size`` bytes. Unpickling runs code, so the cache
+    directory must be writable by its owner only.
+    """
+
+    _SUFFIX = '.pkl'
+    # bump whenever load_table parses tables differently
+    _VERSION = 2
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        st = os.stat(cache_dir)
+        if st.st_uid != os.getuid() or st.st_mode & 0o022:
+            raise RuntimeError(
+                "Refusing the table cache directory {}: it must be owned by "
+                "the current user and not writable by group or others"
+                .format(cache_dir))
+
+    @staticmethod
+    def digest(table_file, zfp=None):
+        sha = hashlib.sha256()
+        with _open_table(table_file, zfp=zfp, mode='rb') as fp:
+            for chunk in iter(lambda: fp.read(1 << 20), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def _entry(self, digest):
+        import pandas as pd
+        key = '{}:{}:{}'.format(digest, self._VERSION, pd.__version__)
+        return os.path.join(self.cache_dir, hashlib.sha256(
+            key.encode('utf-8')).hexdigest() + self._SUFFIX)
+
+    def load(self, table_file, zfp=None):
+        entry = self._entry(self.digest(table_file, zfp=zfp))
+        try:
+            with open(entry, 'rb') as fp:
+                df = pickle.load(fp)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            # truncated, or pickled by a pandas this one cannot read
+            logger.warning("Removing unreadable cache entry %s: %s",
+                           entry, e)
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+        else:
+            logger.debug("Table cache hit for %s", table_file)
+            try:
+                os.utime(entry)
+            except OSError:
+                pass  # evicted by a concurrent job in the meantime
+            return df
+        logger.debug("Table cache miss for %s", table_file)
+        with _open_table(table_file, zfp=zfp) as fp:
+            df = load_table(fp)
+        self._store(entry, df)
+        return df
+
+    def _store(self, entry, df):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                pickle.dump(df, fp, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, entry)
+        except OSError as e:
+            logger.warning("Could not write cache entry %s: %s", entry, e)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(self._SUFFIX):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            logger.debug("Evicting table cache entry %s", name)
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass  # already evicted by a concurrent job
+            total_size -= size
+
+
+def _open_table(table_file, zfp=None, mode='r'):
+    if zfp is None:
+        return open(table_file, mode)
+    member = zfp.open(table_file)
+    if mode == 'rb':
+        return member
+    return io.TextIOWrapper(member, encoding='utf-8')
+
+
+def list_tables(input_path, pattern, zfp=None):
+    """List the ISA-Tab tables matching ``pattern`` in an ISA-Tab source.
+
+    When ``zfp`` is given the tables are looked up among the top-level
+    members of that zip archive, and the member names are returned instead
+    of paths under ``input_path``.
+    """
+    if zfp is None:
+        return sorted(glob.glob(os.path.join(input_path, pattern)))
+    return sorted(name for name in zfp.namelist()
+                  if '/' not in name and fnmatch.fnmatch(name, pattern))
+
+
+@_timed('parsing')
+def read_table(table_file, zfp=None):
+    """Parse an ISA-Tab study or assay table into a DataFrame.
+
+    ``table_file`` is a member name of ``zfp`` when reading straight from a
+    zip archive.
+    """
+    if table_cache is not None:
+        return table_cache.load(table_file, zfp=zfp)
+    with _open_table(table_file, zfp=zfp) as fp:
+        return load_table(fp)
+
+
+@_timed('parsing')
+def read_table_header(table_file, zfp=None):
+    """Read the normalized column labels of an ISA-Tab table, without
+    parsing its rows."""
+    with _open_table(table_file, zfp=zfp) as fp:
+        for line in fp:
+            if line.strip() and not line.lstrip().startswith('#'):
+                header = next(csv.reader([line], delimiter='\t'))
+                break
+        else:
+            return []
+    # duplicated labels are suffixed as pandas.read_csv does
+    seen = collections.Counter()
+    labels = []
+    for label in header:
+        labels.append('{}.{}'.format(label, seen[label])
+                      if seen[label] else label)
+        seen[label] += 1
+    return [_normalize_label(label) for label in labels]
+
+
+_COLUMN_CHUNK_ROWS = 1 << 16
+
+
+@_timed_iterations('parsing')
+def read_column_chunks(table_file, column, zfp=None,
+                       chunksize=_COLUMN_CHUNK_ROWS):
+    """Stream the cells of the ``column`` columns of an ISA-Tab table.
+
+    Only the matching columns are parsed, ``chunksize`` rows at a time, so
+    memory stays bounded whatever the size of the table. Yields DataFrames
+    of strings, empty cells being NaN.
+    """
+    import pandas as pd
+    positions = [position for position, label in enumerate(
+        read_table_header(table_file, zfp=zfp)) if label == column]
+    if not positions:
+        return
+    # a first pass finds the comment lines, which pandas cannot tell apart
+    # from cells starting with '#'
+    with _open_table(table_file, zfp=zfp) as fp:
+        skipped = [number for number, line in enumerate(fp)
+                   if not line.strip() or line.lstrip().startswith('#')]
+    with _open_table(table_file, zfp=zfp) as fp:
+        for chunk in pd.read_csv(fp, sep='\t', dtype=str, usecols=positions,
+                                 skiprows=skipped, chunksize=chunksize):
+            yield chunk
+
+
+def _init_table_worker(log_level, cache):
+    global logger, table_cache, metrics
+    if metrics is not None:  # inherited from a forking parent
+        metrics.uninstall()
+        metrics = None
+    logging.basicConfig(level=log_level)
+    logger = logging.getLogger()
+    logger.setLevel(log_level)
+    table_cache = cache
+
+
+def _read_table_job(table_file, zip_path=None):
+    if zip_path is None:
+        return read_table(table_file)
+    with zipfile.ZipFile(zip_path) as zfp:
+        return read_table(table_file, zfp=zfp)
+
+
+@_timed('parsing')
+def read_tables(table_files, zip_path=None):
+    """Parse several ISA-Tab tables, in a pool of ``jobs`` processes when
+    there is more than one table to parse.
+
+    The DataFrames are returned in the order of ``table_files`` whatever
+    the order the workers complete in, so that the output does not depend
+    on the number of jobs. Table members of a zip archive are read by the
+    workers from ``zip_path``.
+    """
+    workers = min(jobs or os.cpu_count() or 1, len(table_files))
+    if workers <= 1:
+        if zip_path is None:
+            return [read_table(table_file) for table_file in table_files]
+        with zipfile.ZipFile(zip_path) as zfp:
+            return [read_table(table_file, zfp=zfp)
+                    for table_file in table_files]
+    logger.debug("Parsing %d tables with %d processes",
+                 len(table_files), workers)
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_table_worker,
+            initargs=(logger.level, table_cache)) as executor:
+        return list(executor.map(
+            _read_table_job, table_files, [zip_path] * len(table_files)))
+
+
+_RX_BRACKETED_LABEL = re.compile(r'.*\[(.*?)\]')
+
+
+def _normalize_label(label):
+    hit = _RX_BRACKETED_LABEL.match(label)
+    if hit is None:
+        if label == 'Material Type':
+            return 'Characteristics[Material Type]'
+        return label
+    value = hit.group(1).strip()
+    for kind in ('Comment', 'Characteristics', 'Parameter Value',
+                 'Factor Value'):
+        if kind in label:
+            return '{}[{}]'.format(kind, value)
+    return ''
+
+
+def load_table(fp):
+    """Load an ISA-Tab study or assay table into a DataFrame of strings.
+
+    Mirrors ``isatools.isatab.load_table`` (comment lines skipped, empty
+    cells read as '', bracketed labels normalized) without paying for the
+    import of isatools.
+    """
+    import pandas as pd
+    buffer = io.StringIO()
+    for line in fp:
+        if line.strip() and not line.lstrip().startswith('#'):
+            buffer.write(line)
+    buffer.seek(0)
+    df = pd.read_csv(buffer, dtype=str, sep='\t').fillna('')
+    df.columns = [_normalize_label(label) for label in df.columns]
+    return df
+
+
 def filter_data(options):
     loglines = []
     source_dir = options.input_path if options.input_path else ""
@@ -301,209 +912,1801 @@ def query_isatab(options):
         print('Query is:')
         print(json.dumps(query, indent=4))  # for debugging only
     if source_dir:
-        investigation = isatab.load(source_dir)
-    else:
-        tmp = tempfile.mkdtemp()
-        _ = MTBLS.get(galaxy_parameters['input']['mtbls_id'], tmp)
-        investigation = isatab.load(tmp)
-    # filter assays by mt/tt
-    matching_assays = []
-    mt = query.get('measurement_type').strip()
-    tt = query.get('technology_type').strip()
-    if mt and tt:
-        for study in investigation.studies:
-            matching_assays.extend(
-                [x for x in study.assays if x.measurement_type.term == mt
-                 and x.technology_type.term == tt])
-    elif mt and not tt:
-        for study in investigation.studies:
-            matching_assays.extend(
-                [x for x in study.assays if x.measurement_type.term == mt])
-    elif not mt and tt:
-        for study in investigation.studies:
-            matching_assays.extend(
-                [x for x in study.assays if x.technology_type.term == tt])
+        results = open_study(source_dir).query(query)
     else:
-        for study in investigation.studies:
-            matching_assays.extend(study.assays)
-    assay_samples = []
-    for assay in matching_assays:
-        assay_samples.extend(assay.samples)
+        with mtbls_study(galaxy_parameters['input']['mtbls_id']) as study_dir:
+            results = open_study(study_dir).query(query)
     if debug:
-        print('Total samples: {}'.format(len(assay_samples)))
+        print('Final number of samples: {}'.format(len(results)))
+    write_query_results(query, results, output)
 
-    # filter samples by fv
-    factor_selection = {
-        x.get('factor_name').strip(): x.get('factor_value').strip() for x in
-        query.get('factor_selection', [])}
+    # if galaxy_parameters['input']['collection_output']:
+    #     logger = logging.getLogger()
+    #     logger.debug("copying data files to %s", os.path.dirname(output))
+    #     for result in results:
+    #         for data_file_name in result['data_files']:
+    #             logging.info("Copying {}".format(data_file_name))
+    #             shutil.copy(os.path.join(source_dir, data_file_name),
+    #                         os.path.dirname(output))
+    #     logger.info(
+    #       "Finished writing data files to {}".format(os.path.dirname(output)))
 
-    fv_samples = set()
-    if factor_selection:
-        samples_to_remove = set()
-        for f, v in factor_selection.items():
-            for sample in assay_samples:
-                for fv in [x for x in sample.factor_values if
-                           x.factor_name.name == f]:
-                    if isinstance(fv.value, OntologyAnnotation):
-                        if fv.value.term == v:
-                            fv_samples.add(sample)
-                    elif fv.value == v:
-                        fv_samples.add(sample)
-        for f, v in factor_selection.items():
-            for sample in fv_samples:
-                for fv in [x for x in sample.factor_values if
-                           x.factor_name.name == f]:
-                    if isinstance(fv.value, OntologyAnnotation):
-                        if fv.value.term != v:
-                            samples_to_remove.add(sample)
-                    elif fv.value != v:
-                        samples_to_remove.add(sample)
-        final_fv_samples = fv_samples.difference(samples_to_remove)
+
+def batch_query_isatab(options):
+    study = open_study(options.input_path)
+    logger.info("Running queries from %s against study %s. Writing to %s.",
+                options.queries.name, options.input_path, options.output.name)
+    for line_number, line in enumerate(options.queries, start=1):
+        if not line.strip():
+            continue
+        query = json.loads(line)
+        query = query.get('query', query)
+        results = study.query(query)
+        logger.info("Query on line %d matched %d samples",
+                    line_number, len(results))
+        json.dump({'query': query, 'results': results}, options.output)
+        options.output.write('\n')
+    logger.info("Finished writing query results to %s", options.output.name)
+
+
+# columnar query engine
+
+_RX_FACTOR_VALUE = re.compile(r'Factor Value\[(.*?)\]')
+
+
+class LoadedStudy(object):
+    """An ISA-Tab study whose tables are parsed once, then queried many
+    times.
+
+    Tables, the assays listed in the investigation file and the sample to
+    data files indexes are loaded lazily and kept for the lifetime of the
+    object.
+    """
+
+    def __init__(self, source_dir, zfp=None):
+        self.source_dir = source_dir
+        self.zfp = zfp
+        self._tables = {}
+        self._assays = None
+        self._data_files_indexes = {}
+
+    def table_names(self, pattern):
+        return [os.path.basename(table_file) for table_file in
+                list_tables(self.source_dir, pattern, zfp=self.zfp)]
+
+    def table(self, table_file):
+        if table_file not in self._tables:
+            logger.info('Loading {table_file}'.format(table_file=table_file))
+            if self.zfp is None:
+                self._tables[table_file] = read_table(
+                    os.path.join(self.source_dir, table_file))
+            else:
+                self._tables[table_file] = read_table(
+                    table_file, zfp=self.zfp)
+        return self._tables[table_file]
+
+    def table_header(self, table_file):
+        if table_file in self._tables:
+            return list(self._tables[table_file].columns)
+        if self.zfp is None:
+            return read_table_header(os.path.join(self.source_dir, table_file))
+        return read_table_header(table_file, zfp=self.zfp)
+
+    def tables(self, pattern):
+        table_names = self.table_names(pattern)
+        self.prefetch(table_names)
+        return [self.table(table_file) for table_file in table_names]
+
+    def prefetch(self, table_names):
+        """Parse the given tables in parallel when running several jobs."""
+        missing = [table_file for table_file in table_names
+                   if table_file not in self._tables]
+        if len(missing) > 1 and jobs != 1:
+            for table_file in missing:
+                logger.info('Loading {table_file}'.format(
+                    table_file=table_file))
+            if self.zfp is None:
+                dfs = read_tables([os.path.join(self.source_dir, table_file)
+                                   for table_file in missing])
+            else:
+                dfs = read_tables(missing, zip_path=self.zfp.filename)
+            self._tables.update(zip(missing, dfs))
+
+    @property
+    def assays(self):
+        if self._assays is None:
+            self._assays = read_investigation_assays(
+                self.source_dir, zfp=self.zfp)
+        return self._assays
+
+    @_timed('filtering')
+    def data_files_index(self, parameter_selection=None, distinct=False):
+        key = (frozenset((parameter_selection or {}).items()), distinct)
+        if key not in self._data_files_indexes:
+            self._data_files_indexes[key] = index_data_files(
+                self.tables('a_*'), parameter_selection=parameter_selection,
+                distinct=distinct)
+        return self._data_files_indexes[key]
+
+    def factor_names(self):
+        factors = collections.OrderedDict()
+        for table_file in self.table_names('[a|s]_*'):
+            for header in self.table_header(table_file):
+                if _RX_FACTOR_VALUE.match(header):
+                    factors[header[13:-1]] = None
+        return list(factors)
+
+    @_timed('filtering')
+    def factor_values(self, factor_name):
+        import pandas as pd
+        fvs = collections.OrderedDict()
+        column = 'Factor Value[{factor}]'.format(factor=factor_name)
+        for table_file in self.table_names('[a|s]_*'):
+            if table_file in self._tables:
+                df = self._tables[table_file]
+                chunks = [df.loc[:, df.columns == column]]
+            elif self.zfp is None:
+                chunks = read_column_chunks(
+                    os.path.join(self.source_dir, table_file), column)
+            else:
+                chunks = read_column_chunks(table_file, column, zfp=self.zfp)
+            for chunk in chunks:
+                for value in pd.unique(chunk.values.ravel()):
+                    if isinstance(value, str) and value not in ('', 'nan'):
+                        fvs[value] = None
+        return list(fvs)
+
+    @_timed('filtering')
+    def sample_records(self):
+        """Factor values and characteristics of every sample of the study
+        tables, in table order.
+
+        A sample takes its values from its first row, its own
+        characteristics overriding those of its source.
+        :return: A list of dicts giving the ``sample_name``,
+        ``source_name``, ``factors`` and ``characteristics`` of each sample
+        """
+        records = []
+        for df in self.tables('s_*'):
+            columns = list(df.columns)
+            first_rows = df[~df['Sample Name'].duplicated()]
+            factors = [(label[13:-1], _typed_values(first_rows, position))
+                       for position, label in enumerate(columns)
+                       if _RX_FACTOR_VALUE.match(label)]
+            characteristics = []
+            for node_label in ('Source Name', 'Sample Name'):
+                if node_label in columns:
+                    characteristics.extend(
+                        (category, _typed_values(first_rows, position))
+                        for category, position in _node_characteristics(
+                            columns, node_label).items())
+            sources = first_rows['Source Name'] if 'Source Name' in columns \
+                else [''] * len(first_rows)
+            for i, (sample_name, source_name) in enumerate(
+                    zip(first_rows['Sample Name'], sources)):
+                records.append({
+                    'sample_name': sample_name,
+                    'source_name': source_name,
+                    'factors': collections.OrderedDict(
+                        (name, values.iat[i]) for name, values in factors
+                        if values.iat[i] not in ('', None)),
+                    'characteristics': collections.OrderedDict(
+                        (category, values.iat[i])
+                        for category, values in characteristics
+                        if values.iat[i] not in ('', None)),
+                })
+        return records
+
+    @_timed('filtering')
+    def variables_summary(self, sources=False):
+        """Pivot the samples of the study tables against their variables.
+
+        Each sample gets its factor values and, with ``sources``, the name
+        and characteristics of its source, taken from their first rows and
+        typed as in the ISA object model. Variables having a single value
+        across the samples are dropped.
+        :return: A list of dicts, one per sample, ordered by name within
+        each study table as isatools orders them
+        """
+        import pandas as pd
+        frames = []
+        for df in self.tables('s_*'):
+            columns = list(df.columns)
+            first_rows = df[~df['Sample Name'].duplicated()]
+            variables = collections.OrderedDict([
+                ('sample_name', first_rows['Sample Name'])])
+            has_sources = sources and 'Source Name' in columns
+            if has_sources:
+                variables['source_name'] = first_rows['Source Name']
+            for position, label in enumerate(columns):
+                if _RX_FACTOR_VALUE.match(label):
+                    variables[label[13:-1]] = _typed_values(
+                        first_rows, position)
+            if has_sources:
+                source_rows = df[~df['Source Name'].duplicated()]
+                for category, position in _node_characteristics(
+                        columns, 'Source Name').items():
+                    values = _typed_values(source_rows, position)
+                    values.index = source_rows['Source Name']
+                    variables[category] = first_rows['Source Name'].map(
+                        values)
+            frames.append(pd.DataFrame(variables).sort_values(
+                'sample_name', kind='mergesort'))
+        if not frames:
+            return []
+        df = pd.concat(frames, ignore_index=True)
+        df = df.where(df.notna()).infer_objects()
+        nunique = df.apply(pd.Series.nunique)
+        cols_to_drop = nunique[nunique == 1].index
+        df = df.drop(cols_to_drop, axis=1)
+        return df.to_dict(orient='records')
+
+    @_timed('filtering')
+    def slice_samples(self, factor_selection=None):
+        """Names of the samples of the study and assay tables having one of
+        the selected factor values, in table order"""
+        samples = collections.OrderedDict()
+        for df in self.tables('[a|s]_*'):
+            if factor_selection is None:
+                samples.update((sample_name, None)
+                               for sample_name in df['Sample Name'])
+                continue
+            for factor_name, factor_value in factor_selection.items():
+                column = 'Factor Value[{}]'.format(factor_name)
+                if column in df.columns:
+                    samples.update(
+                        (sample_name, None) for sample_name in
+                        df.loc[df[column] == factor_value]['Sample Name'])
+        return list(samples)
+
+    def slice_data_files(self, factor_selection=None):
+        return list(self.iter_data_files(factor_selection))
+
+    @_timed_iterations('filtering')
+    def iter_data_files(self, factor_selection=None):
+        """Generate the slice_data_files results one sample at a time"""
+        data_files_index = self.data_files_index()
+        for sample_name in self.slice_samples(factor_selection):
+            result = {
+                'sample': sample_name,
+                'data_files': list(data_files_index.get(sample_name, [])),
+            }
+            if factor_selection is not None:
+                result['query_used'] = factor_selection
+            yield result
+
+    @_timed('filtering')
+    def assay_samples(self, study_file, assay_files):
+        """The samples of a study table found in its assay tables, in assay
+        order, listed once per assay"""
+        study_df = self.table(study_file)
+        assay_samples = []
+        for assay_file in assay_files:
+            assay_df = self.table(assay_file)
+            assay_samples.extend(
+                assay_df['Sample Name'][assay_df['Sample Name'].isin(
+                    study_df['Sample Name'])].drop_duplicates())
+        return assay_samples
+
+    def select_samples(self, study_file, assay_samples, factor_selection=None,
+                       characteristics_selection=None):
+        return select_samples(
+            self.table(study_file), assay_samples, factor_selection,
+            characteristics_selection)
+
+    @_timed('filtering')
+    def query(self, query):
+        """Run a slicer query against the study.
+
+        :param query: A query as built by the ISAslicer2 Galaxy tool, with
+        ``measurement_type``, ``technology_type``, ``factor_selection``,
+        ``characteristics_selection`` and ``parameter_selection`` entries
+        :return: A list of dicts giving the ``sample_name`` and
+        ``data_files`` of each matching sample
+        """
+        # filter assays by mt/tt
+        mt = (query.get('measurement_type') or '').strip()
+        tt = (query.get('technology_type') or '').strip()
+        studies = {}
+        for assay in self.assays:
+            if mt and assay['measurement_type'] != mt:
+                continue
+            if tt and assay['technology_type'] != tt:
+                continue
+            studies.setdefault(assay['study_file'], []).append(
+                assay['assay_file'])
+
+        factor_selection = {
+            x.get('factor_name').strip(): x.get('factor_value').strip()
+            for x in query.get('factor_selection', [])}
+        characteristics_selection = {
+            x.get('characteristic_name').strip():
+                x.get('characteristic_value').strip() for x in
+                query.get('characteristics_selection', [])}
+        parameters_selection = {
+            x.get('parameter_name').strip():
+                x.get('parameter_value').strip() for x in
+            query.get('parameter_selection', [])}
+
+        self.prefetch(list(studies) + self.table_names('a_*'))
+        final_samples = []
+        total_samples = 0
+        for study_file, assay_files in studies.items():
+            assay_samples = self.assay_samples(study_file, assay_files)
+            total_samples += len(assay_samples)
+            final_samples.extend(self.select_samples(
+                study_file, assay_samples, factor_selection,
+                characteristics_selection))
+        logger.debug("Selected %d samples out of %d",
+                     len(final_samples), total_samples)
+
+        data_files_index = self.data_files_index(
+            parameters_selection, distinct=True)
+        results = []
+        for sample_name in final_samples:
+            results.append({
+                'sample_name': sample_name,
+                'data_files': list(data_files_index.get(sample_name, []))
+            })
+        return results
+
+
+# isaslicer study index
+
+_INDEX_FORMAT = 'isaslicer-index'
+_INDEX_VERSION = 1
+_INDEX_HEADER = 'isaslicer-index.json'
+
+
+def _is_indexed_column(label):
+    """Whether a table column is kept in a study index, which holds what
+    the slicer queries need: nodes, the values qualifying them and units"""
+    return _is_node_column(label) or label.startswith((
+        'Factor Value[', 'Characteristics[', 'Parameter Value[', 'Unit',
+        'Term Source REF', 'Term Accession Number'))
+
+
+@_timed('output')
+def write_study_index(study, index_path):
+    """Write the index of a LoadedStudy, parsing each of its tables once.
+
+    The index is a zip archive whose header member holds the assays and
+    the factors, next to members holding the sample records, the sample to
+    data files mapping and the indexed columns of each table, so that
+    readers only inflate the parts they need.
+    """
+    table_names = study.table_names('[a|s]_*')
+    study.prefetch(table_names)
+    factor_names = study.factor_names()
+    header = collections.OrderedDict([
+        ('format', _INDEX_FORMAT),
+        ('version', _INDEX_VERSION),
+        ('assays', study.assays),
+        ('factor_names', factor_names),
+        ('factor_values', collections.OrderedDict(
+            (name, study.factor_values(name)) for name in factor_names)),
+        ('tables', table_names),
+    ])
+    samples = study.sample_records()
+    data_files = collections.OrderedDict(
+        (sample_name, list(files))
+        for sample_name, files in study.data_files_index().items())
+
+    def write(zfp, member, content):
+        zfp.writestr(member, json.dumps(content, separators=(',', ':')))
+
+    with zipfile.ZipFile(index_path, 'w', zipfile.ZIP_DEFLATED) as zfp:
+        write(zfp, _INDEX_HEADER, header)
+        write(zfp, 'samples.json', samples)
+        write(zfp, 'data_files.json', data_files)
+        for table_file in table_names:
+            df = study.table(table_file)
+            df = df.loc[:, [_is_indexed_column(label)
+                            for label in df.columns]]
+            write(zfp, 'tables/{}.json'.format(table_file), {
+                'columns': list(df.columns),
+                'rows': df.fillna('').values.tolist(),
+            })
+    return header, samples
+
+
+def is_study_index(input_path):
+    if not os.path.isfile(input_path) or not zipfile.is_zipfile(input_path):
+        return False
+    with zipfile.ZipFile(input_path) as zfp:
+        return _INDEX_HEADER in zfp.namelist()
+
+
+class IndexedStudy(LoadedStudy):
+    """A study answered from the index written by isa-tab-build-index.
+
+    The precomputed factors, samples and data files are returned as is,
+    while slicer queries run against the tables of the index.
+    """
+
+    def __init__(self, index_path):
+        super(IndexedStudy, self).__init__(index_path)
+        self.header = self._member(_INDEX_HEADER)
+        if self.header.get('format') != _INDEX_FORMAT \
+                or self.header.get('version') != _INDEX_VERSION:
+            raise IOError('{} is not a supported isaslicer index'.format(
+                index_path))
+        self._assays = self.header['assays']
+        self._samples = None
+
+    @_timed('parsing')
+    def _member(self, member):
+        with zipfile.ZipFile(self.source_dir) as zfp, zfp.open(member) as fp:
+            return json.load(io.TextIOWrapper(fp, encoding='utf-8'))
+
+    def table_names(self, pattern):
+        return [table_file for table_file in self.header['tables']
+                if fnmatch.fnmatch(table_file, pattern)]
+
+    def table(self, table_file):
+        import pandas as pd
+        if table_file not in self._tables:
+            logger.info('Loading {table_file}'.format(table_file=table_file))
+            table = self._member('tables/{}.json'.format(table_file))
+            self._tables[table_file] = pd.DataFrame(
+                table['rows'], columns=table['columns'], dtype=object)
+        return self._tables[table_file]
+
+    def table_header(self, table_file):
+        return list(self.table(table_file).columns)
+
+    def prefetch(self, table_names):
+        pass
+
+    @_timed('filtering')
+    def data_files_index(self, parameter_selection=None, distinct=False):
+        key = (frozenset((parameter_selection or {}).items()), distinct)
+        if key not in self._data_files_indexes \
+                and not parameter_selection and not distinct:
+            self._data_files_indexes[key] = self._member('data_files.json')
+        return super(IndexedStudy, self).data_files_index(
+            parameter_selection, distinct)
+
+    def factor_names(self):
+        return list(self.header['factor_names'])
+
+    def factor_values(self, factor_name):
+        return list(self.header['factor_values'].get(factor_name, []))
+
+    def sample_records(self):
+        if self._samples is None:
+            self._samples = self._member('samples.json')
+        return self._samples
+
+
+# SQLite query engine
+
+def _is_sql_indexed_column(label):
+    return label in ('Sample Name', 'Source Name') or label.startswith((
+        'Factor Value[', 'Characteristics[', 'Parameter Value['))
+
+
+class SQLiteStudy(LoadedStudy):
+    """A study whose slicer queries run as indexed SQL.
+
+    Each table is loaded once into the SQLite database under the digest of
+    its content, whatever the study it is found in, so that later jobs on
+    the same tables reuse it. Cells are stored as text in columns named
+    after their position, ``c<i>``; a ``k<i>`` column holds the values of
+    unit-qualified columns as compared by the ISA object model, numbers
+    being NULL.
+    """
+
+    def __init__(self, source_dir, db_path):
+        super(SQLiteStudy, self).__init__(source_dir)
+        self.db = sqlite3.connect(db_path, timeout=600)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS isa_tables '
+            '(digest TEXT PRIMARY KEY, columns TEXT NOT NULL)')
+        self.db.commit()
+        self._sql_tables = {}
+        self._digests = {}
+
+    def _path(self, table_file):
+        return os.path.join(self.source_dir, table_file)
+
+    def _digest(self, table_file):
+        if table_file not in self._digests:
+            self._digests[table_file] = TableCache.digest(
+                self._path(table_file))
+        return self._digests[table_file]
+
+    def _registered(self, digest):
+        row = self.db.execute('SELECT columns FROM isa_tables WHERE digest=?',
+                              (digest,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    @_timed('parsing')
+    def _store(self, digest, df):
+        columns = list(df.columns)
+        name = 't_' + digest
+        qualified = [position for position in range(len(columns))
+                     if _is_unit_qualified(columns, position)]
+        sql_columns = ['c{}'.format(i) for i in range(len(columns))] + \
+            ['k{}'.format(i) for i in qualified]
+        values = [df.iloc[:, i].fillna('') for i in range(len(columns))] + \
+            [_comparable_values(df, i) for i in qualified]
+        with self.db:
+            self.db.execute('BEGIN IMMEDIATE')
+            if self._registered(digest) is not None:
+                return  # loaded by a concurrent job
+            self.db.execute('DROP TABLE IF EXISTS {}'.format(name))
+            self.db.execute('CREATE TABLE {} ({})'.format(
+                name, ', '.join(sql_columns)))
+            self.db.executemany(
+                'INSERT INTO {} VALUES ({})'.format(
+                    name, ', '.join('?' * len(sql_columns))),
+                zip(*[value.tolist() for value in values]))
+            for i, label in enumerate(columns):
+                if _is_sql_indexed_column(label):
+                    column = 'k{}'.format(i) if i in qualified \
+                        else 'c{}'.format(i)
+                    self.db.execute('CREATE INDEX {0}_{1} ON {0} ({1})'.format(
+                        name, column))
+            self.db.execute('INSERT INTO isa_tables VALUES (?, ?)',
+                            (digest, json.dumps(columns)))
+
+    def sql_table(self, table_file):
+        """Load a table into the database if needed.
+
+        :return: The name of the SQL table and the labels of its columns
+        """
+        if table_file not in self._sql_tables:
+            digest = self._digest(table_file)
+            if self._registered(digest) is None:
+                logger.info('Loading {} into SQLite'.format(table_file))
+                self._store(digest, read_table(self._path(table_file)))
+            self._sql_tables[table_file] = (
+                't_' + digest, self._registered(digest))
+        return self._sql_tables[table_file]
+
+    def prefetch(self, table_names):
+        missing = {}
+        for table_file in table_names:
+            digest = self._digest(table_file)
+            if table_file not in self._sql_tables \
+                    and self._registered(digest) is None:
+                missing.setdefault(digest, table_file)
+        if missing:
+            dfs = read_tables([self._path(table_file)
+                               for table_file in missing.values()])
+            for digest, df in zip(missing, dfs):
+                self._store(digest, df)
+
+    @staticmethod
+    def _comparable(columns, position):
+        return 'k{}'.format(position) \
+            if _is_unit_qualified(columns, position) \
+            else 'c{}'.format(position)
+
+    @_timed('filtering')
+    def slice_samples(self, factor_selection=None):
+        samples = collections.OrderedDict()
+        table_names = self.table_names('[a|s]_*')
+        self.prefetch(table_names)
+        for table_file in table_names:
+            name, columns = self.sql_table(table_file)
+            sample = 'c{}'.format(columns.index('Sample Name'))
+            if factor_selection is None:
+                selects = [('SELECT {} FROM {} ORDER BY rowid'.format(
+                    sample, name), ())]
+            else:
+                selects = [
+                    ('SELECT {} FROM {} WHERE c{} = ? ORDER BY rowid'.format(
+                        sample, name, columns.index(
+                            'Factor Value[{}]'.format(factor_name))),
+                     (factor_value,))
+                    for factor_name, factor_value in factor_selection.items()
+                    if 'Factor Value[{}]'.format(factor_name) in columns]
+            for sql, parameters in selects:
+                samples.update((sample_name, None) for sample_name, in
+                               self.db.execute(sql, parameters))
+        return list(samples)
+
+    @_timed('filtering')
+    def data_files_index(self, parameter_selection=None, distinct=False):
+        key = (frozenset((parameter_selection or {}).items()), distinct)
+        if key in self._data_files_indexes:
+            return self._data_files_indexes[key]
+        index = {}
+        table_names = self.table_names('a_*')
+        self.prefetch(table_names)
+        for table_file in table_names:
+            name, columns = self.sql_table(table_file)
+            where, parameters = '', []
+            if parameter_selection:
+                conditions = []
+                for parameter, value in parameter_selection.items():
+                    label = 'Parameter Value[{}]'.format(parameter)
+                    if label in columns:
+                        conditions.append('c{} = ?'.format(
+                            columns.index(label)))
+                        parameters.append(value)
+                where = ' AND ({})'.format(' OR '.join(conditions)) \
+                    if conditions else ' AND 0'
+            sample = 'c{}'.format(columns.index('Sample Name'))
+            links = []
+            for label in _DATA_NODE_LABELS:
+                for position in [i for i, c in enumerate(columns)
+                                 if c == label]:
+                    links.extend(self.db.execute(
+                        "SELECT {0}, c{1} FROM {2} WHERE c{1} NOT IN "
+                        "('', 'nan'){3} ORDER BY rowid".format(
+                            sample, position, name, where), parameters))
+            if distinct:
+                links = list(collections.OrderedDict.fromkeys(links))
+            table_index = collections.OrderedDict()
+            for sample_name, data_file in links:
+                table_index.setdefault(sample_name, []).append(data_file)
+            for sample_name, data_files in table_index.items():
+                index.setdefault(sample_name, []).extend(data_files)
+        self._data_files_indexes[key] = index
+        return index
+
+    @_timed('filtering')
+    def assay_samples(self, study_file, assay_files):
+        study_name, study_columns = self.sql_table(study_file)
+        assay_samples = []
+        for assay_file in assay_files:
+            name, columns = self.sql_table(assay_file)
+            sample = 'c{}'.format(columns.index('Sample Name'))
+            rows = self.db.execute(
+                'SELECT {0} FROM {1} WHERE {0} IN (SELECT c{2} FROM {3}) '
+                'ORDER BY rowid'.format(
+                    sample, name, study_columns.index('Sample Name'),
+                    study_name))
+            assay_samples.extend(collections.OrderedDict.fromkeys(
+                sample_name for sample_name, in rows))
+        return assay_samples
+
+    @_timed('filtering')
+    def select_samples(self, study_file, assay_samples, factor_selection=None,
+                       characteristics_selection=None):
+        """Same selection as the module-level select_samples, each sample
+        being reduced over its rows by a GROUP BY"""
+        if not factor_selection and not characteristics_selection:
+            return list(assay_samples)
+        name, columns = self.sql_table(study_file)
+        sample = 'c{}'.format(columns.index('Sample Name'))
+        aggregates, parameters = [], []
+
+        def aggregate(matches, mismatches):
+            match = ' OR '.join(matches) or '0'
+            mismatch = ' OR '.join(mismatches) or '0'
+            aggregates.append('MAX(COALESCE({}, 0)) AND NOT MAX(COALESCE('
+                              '{}, 1))'.format(match, mismatch))
+
+        if factor_selection:
+            matches, mismatches, match_values, mismatch_values = [], [], [], []
+            for factor_name, factor_value in factor_selection.items():
+                label = 'Factor Value[{}]'.format(factor_name)
+                for position in [i for i, c in enumerate(columns)
+                                 if c == label]:
+                    column = self._comparable(columns, position)
+                    matches.append('{} = ?'.format(column))
+                    mismatches.append('COALESCE({} != ?, 1)'.format(column))
+                    match_values.append(factor_value)
+                    mismatch_values.append(factor_value)
+            aggregate(matches, mismatches)
+            parameters.extend(match_values + mismatch_values)
+
+        if characteristics_selection:
+            nodes = ['Sample Name']
+            if 'Source Name' in columns:
+                nodes.append('Source Name')
+            matches, mismatches, match_values, mismatch_values = [], [], [], []
+            for i, (category, value) in enumerate(
+                    characteristics_selection.items()):
+                for node_label in nodes:
+                    characteristics = _node_characteristics(
+                        columns, node_label)
+                    if category not in characteristics:
+                        continue
+                    # a node takes its characteristics from its first row
+                    node = 'c{}'.format(columns.index(node_label))
+                    first_value = (
+                        '(SELECT f.{0} FROM {1} f WHERE f.{2} = {1}.{2} '
+                        'ORDER BY f.rowid LIMIT 1)'.format(
+                            self._comparable(
+                                columns, characteristics[category]),
+                            name, node))
+                    if i == 0:
+                        matches.append('{} = ?'.format(first_value))
+                        match_values.append(value)
+                    else:
+                        mismatches.append('COALESCE({} != ?, 1)'.format(
+                            first_value))
+                        mismatch_values.append(value)
+            aggregate(matches, mismatches)
+            parameters.extend(match_values + mismatch_values)
+
+        selected = {
+            sample_name for sample_name, in self.db.execute(
+                'SELECT {} FROM {} GROUP BY {} HAVING {}'.format(
+                    sample, name, sample, ' AND '.join(aggregates)),
+                parameters)}
+        return [sample_name for sample_name
+                in collections.OrderedDict.fromkeys(assay_samples)
+                if sample_name in selected]
+
+
+def open_study(input_path):
+    """Open an unpacked ISA-Tab study or a study index, through the
+    isaslicer server or the SQLite engine if one was configured"""
+    if is_study_index(input_path):
+        return IndexedStudy(input_path)
+    if server_address:
+        return RemoteStudy(server_address, input_path)
+    return _open_local_study(input_path)
+
+
+def _open_local_study(input_path):
+    if sqlite_db:
+        return SQLiteStudy(input_path, sqlite_db)
+    return LoadedStudy(input_path)
+
+
+# isaslicer server
+
+_SERVED_METHODS = frozenset([
+    'factor_names', 'factor_values', 'slice_data_files', 'query',
+    'variables_summary'])
+
+
+def _server_socket(address):
+    if address.isdigit():
+        return socket.AF_INET, ('127.0.0.1', int(address))
+    return socket.AF_UNIX, address
+
+
+class RemoteStudy(object):
+    """Proxy to a LoadedStudy kept in memory by an isaslicer server.
+
+    Calling any of the served methods sends the call over a single
+    connection and returns the decoded result. If the server cannot be
+    reached, the study is opened in process once, and that local study
+    answers this and all later calls.
+    """
+
+    def __init__(self, address, input_path):
+        self.address = address
+        self.input_path = os.path.abspath(input_path)
+        self._local = None
+
+    @_timed('server')
+    def _call(self, method, *args):
+        if self._local is not None:
+            return getattr(self._local, method)(*args)
+        request = {'input_path': self.input_path, 'method': method,
+                   'args': list(args)}
+        family, address = _server_socket(self.address)
+        try:
+            with socket.socket(family, socket.SOCK_STREAM) as sock:
+                sock.connect(address)
+                with sock.makefile('rw', encoding='utf-8') as fp:
+                    fp.write(json.dumps(request) + '\n')
+                    fp.flush()
+                    response = json.loads(fp.readline())
+        except (OSError, ValueError) as e:
+            logger.warning("Could not reach isaslicer server at %s (%s), "
+                           "loading study locally", self.address, e)
+            self._local = _open_local_study(self.input_path)
+            return getattr(self._local, method)(*args)
+        if 'error' in response:
+            raise RuntimeError("isaslicer server error: {}".format(
+                response['error']))
+        return response['result']
+
+    def iter_data_files(self, factor_selection=None):
+        return iter(self.slice_data_files(factor_selection))
+
+    def __getattr__(self, method):
+        if method not in _SERVED_METHODS:
+            raise AttributeError(method)
+        return functools.partial(self._call, method)
+
+
+class StudyServer(object):
+    """Answers RemoteStudy calls from an LRU of resident LoadedStudy
+    objects.
+
+    A study is reloaded whenever the size or mtime of one of its
+    investigation, study or assay files changes.
+    """
+
+    def __init__(self, max_studies):
+        self.max_studies = max_studies
+        self.studies = collections.OrderedDict()
+
+    @staticmethod
+    def signature(input_path):
+        signature = []
+        for table_file in sorted(list_tables(input_path, '[i|s|a]_*')):
+            st = os.stat(table_file)
+            signature.append((table_file, st.st_size, st.st_mtime_ns))
+        return signature
+
+    def study(self, input_path):
+        signature = self.signature(input_path)
+        entry = self.studies.pop(input_path, None)
+        if entry is None or entry[0] != signature:
+            logger.info("Loading study %s", input_path)
+            entry = (signature, LoadedStudy(input_path))
+        self.studies[input_path] = entry
+        while len(self.studies) > self.max_studies:
+            evicted, _ = self.studies.popitem(last=False)
+            logger.info("Evicting study %s", evicted)
+        return entry[1]
+
+    def handle(self, request):
+        try:
+            if request['method'] not in _SERVED_METHODS:
+                raise ValueError("Unknown method {}".format(
+                    request['method']))
+            study = self.study(request['input_path'])
+            result = getattr(study, request['method'])(*request['args'])
+        except Exception as e:
+            logger.exception(e)
+            return {'error': str(e)}
+        return {'result': result}
+
+
+def serve_command(options):
+    server = StudyServer(options.max_studies)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            response = server.handle(request)
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+    family, address = _server_socket(options.address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(address):
+            os.remove(address)
+        listener = socketserver.UnixStreamServer(address, Handler)
     else:
-        final_fv_samples = assay_samples
+        socketserver.TCPServer.allow_reuse_address = True
+        listener = socketserver.TCPServer(address, Handler)
+    logger.info("isaslicer server listening on %s", options.address)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    with listener:
+        try:
+            listener.serve_forever()
+        except KeyboardInterrupt:
+            logger.info("isaslicer server stopped")
+        finally:
+            if family == socket.AF_UNIX and os.path.exists(address):
+                os.remove(address)
+
+
+_INVESTIGATION_ASSAY_FIELDS = {
+    'Study Assay File Name': 'assay_file',
+    'Study Assay Measurement Type': 'measurement_type',
+    'Study Assay Technology Type': 'technology_type',
+}
 
-    # filter samples by characteristic
-    characteristics_selection = {
-        x.get('characteristic_name').strip():
-            x.get('characteristic_value').strip() for x in
-            query.get('characteristics_selection', [])}
 
-    cv_samples = set()
+@_timed('parsing')
+def read_investigation_assays(input_path, zfp=None):
+    """List the assays declared in the investigation file.
+
+    :return: A list of dicts giving, for each assay, its ``study_file``,
+    ``assay_file``, ``measurement_type`` and ``technology_type``
+    """
+    assays = []
+    i_files = list_tables(input_path, 'i_*.txt', zfp=zfp)
+    if len(i_files) != 1:
+        raise IOError('Expected a single investigation file in {}, found '
+                      '{}'.format(input_path, len(i_files)))
+
+    def flush(study_file, fields):
+        assay_files = fields.get('assay_file', [])
+        for i, assay_file in enumerate(assay_files):
+            if not assay_file:
+                continue
+            assay = {'study_file': study_file, 'assay_file': assay_file}
+            for key in ('measurement_type', 'technology_type'):
+                values = fields.get(key, [])
+                assay[key] = values[i] if i < len(values) else ''
+            assays.append(assay)
+
+    study_file, fields = None, {}
+    with _open_table(next(iter(i_files)), zfp=zfp) as fp:
+        for row in csv.reader(fp, delimiter='\t'):
+            if not row:
+                continue
+            label = row[0].strip()
+            if label == 'STUDY':
+                flush(study_file, fields)
+                study_file, fields = None, {}
+            elif label == 'Study File Name':
+                study_file = row[1] if len(row) > 1 else None
+            elif label in _INVESTIGATION_ASSAY_FIELDS:
+                fields[_INVESTIGATION_ASSAY_FIELDS[label]] = row[1:]
+    flush(study_file, fields)
+    return assays
+
+
+def _is_node_column(label):
+    return label.endswith(' Name') or label.startswith('Protocol REF') \
+        or label in _DATA_NODE_LABELS
+
+
+def _node_characteristics(columns, node_label):
+    """Map the characteristic categories qualifying the first node called
+    ``node_label`` to the position of their first column"""
+    characteristics = {}
+    start = columns.index(node_label)
+    for position in range(start + 1, len(columns)):
+        label = columns[position]
+        if _is_node_column(label):
+            break
+        if label.startswith('Characteristics['):
+            characteristics.setdefault(label[16:-1], position)
+    return characteristics
+
+
+def _is_unit_qualified(columns, position):
+    qualifiers = columns[position + 1:position + 4]
+    return len(qualifiers) == 3 and qualifiers[0].startswith('Unit') \
+        and qualifiers[1].startswith('Term Source REF') \
+        and qualifiers[2].startswith('Term Accession Number')
+
+
+def _comparable_values(df, position):
+    """Values of a column, as compared by the ISA object model.
+
+    Values qualified by a unit are parsed as numbers by isatools, so that
+    they never compare equal to a string selection; they are masked out.
+    """
+    import pandas as pd
+    values = df.iloc[:, position].fillna('')
+    if _is_unit_qualified(list(df.columns), position):
+        numeric = pd.to_numeric(values, errors='coerce').notna()
+        values = values.where(~numeric, None)
+    return values
+
+
+def _to_number(value):
+    # as isatools.isatab.utils.convert_to_number
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+
+
+def _typed_values(df, position):
+    """Values of a column, typed as in the ISA object model: values
+    qualified by a unit are numbers, any other value is a string."""
+    values = df.iloc[:, position].fillna('')
+    if _is_unit_qualified(list(df.columns), position):
+        values = values.map(
+            lambda value: _to_number(value) if value else '').astype(object)
+    return values
+
+
+@_timed('filtering')
+def select_samples(study_df, assay_samples, factor_selection=None,
+                   characteristics_selection=None):
+    """Select the assay samples matching factor values and characteristics.
+
+    Each selection is evaluated as a boolean mask over the study table rows,
+    then reduced per sample. A sample matches a factor selection if one of
+    its selected factors has the selected value and none has another value.
+    It matches a characteristics selection if its own or its source's first
+    selected characteristic has the selected value, and none of the others
+    has another value.
+
+    :param study_df: The study table DataFrame
+    :param assay_samples: Sample names in the matching assays, in order
+    :param factor_selection: A dict of factor names to factor values
+    :param characteristics_selection: A dict of characteristic categories
+    to characteristic values
+    :return: The list of matching sample names
+    """
+    import pandas as pd
+    if not factor_selection and not characteristics_selection:
+        return list(assay_samples)
+
+    columns = list(study_df.columns)
+    sample_names = study_df['Sample Name']
+    candidates = pd.Series(True, index=pd.unique(pd.Series(assay_samples)))
+
+    def per_sample(mask):
+        return mask.groupby(sample_names, sort=False).any().reindex(
+            candidates.index, fill_value=False)
+
+    if factor_selection:
+        matching = pd.Series(False, index=study_df.index)
+        mismatching = pd.Series(False, index=study_df.index)
+        for factor_name, factor_value in factor_selection.items():
+            label = 'Factor Value[{}]'.format(factor_name)
+            for position in [i for i, c in enumerate(columns) if c == label]:
+                equal = _comparable_values(study_df, position) == factor_value
+                matching |= equal
+                mismatching |= ~equal
+        candidates &= per_sample(matching) & ~per_sample(mismatching)
+
     if characteristics_selection:
-        first_pass = True
-        samples_to_remove = set()
-        for c, v in characteristics_selection.items():
-            if first_pass:
-                for sample in final_fv_samples:
-                    for cv in [x for x in sample.characteristics if
-                               x.category.term == c]:
-                        if isinstance(cv.value, OntologyAnnotation):
-                            if cv.value.term == v:
-                                cv_samples.add(sample)
-                        elif cv.value == v:
-                            cv_samples.add(sample)
-                    for source in sample.derives_from:
-                        for cv in [x for x in source.characteristics if
-                                   x.category.term == c]:
-                            if isinstance(cv.value, OntologyAnnotation):
-                                if cv.value.term == v:
-                                    cv_samples.add(sample)
-                            elif cv.value == v:
-                                cv_samples.add(sample)
-                first_pass = False
+        # samples and their sources, each with its characteristics columns
+        nodes = [study_df['Sample Name']]
+        if 'Source Name' in columns:
+            nodes.append(study_df['Source Name'])
+        matching = pd.Series(False, index=study_df.index)
+        mismatching = pd.Series(False, index=study_df.index)
+        for i, (category, value) in enumerate(
+                characteristics_selection.items()):
+            for names in nodes:
+                characteristics = _node_characteristics(columns, names.name)
+                if category not in characteristics:
+                    continue
+                # a node takes its characteristics from its first row
+                first_rows = ~names.duplicated()
+                values = _comparable_values(
+                    study_df, characteristics[category])[first_rows]
+                values.index = names[first_rows]
+                equal = names.map(values == value).astype(bool)
+                if i == 0:
+                    matching |= equal
+                else:
+                    mismatching |= ~equal
+        candidates &= per_sample(matching) & ~per_sample(mismatching)
+
+    return list(candidates.index[candidates])
+
+
+# MetaboLights downloads
+
+_MTBLS_URL = 'ftp://ftp.ebi.ac.uk/pub/databases/metabolights/studies/public'
+
+_RX_STUDY_ID = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+_RX_HREF = re.compile(r'href="([^"?#/]+)"')
+
+_DOWNLOAD_ATTEMPTS = 3
+
+_PARTIAL_MAX_AGE = 7 * 86400
+
+# algorithms of the checksums announced by servers, as hashlib names
+_CHECKSUM_ALGORITHMS = {'md5': 'md5', 'sha': 'sha1', 'sha1': 'sha1',
+                        'sha256': 'sha256', 'sha512': 'sha512'}
+
+RemoteFile = collections.namedtuple(
+    'RemoteFile', ['size', 'revision', 'checksum'])
+
+
+def _is_metadata_file(name):
+    return fnmatch.fnmatch(name, '[isa]_*.txt')
+
+
+def _check_study_id(study_id):
+    if not _RX_STUDY_ID.match(study_id):
+        raise ValueError("Invalid study identifier {!r}".format(study_id))
+
+
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _http_checksum(headers):
+    """The checksum announced in the Repr-Digest, Digest or Content-MD5
+    HTTP headers of a file, as an (algorithm, hex digest) pair"""
+    import base64
+    values = [headers.get('Repr-Digest'), headers.get('Digest')]
+    if headers.get('Content-MD5'):
+        values.append('md5=' + headers['Content-MD5'])
+    for value in values:
+        for item in (value or '').split(','):
+            algorithm, _, digest = item.strip().partition('=')
+            algorithm = _CHECKSUM_ALGORITHMS.get(
+                algorithm.lower().replace('-', ''))
+            if algorithm is not None:
+                try:
+                    return algorithm, base64.b64decode(digest.strip(':')).hex()
+                except ValueError:
+                    pass
+    return None
+
+
+def _file_checksum(path, algorithm):
+    checksum = hashlib.new(algorithm)
+    with open(path, 'rb') as fp:
+        for chunk in iter(functools.partial(fp.read, 1 << 20), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+class MetaboLightsRemote(object):
+    """Lists and downloads the ISA-Tab metadata files of MetaboLights
+    studies, found in the directories named after their identifiers
+    under an ftp://, http(s):// or file:// base URL.
+
+    Files are downloaded by a pool of ``jobs`` threads, each reusing its
+    own FTP or HTTP connection, shared by the studies fetched at once from
+    several threads. A file is written to a ``.part`` file
+    first, an interrupted transfer resuming from it, and its size and the
+    checksum the server announces, if any, are checked once complete.
+    """
+
+    def __init__(self, url, jobs=1):
+        self.url = url.rstrip('/')
+        self.parts = urllib.parse.urlsplit(self.url)
+        self.jobs = jobs
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _study_url(self, study_id, name=''):
+        _check_study_id(study_id)
+        return '{}/{}/{}'.format(self.url, study_id, urllib.parse.quote(name))
+
+    def _study_path(self, study_id, name=''):
+        _check_study_id(study_id)
+        return '{}/{}/{}'.format(
+            urllib.parse.unquote(self.parts.path), study_id, name)
+
+    def _connection(self):
+        """The connection of the current thread to the server, opened on
+        first use"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            return connection
+        if self.parts.scheme == 'ftp':
+            import ftplib
+            logger.info("Connecting to %s", self.parts.hostname)
+            connection = ftplib.FTP()
+            connection.connect(self.parts.hostname, self.parts.port or 21)
+            connection.login(self.parts.username or 'anonymous',
+                             self.parts.password or '')
+            try:
+                connection.features = connection.sendcmd('FEAT').upper()
+            except ftplib.Error:
+                connection.features = ''
+        else:
+            import http.client
+            connection = (http.client.HTTPSConnection
+                          if self.parts.scheme == 'https'
+                          else http.client.HTTPConnection)(
+                self.parts.hostname, self.parts.port)
+        self._local.connection = connection
+        with self._lock:
+            self._connections.append(connection)
+        return connection
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=max(1, self.jobs))
+            return self._executor
+
+    def _drop_connection(self):
+        """Close the connection of the current thread, after an error left
+        it in an unknown state"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            self._local.connection = None
+            connection.close()
+
+    def _http_request(self, method, path, headers=None):
+        connection = self._connection()
+        connection.request(method, urllib.parse.quote(path),
+                           headers=headers or {})
+        response = connection.getresponse()
+        if response.status >= 300 and response.status != 416:
+            response.read()
+            error = FileNotFoundError if response.status == 404 else IOError
+            raise error("{} {} returned {} {}".format(
+                method, path, response.status, response.reason))
+        return response
+
+    def _ftp_checksum(self, ftp, name):
+        """The checksum of a file from the HASH command of the FTP server,
+        if it supports it"""
+        import ftplib
+        if 'HASH' not in ftp.features:
+            return None
+        try:
+            # 213 <algorithm> <range> <hex digest> <file name>
+            fields = ftp.sendcmd('HASH ' + name).split(None, 4)
+        except ftplib.Error:
+            return None
+        algorithm = _CHECKSUM_ALGORITHMS.get(
+            fields[1].lower().replace('-', '')) if len(fields) > 3 else None
+        return (algorithm, fields[3].lower()) if algorithm else None
+
+    @_timed('download')
+    def list_files(self, study_id):
+        """The metadata files of a study, mapped to their RemoteFile: their
+        size, a revision string that changes whenever the file does (its
+        size and modification time, or its HTTP validators) and the
+        checksum announced by the server, if any"""
+        _check_study_id(study_id)
+        files = collections.OrderedDict()
+        if self.parts.scheme == 'file':
+            study_dir = self._study_path(study_id)
+            if not os.path.isdir(study_dir):
+                raise IOError("Study {} not found at {}".format(
+                    study_id, self.url))
+            for name in sorted(os.listdir(study_dir)):
+                if _is_metadata_file(name):
+                    st = os.stat(os.path.join(study_dir, name))
+                    files[name] = RemoteFile(st.st_size, '{}:{}'.format(
+                        st.st_size, st.st_mtime_ns), None)
+        elif self.parts.scheme == 'ftp':
+            import ftplib
+            ftp = self._connection()
+            try:
+                ftp.cwd(self._study_path(study_id))
+            except ftplib.error_perm:
+                raise IOError("Study {} not found at {}".format(
+                    study_id, self.url))
+            try:
+                for name, facts in sorted(ftp.mlsd(facts=['size', 'modify'])):
+                    if _is_metadata_file(name):
+                        files[name] = RemoteFile(
+                            _int_or_none(facts.get('size')), '{}:{}'.format(
+                                facts.get('size'), facts.get('modify')),
+                            self._ftp_checksum(ftp, name))
+            except ftplib.error_perm:  # no MLSD support
+                for name in sorted(ftp.nlst()):
+                    if _is_metadata_file(name):
+                        size = ftp.size(name)
+                        files[name] = RemoteFile(size, '{}:{}'.format(
+                            size, ftp.sendcmd('MDTM ' + name)),
+                            self._ftp_checksum(ftp, name))
+        elif self.parts.scheme in ('http', 'https'):
+            try:
+                index = self._http_request(
+                    'GET', self._study_path(study_id))
+            except FileNotFoundError:
+                raise IOError("Study {} not found at {}".format(
+                    study_id, self.url))
+            names = sorted(set(
+                urllib.parse.unquote(name) for name in _RX_HREF.findall(
+                    index.read().decode('utf-8', 'replace'))))
+            for name in names:
+                if not _is_metadata_file(name):
+                    continue
+                response = self._http_request(
+                    'HEAD', self._study_path(study_id, name))
+                response.read()
+                files[name] = RemoteFile(
+                    _int_or_none(response.headers.get('Content-Length')),
+                    '{}:{}:{}'.format(
+                        response.headers.get('Content-Length'),
+                        response.headers.get('Last-Modified'),
+                        response.headers.get('ETag')),
+                    _http_checksum(response.headers))
+        else:
+            raise ValueError("Unsupported MetaboLights URL {}".format(
+                self.url))
+        if not any(name.startswith('i_') for name in files):
+            raise IOError("Could not find an investigation file for study "
+                          "{}".format(study_id))
+        return files
+
+    def _transfer(self, study_id, name, fp, offset):
+        """Append a file of a study to fp from offset on"""
+        path = self._study_path(study_id, name)
+        if self.parts.scheme == 'file':
+            with open(path, 'rb') as src:
+                src.seek(offset)
+                shutil.copyfileobj(src, fp, 1 << 20)
+        elif self.parts.scheme == 'ftp':
+            self._connection().retrbinary(
+                'RETR ' + path, fp.write, rest=offset or None)
+        else:
+            response = self._http_request('GET', path, {
+                'Range': 'bytes={}-'.format(offset)} if offset else {})
+            if response.status == 416:  # complete already
+                response.read()
+                return
+            if response.status != 206 and offset:
+                fp.truncate(0)  # ranges unsupported, start over
+            shutil.copyfileobj(response, fp, 1 << 20)
+            if response.length:
+                raise EOFError("Connection closed before the end of "
+                               "{}".format(name))
+
+    def download(self, study_id, name, path, remote_file=None):
+        """Download a file of a study to path, through ``path.part``: an
+        interrupted transfer is resumed from it, by the next attempt or by
+        a later call.
+
+        :param remote_file: The RemoteFile of the file, to check its size
+                            and checksum against
+        :return: The number of bytes transferred
+        """
+        import ftplib
+        import http.client
+        part_path = path + '.part'
+        start = time.perf_counter()
+        initial_size = size = (os.path.getsize(part_path)
+                               if os.path.exists(part_path) else 0)
+        if remote_file is not None and remote_file.size is not None and \
+                size > remote_file.size:
+            initial_size = size = 0
+        for attempt in range(1, _DOWNLOAD_ATTEMPTS + 1):
+            if size:
+                logger.info("Resuming %s at byte %d",
+                            self._study_url(study_id, name), size)
             else:
-                for sample in cv_samples:
-                    for cv in [x for x in sample.characteristics if
-                               x.category.term == c]:
-                        if isinstance(cv.value, OntologyAnnotation):
-                            if cv.value.term != v:
-                                samples_to_remove.add(sample)
-                        elif cv.value != v:
-                            samples_to_remove.add(sample)
-                    for source in sample.derives_from:
-                        for cv in [x for x in source.characteristics if
-                                   x.category.term == c]:
-                            if isinstance(cv.value, OntologyAnnotation):
-                                if cv.value.term != v:
-                                    samples_to_remove.add(sample)
-                            elif cv.value != v:
-                                samples_to_remove.add(sample)
-        final_cv_samples = cv_samples.difference(samples_to_remove)
-    else:
-        final_cv_samples = final_fv_samples
+                logger.info("Retrieving %s", self._study_url(study_id, name))
+            try:
+                with open(part_path, 'ab') as fp:
+                    fp.truncate(size)
+                    self._transfer(study_id, name, fp, size)
+                break
+            except FileNotFoundError:
+                raise
+            except (OSError, EOFError, http.client.HTTPException,
+                    ftplib.error_temp, ftplib.error_reply,
+                    ftplib.error_proto) as e:
+                self._drop_connection()
+                if attempt == _DOWNLOAD_ATTEMPTS:
+                    raise IOError("Could not download {}: {}".format(
+                        self._study_url(study_id, name), e))
+                logger.warning("Download of %s interrupted: %s", name, e)
+                size = os.path.getsize(part_path)
+        self._verify(part_path, name, remote_file)
+        os.replace(part_path, path)
+        transferred = os.path.getsize(path) - initial_size
+        elapsed = time.perf_counter() - start
+        logger.info("Retrieved %s: %d bytes in %.2f s (%.1f MB/s)", name,
+                    transferred, elapsed,
+                    transferred / 1e6 / max(elapsed, 1e-6))
+        return transferred
+
+    def _verify(self, path, name, remote_file):
+        size = os.path.getsize(path)
+        if remote_file is not None and remote_file.size is not None and \
+                size != remote_file.size:
+            raise IOError("Downloaded {} has {} bytes instead of {}".format(
+                name, size, remote_file.size))
+        algorithm, expected = (remote_file and remote_file.checksum or
+                               ('sha256', None))
+        if expected is None and not logger.isEnabledFor(logging.DEBUG):
+            return
+        checksum = _file_checksum(path, algorithm)
+        if expected is not None and checksum != expected:
+            os.remove(path)  # not to be resumed
+            raise IOError("Downloaded {} has {} checksum {} instead of "
+                          "{}".format(name, algorithm, checksum, expected))
+        logger.debug("%s checksum of %s: %s%s", algorithm, name, checksum,
+                     ", verified" if expected else "")
+
+    @_timed('download')
+    def fetch(self, study_id, target_dir, files=None, on_file=None):
+        """Download the investigation file of a study to target_dir, then
+        the study and assay tables it declares, as isatools does. Files
+        already in target_dir, from an interrupted fetch, are kept.
+
+        :param files: The result of list_files, if already known
+        :param on_file: Function called with the name and path of every
+                        file of the study once it is in target_dir, in the
+                        calling thread while the next ones download
+        """
+        if files is None:
+            files = self.list_files(study_id)
+        start = time.perf_counter()
+        i_file = next(name for name in files if name.startswith('i_'))
+        names = [i_file]
+        downloaded = transferred = 0
+        if not os.path.exists(os.path.join(target_dir, i_file)):
+            transferred += self.download(
+                study_id, i_file, os.path.join(target_dir, i_file),
+                files[i_file])
+            downloaded += 1
+        if on_file is not None:
+            on_file(i_file, os.path.join(target_dir, i_file))
+        with open(os.path.join(target_dir, i_file), encoding='utf-8') as fp:
+            for row in csv.reader(fp, delimiter='\t'):
+                if row and row[0].strip() in ('Study File Name',
+                                              'Study Assay File Name'):
+                    for name in row[1:]:
+                        name = name.strip()
+                        if not name or '/' in name or name in names:
+                            continue
+                        if name not in files:
+                            raise IOError("Study {} declares {}, which is "
+                                          "not in {}".format(
+                                              study_id, name, self.url))
+                        names.append(name)
+        missing = []
+        for name in names[1:]:
+            if not os.path.exists(os.path.join(target_dir, name)):
+                missing.append(name)
+            elif on_file is not None:
+                on_file(name, os.path.join(target_dir, name))
+        executor = self._pool()
+        futures = {executor.submit(
+            self.download, study_id, name, os.path.join(target_dir, name),
+            files[name]): name for name in missing}
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                transferred += future.result()
+                if on_file is not None:
+                    on_file(futures[future],
+                            os.path.join(target_dir, futures[future]))
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            concurrent.futures.wait(futures)
+            raise
+        downloaded += len(missing)
+        elapsed = time.perf_counter() - start
+        logger.info("Downloaded %d of the %d files of study %s: %.1f MB in "
+                    "%.2f s (%.1f MB/s)", downloaded, len(names), study_id,
+                    transferred / 1e6, elapsed,
+                    transferred / 1e6 / max(elapsed, 1e-6))
+        return target_dir
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        for connection in self._connections:
+            try:
+                if self.parts.scheme == 'ftp':
+                    connection.quit()
+            except Exception:
+                pass
+            connection.close()
+        self._connections = []
+
+
+class StudyCache(object):
+    """On-disk LRU cache of downloaded MetaboLights studies.
+
+    A study is stored in a directory named after the SHA-256 digest of its
+    identifier and of the remote revision of its metadata files, so that a
+    study updated on the server is downloaded again while an unchanged one
+    never is. The revision last seen for a study is trusted for ``ttl``
+    seconds without contacting the server. Entries are published with an
+    atomic rename and their mtime is bumped on every hit, the least recently
+    used entries being evicted once the cache grows over ``max_size``
+    bytes.
+    """
 
-    # filter samples by process parameter
-    parameters_selection = {
-        x.get('parameter_name').strip():
-            x.get('parameter_value').strip() for x in
-        query.get('parameter_selection', [])}
+    _REFS = 'refs'
 
-    final_samples = final_cv_samples
+    def __init__(self, cache_dir, max_size, ttl):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.ttl = ttl
+        os.makedirs(os.path.join(cache_dir, self._REFS), exist_ok=True)
 
-    if debug:
-        print('Final number of samples: {}'.format(len(final_samples)))
-    results = []
-    for sample in final_samples:
-        results.append({
-            'sample_name': sample.name,
-            'data_files': []
-        })
-    for result in results:
-        sample_name = result['sample_name']
-        if source_dir:
-            table_files = glob.iglob(os.path.join(source_dir, 'a_*'))
+    @staticmethod
+    def digest(study_id, files):
+        return hashlib.sha256(json.dumps([study_id, [
+            (name, remote_file.revision)
+            for name, remote_file in files.items()]]).encode(
+                'utf-8')).hexdigest()
+
+    def _ref_path(self, study_id):
+        return os.path.join(self.cache_dir, self._REFS, study_id + '.json')
+
+    def _read_ref(self, study_id):
+        try:
+            with open(self._ref_path(study_id)) as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+    def _write_ref(self, study_id, digest):
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.join(self.cache_dir, self._REFS), suffix='.tmp')
+        with os.fdopen(fd, 'w') as fp:
+            json.dump({'digest': digest, 'checked': time.time()}, fp)
+        os.replace(tmp_path, self._ref_path(study_id))
+
+    def _hit(self, entry):
+        try:
+            os.utime(entry)
+        except OSError:
+            return False  # evicted by a concurrent job in the meantime
+        return True
+
+    def get(self, remote, study_id, on_file=None):
+        """The path of the cached copy of a study, downloaded if missing.
+
+        :param on_file: Passed to MetaboLightsRemote.fetch when the study
+                        is downloaded
+        """
+        _check_study_id(study_id)
+        ref = self._read_ref(study_id)
+        if ref is not None and time.time() - ref['checked'] < self.ttl:
+            entry = os.path.join(self.cache_dir, ref['digest'])
+            if self._hit(entry):
+                logger.info("Study cache hit for %s", study_id)
+                return entry
+        files = remote.list_files(study_id)
+        digest = self.digest(study_id, files)
+        entry = os.path.join(self.cache_dir, digest)
+        if self._hit(entry):
+            logger.info("Study cache hit for %s, revalidated", study_id)
         else:
-            table_files = glob.iglob(os.path.join(tmp, 'a_*'))
-        for table_file in table_files:
-            with open(table_file) as fp:
-                df = isatab.load_table(fp)
-                data_files = []
-                table_headers = list(df.columns.values)
-                sample_rows = df.loc[df['Sample Name'] == sample_name]
-                data_node_labels = [
-                    'Raw Data File', 'Raw Spectral Data File',
-                    'Derived Spectral Data File',
-                    'Derived Array Data File', 'Array Data File',
-                    'Protein Assignment File', 'Peptide Assignment File',
-                    'Post Translational Modification Assignment File',
-                    'Acquisition Parameter Data File',
-                    'Free Induction Decay Data File',
-                    'Derived Array Data Matrix File', 'Image File',
-                    'Derived Data File', 'Metabolite Assignment File']
-                if parameters_selection:
-                    for p, v in parameters_selection.items():
-                        sample_pv_rows = sample_rows.loc[
-                            sample_rows['Parameter Value[{}]'.format(p)] == v]
-                        for node_label in data_node_labels:
-                            if node_label in table_headers:
-                                data_files.extend(
-                                    list(sample_pv_rows[node_label]))
-                    result['data_files'].extend(list(set(
-                        i for i in list(data_files) if
-                        str(i) not in ('nan', ''))))
-                else:
-                    for node_label in data_node_labels:
-                        if node_label in table_headers:
-                            data_files.extend(list(sample_rows[node_label]))
-                    result['data_files'].extend(
-                        list(set(i for i in list(data_files) if
-                                 str(i) not in ('nan', ''))))
-    results_json = {
-        'query': query,
-        'results': results
-    }
-    json.dump(results_json, output, indent=4)
+            logger.info("Study cache miss for %s", study_id)
+            self._download(remote, study_id, files, entry, on_file)
+        self._write_ref(study_id, digest)
+        self._evict(keep=digest)
+        return entry
+
+    def _download(self, remote, study_id, files, entry, on_file=None):
+        """Download a study into entry through the partial directory
+        ``entry.part``, which a concurrent job downloading the same
+        revision holds locked, and where an interrupted job leaves the
+        files it got to be resumed."""
+        import fcntl
+        part_dir = entry + '.part'
+        while True:
+            os.makedirs(part_dir, exist_ok=True)
+            fd = os.open(part_dir, os.O_RDONLY)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                if os.path.isdir(entry):
+                    return  # published by a concurrent job in the meantime
+                try:
+                    current = os.stat(part_dir).st_ino == os.fstat(fd).st_ino
+                except FileNotFoundError:
+                    current = False
+                if current:  # else removed while we waited for the lock
+                    remote.fetch(study_id, part_dir, files, on_file)
+                    os.rename(part_dir, entry)
+                    return
+            finally:
+                os.close(fd)
+
+    def _remove_partial(self, path):
+        """Remove a partial download, once its study is published or after
+        it was abandoned for ``_PARTIAL_MAX_AGE`` seconds, unless a job is
+        still downloading into it"""
+        import fcntl
+        try:
+            if not os.path.isdir(path[:-len('.part')]) and \
+                    time.time() - os.stat(path).st_mtime < _PARTIAL_MAX_AGE:
+                return
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            logger.debug("Removing partial study download %s", path)
+            shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            pass  # locked
+        finally:
+            os.close(fd)
+
+    def _evict(self, keep):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name == self._REFS:
+                continue
+            if name.endswith('.part'):
+                self._remove_partial(path)
+                continue
+            try:
+                mtime = os.stat(path).st_mtime
+                size = sum(os.path.getsize(os.path.join(path, file_name))
+                           for file_name in os.listdir(path))
+            except OSError:
+                continue
+            entries.append((mtime, size, name))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if name == keep:
+                continue
+            logger.debug("Evicting study cache entry %s", name)
+            shutil.rmtree(os.path.join(self.cache_dir, name),
+                          ignore_errors=True)
+            total_size -= size
+
+
+@contextlib.contextmanager
+def mtbls_study(study_id, on_file=None, remote=None):
+    """Provide a directory holding the ISA-Tab metadata of a MetaboLights
+    study: its copy in the study cache, to be left untouched, or else a
+    temporary download removed on exit.
+
+    :param on_file: Passed to MetaboLightsRemote.fetch when the study is
+                    downloaded, not when it is found in the cache
+    :param remote: MetaboLightsRemote to download through, left open, else
+                   one is opened for the study
+    """
+    owned = remote is None
+    if owned:
+        remote = MetaboLightsRemote(mtbls_url, download_jobs)
+    try:
+        if study_cache is not None:
+            yield study_cache.get(remote, study_id, on_file)
+            return
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            yield remote.fetch(study_id, tmp_dir, on_file=on_file)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    finally:
+        if owned:
+            remote.close()
+
+
+# archives
+
+_ARCHIVE_EXTENSIONS = collections.OrderedDict([
+    ('zip', '.zip'),
+    ('tar', '.tar'),
+    ('gztar', '.tar.gz'),
+    ('bztar', '.tar.bz2'),
+    ('xztar', '.tar.xz'),
+])
+
+_COMPRESS_BLOCK_SIZE = 4 << 20
+
+
+class BlockCompressor(object):
+    """Write-only file compressing what is written to it by blocks, in a
+    pool of threads, into the concatenation of a compressed stream per
+    block, which gzip, bzip2 and xz read as a single stream."""
+
+    def __init__(self, fp, compress, jobs, block_size=_COMPRESS_BLOCK_SIZE):
+        self.fp = fp
+        self.compress = compress
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.pending = collections.deque()
+        self.max_pending = 2 * jobs
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=jobs)
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def _submit(self, block):
+        self.pending.append(self.executor.submit(self.compress, block))
+        # written in order, the compressed blocks in memory being bounded
+        while len(self.pending) > self.max_pending:
+            self.fp.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self.fp.write(self.pending.popleft().result())
+        self.executor.shutdown()
+
+
+def _tar_compressor(archive_format, level):
+    """The function compressing a block of a tar archive of the format, or
+    None for an uncompressed tar"""
+    if archive_format == 'gztar':
+        import gzip
+        return functools.partial(
+            gzip.compress, compresslevel=9 if level is None else level)
+    if archive_format == 'bztar':
+        import bz2
+        return functools.partial(
+            bz2.compress, compresslevel=9 if level is None else level)
+    if archive_format == 'xztar':
+        import lzma
+        return functools.partial(
+            lzma.compress, preset=6 if level is None else level)
+    return None
+
+
+class ArchiveWriter(object):
+    """Zip or tar archive of files added one at a time, as shutil's
+    make_archive would write them (zip members named after the files, tar
+    members prefixed with ./).
+
+    :param level: Compression level from 0 to 9, the default of the format
+                  if None. Level 0 stores zip members uncompressed.
+    :param jobs: Number of threads compressing the gztar, bztar and xztar
+                 formats, by blocks
+    """
 
-    # if galaxy_parameters['input']['collection_output']:
-    #     logger = logging.getLogger()
-    #     logger.debug("copying data files to %s", os.path.dirname(output))
-    #     for result in results:
-    #         for data_file_name in result['data_files']:
-    #             logging.info("Copying {}".format(data_file_name))
-    #             shutil.copy(os.path.join(source_dir, data_file_name),
-    #                         os.path.dirname(output))
-    #     logger.info(
-    #       "Finished writing data files to {}".format(os.path.dirname(output)))
+    def __init__(self, base_name, archive_format='zip', level=None, jobs=1):
+        import tarfile
+        if archive_format == 'bztar' and level == 0:
+            raise ValueError("bzip2 compression levels range from 1 to 9")
+        self.path = base_name + _ARCHIVE_EXTENSIONS[archive_format]
+        self.zip = self.tar = self.compressor = None
+        self.fp = open(self.path, 'wb')
+        if archive_format == 'zip':
+            self.zip = zipfile.ZipFile(
+                self.fp, 'w', zipfile.ZIP_STORED if level == 0
+                else zipfile.ZIP_DEFLATED, compresslevel=level)
+            return
+        compress = _tar_compressor(archive_format, level)
+        if compress is not None and jobs > 1:
+            self.compressor = BlockCompressor(self.fp, compress, jobs)
+            self.tar = tarfile.open(fileobj=self.compressor, mode='w|')
+        elif compress is not None:
+            kwargs = {}
+            if level is not None:
+                kwargs['preset' if archive_format == 'xztar'
+                       else 'compresslevel'] = level
+            self.tar = tarfile.open(fileobj=self.fp, mode='w:' + {
+                'gztar': 'gz', 'bztar': 'bz2', 'xztar': 'xz'}[archive_format],
+                **kwargs)
+        else:
+            self.tar = tarfile.open(fileobj=self.fp, mode='w')
 
+    @_timed('output')
+    def add(self, path, name):
+        logger.info("Adding %s to %s", name, self.path)
+        if self.zip is not None:
+            self.zip.write(path, name)
+        else:
+            self.tar.add(path, './' + name)
 
-def get_study_archive_command(options):
-    study_id = options.study_id
+    def close(self):
+        if self.zip is not None:
+            self.zip.close()
+        else:
+            self.tar.close()
+            if self.compressor is not None:
+                self.compressor.close()
+        self.fp.close()
 
-    logger.info("Downloading study %s into archive at path %s.%s",
-                study_id, options.output, options.format)
+    def __enter__(self):
+        return self
 
-    tmpdir = MTBLS.get(study_id)
-    logger.debug("MTBLS.get returned '%s'", tmpdir)
-    if tmpdir is not None:
+    def __exit__(self, exc_type, exc_value, traceback):
         try:
-            shutil.make_archive(
-                options.output, options.format, tmpdir, logger=logger)
-            logger.info("ISA archive written")
+            self.close()
         finally:
-            logger.debug("Trying to clean up tmp dir %s", tmpdir)
-            shutil.rmtree(tmpdir, ignore_errors=True)
-    else:
-        raise RuntimeError("Error downloading ISA study")
+            if exc_type is not None:
+                os.remove(self.path)
+
+
+def get_study_archive_command(options):
+    study_id = options.study_id
+
+    logger.info("Downloading study %s into archive at path %s%s",
+                study_id, options.output, _ARCHIVE_EXTENSIONS[options.format])
+
+    compress_jobs = jobs if options.compress_jobs is None \
+        else options.compress_jobs
+    with ArchiveWriter(options.output, options.format,
+                       options.compression_level,
+                       compress_jobs or os.cpu_count() or 1) as archive:
+        archived = set()
+
+        def add(name, path):
+            archive.add(path, name)
+            archived.add(name)
+
+        # files are archived as they are downloaded, or all at once when
+        # the study is in the cache
+        with mtbls_study(study_id, on_file=add) as study_dir:
+            logger.debug("Study %s fetched to '%s'", study_id, study_dir)
+            for name in sorted(os.listdir(study_dir)):
+                if name not in archived:
+                    add(name, os.path.join(study_dir, name))
+    logger.info("ISA archive written")
 
 # mtblisa commands
 
@@ -514,48 +2717,116 @@ def get_study_command(options):
             options.output))
 
     if options.isa_format == "isa-tab":
-        tmp_data = None
-        try:
-            logger.info("Downloading study %s", options.study_id)
-            tmp_data = MTBLS.get(options.study_id)
-            if tmp_data is None:
-                raise RuntimeError("Error downloading ISA study")
-
+        logger.info("Downloading study %s", options.study_id)
+        with mtbls_study(options.study_id) as study_dir:
             logger.debug(
-                "Finished downloading data. Moving to final location %s",
+                "Finished downloading data. Copying to final location %s",
                 options.output)
-            shutil.move(tmp_data, options.output)
-            logger.info("ISA archive written to %s", options.output)
-        finally:
-            if tmp_data:
-                # try to clean up any temporary files left behind
-                logger.debug("Deleting %s, if there's anything there", tmp_data)
-                shutil.rmtree(tmp_data, ignore_errors=True)
+            shutil.copytree(study_dir, options.output)
+        logger.info("ISA archive written to %s", options.output)
     elif options.isa_format == "isa-json":
-        isajson = MTBLS.getj(options.study_id)
-        if isajson is None:
-            raise RuntimeError("Error downloading ISA study")
+        logger.info("Downloading study %s", options.study_id)
+        with mtbls_study(options.study_id) as study_dir:
+            investigation = load_investigation(study_dir)
 
         logger.debug(
             "Finished downloading data. Dumping json to final location %s",
             options.output)
         os.makedirs(options.output)
         json_file = os.path.join(options.output, "{}.json".format(
-            isajson['identifier']))
+            investigation.identifier))
         with open(json_file, 'w') as fd:
-            json.dump(isajson, fd)
+            write_isa_json(investigation, fd)
         logger.info("ISA-JSON written to %s", options.output)
     else:
         raise ValueError("BUG! Got an invalid isa format '{}'".format(
             options.isa_format))
 
 
+def _get_study_into(remote, study_id, output_dir):
+    """Fetch a study into output_dir/study_id, replacing any former copy.
+
+    :return: A report of the study, with its status and the time it took
+    """
+    start = time.perf_counter()
+    report = collections.OrderedDict([
+        ('study_id', study_id), ('status', 'ok'), ('seconds', None),
+        ('files', None), ('bytes', None), ('error', None)])
+    try:
+        with mtbls_study(study_id, remote=remote) as study_dir:
+            names = sorted(os.listdir(study_dir))
+            tmp_dir = tempfile.mkdtemp(
+                dir=output_dir, prefix='.{}.'.format(study_id))
+            try:
+                for name in names:
+                    materialize_file(os.path.join(study_dir, name),
+                                     os.path.join(tmp_dir, name), 'reflink')
+                path = os.path.join(output_dir, study_id)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                os.rename(tmp_dir, path)
+            except BaseException:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                raise
+        report['files'] = len(names)
+        report['bytes'] = sum(os.path.getsize(os.path.join(path, name))
+                              for name in names)
+    except Exception as e:  # reported, not to abort the other studies
+        report['status'] = 'failed'
+        report['error'] = str(e)
+    report['seconds'] = round(time.perf_counter() - start, 3)
+    if report['status'] == 'ok':
+        logger.info("Got study %s in %.2f s: %d files, %.1f MB", study_id,
+                    report['seconds'], report['files'],
+                    report['bytes'] / 1e6)
+    else:
+        logger.error("Could not get study %s, after %.2f s: %s", study_id,
+                     report['seconds'], report['error'])
+    return report
+
+
+def get_studies_command(options):
+    study_ids = list(options.study_ids)
+    if options.study_list:
+        with options.study_list as fp:
+            study_ids.extend(line.split('#')[0].strip() for line in fp)
+    study_ids = list(collections.OrderedDict.fromkeys(
+        study_id for study_id in study_ids if study_id))
+    if not study_ids:
+        raise RuntimeError("No study identifier was given")
+    logger.info("Getting %d studies into %s, %d at a time", len(study_ids),
+                options.output_dir, options.study_jobs)
+    os.makedirs(options.output_dir, exist_ok=True)
+    start = time.perf_counter()
+    remote = MetaboLightsRemote(mtbls_url, download_jobs)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, min(options.study_jobs,
+                                       len(study_ids)))) as executor:
+            reports = list(executor.map(
+                lambda study_id: _get_study_into(
+                    remote, study_id, options.output_dir), study_ids))
+    finally:
+        remote.close()
+    if options.report:
+        with options.report as fp:
+            write_results(reports, fp)
+    failed = [report['study_id'] for report in reports
+              if report['status'] != 'ok']
+    logger.info("Got %d of %d studies in %.2f s", len(reports) - len(failed),
+                len(reports), time.perf_counter() - start)
+    if failed:
+        raise RuntimeError("Could not get {} of the {} studies: {}".format(
+            len(failed), len(reports), ', '.join(failed)))
+
+
 def get_factors_command(options):
     logger.info("Getting factors for study %s. Writing to %s.",
                 options.study_id, options.output.name)
-    factor_names = MTBLS.get_factor_names(options.study_id)
+    with mtbls_study(options.study_id) as study_dir:
+        factor_names = LoadedStudy(study_dir).factor_names()
     if factor_names is not None:
-        json.dump(list(factor_names), options.output, indent=4)
+        write_results(factor_names, options.output)
         logger.debug("Factor names written")
     else:
         raise RuntimeError("Error downloading factors.")
@@ -564,349 +2835,591 @@ def get_factors_command(options):
 def get_factor_values_command(options):
     logger.info("Getting values for factor {factor} in study {study_id}. Writing to {output_file}."
                 .format(factor=options.factor, study_id=options.study_id, output_file=options.output.name))
-    fvs = MTBLS.get_factor_values(options.study_id, options.factor)
+    with mtbls_study(options.study_id) as study_dir:
+        fvs = LoadedStudy(study_dir).factor_values(options.factor)
     if fvs is not None:
-        json.dump(list(fvs), options.output, indent=4)
+        write_results(fvs, options.output)
         logger.debug("Factor values written to {}".format(options.output))
     else:
         raise RuntimeError("Error getting factor values")
 
 
-def get_data_files_command(options):
-    logger.info("Getting data files for study %s. Writing to %s.",
-                options.study_id, options.output.name)
+def _data_files_factor_selection(options):
+    """The factor selection of the --json-query or --galaxy_parameters_file
+    option of a data files command, or None"""
     if options.json_query:
         logger.debug("This is the specified query:\n%s", options.json_query)
-        json_struct = json.loads(options.json_query)
-        data_files = MTBLS.get_data_files(options.study_id, json_struct)
-    elif options.galaxy_parameters_file:
+        return json.loads(options.json_query)
+    if options.galaxy_parameters_file:
         logger.debug("Using input Galaxy JSON parameters from:\n%s",
                      options.galaxy_parameters_file)
         with open(options.galaxy_parameters_file) as json_fp:
             galaxy_json = json.load(json_fp)
-            json_struct = {}
-            for fv_item in galaxy_json['factor_value_series']:
-                json_struct[fv_item['factor_name']] = fv_item['factor_value']
-            data_files = MTBLS.get_data_files(options.study_id, json_struct)
-    else:
-        logger.debug("No query was specified")
-        data_files = MTBLS.get_data_files(options.study_id)
+        return {fv_item['factor_name']: fv_item['factor_value']
+                for fv_item in galaxy_json['factor_value_series']}
+    logger.debug("No query was specified")
+    return None
+
+
+def get_data_files_command(options):
+    logger.info("Getting data files for study %s. Writing to %s.",
+                options.study_id, options.output.name)
+    factor_selection = _data_files_factor_selection(options)
+    with mtbls_study(options.study_id) as study_dir:
+        data_files = LoadedStudy(study_dir).slice_data_files(
+            factor_selection)
 
     logger.debug("Result data files list: %s", data_files)
     if data_files is None:
         raise RuntimeError("Error getting data files with isatools")
 
     logger.debug("dumping data files to %s", options.output.name)
-    json.dump(list(data_files), options.output, indent=4)
+    write_results(data_files, options.output)
     logger.info("Finished writing data files to {}".format(options.output))
 
 
-def build_html_data_files_list(data_files_list):
-    data_files_table = '<table>'
-    data_files_table += '<tr><th>Sample Name</th><th>Data File Names</th></tr>'
-    for data_file in data_files_list:
-        sample_name = data_file['sample']
-        data_files = ', '.join(data_file['data_files'])
-        data_files_table += '<tr><td>{sample_name}</td><td>{data_files}</td>' \
-            .format(sample_name=sample_name, data_files=data_files)
-    html_data_files_list = """
-    <html>
-    <head>
-    <title>ISA-Tab Factors Summary</title>
-    </head>
-    <body>
-    {summary_table}
-    </body>
-    </html>
-""".format(summary_table=data_files_table)
-    return html_data_files_list
-
-
-def build_html_summary(summary):
-    study_groups = {}
-    for item in summary:
-        sample_name = item['sample_name']
-        study_factors = []
-        for item in [x for x in item.items() if x[0] != "sample_name"]:
-            study_factors.append(': '.join([item[0], item[1]]))
-        study_group = ', '.join(study_factors)
-        if study_group not in study_groups.keys():
-            study_groups[study_group] = []
-        study_groups[study_group].append(sample_name)
-    summary_table = '<table>'
-    summary_table += '<tr><th>Study group</th><th>Number of samples</th></tr>'
-    for item in study_groups.items():
-        study_group = item[0]
-        num_samples = len(item[1])
-        summary_table += '<tr><td>{study_group}</td><td>{num_samples}</td>' \
-            .format(study_group=study_group, num_samples=num_samples)
-    summary_table += '</table>'
-    html_summary = """
+_HTML_PAGE_SIZE = 1000
+
+_HTML_HEAD = """
 <html>
 <head>
-<title>ISA-Tab Factors Summary</title>
+<title>{title}</title>
+<style>.page {{ content-visibility: auto; }}</style>
 </head>
 <body>
-{summary_table}
+"""
+
+_HTML_TAIL = """
 </body>
 </html>
-""".format(summary_table=summary_table)
-    return html_summary
+"""
+
+
+def _html_row(cells, tag='td'):
+    return '<tr>{}</tr>\n'.format(''.join(
+        '<{0}>{1}</{0}>'.format(tag, html.escape(str(cell), quote=False))
+        for cell in cells))
+
+
+@_timed('output')
+def write_html_table(fp, headers, rows, row_count,
+                     page_size=_HTML_PAGE_SIZE):
+    """Write a table of row_count rows to fp, a page of rows at a time.
+
+    Tables longer than page_size rows (if not 0) are split into pages of
+    page_size rows. A list of links to the pages comes first, and browsers
+    only lay out the pages in view.
+    """
+    header = _html_row(headers, tag='th')
+    paginated = 0 < page_size < row_count
+    if paginated:
+        fp.write('<p class="pages">Pages:{}</p>\n'.format(''.join(
+            ' <a href="#page-{0}">{0}</a>'.format(page)
+            for page in range(1, (row_count - 1) // page_size + 2))))
+    else:
+        page_size = max(row_count, 1)
+    row_template = '<tr>{}</tr>\n'.format('<td>{}</td>' * len(headers))
+    escape = functools.partial(html.escape, quote=False)
+    rows = iter(rows)
+    page = 1
+    while True:
+        lines = [row_template.format(*[escape(str(cell)) for cell in row])
+                 for row in itertools.islice(rows, page_size)]
+        if page > 1 and not lines:
+            break
+        fp.write('<div class="page" id="page-{}">\n<table>\n'.format(page))
+        fp.write(header)
+        fp.write(''.join(lines))
+        fp.write('</table>\n</div>\n')
+        if len(lines) < page_size:
+            break
+        page += 1
+
+
+def write_html_data_files_list(data_files_list, fp,
+                               page_size=_HTML_PAGE_SIZE):
+    fp.write(_HTML_HEAD.format(title='ISA-Tab Data Files List'))
+    write_html_table(
+        fp, ['Sample Name', 'Data File Names'],
+        ((data_file['sample'], ', '.join(data_file['data_files']))
+         for data_file in data_files_list),
+        len(data_files_list), page_size)
+    fp.write(_HTML_TAIL)
+
+
+def build_html_data_files_list(data_files_list, page_size=_HTML_PAGE_SIZE):
+    fp = io.StringIO()
+    write_html_data_files_list(data_files_list, fp, page_size)
+    return fp.getvalue()
+
+
+def write_html_summary(summary, fp, page_size=_HTML_PAGE_SIZE):
+    """Write the study groups of a variables summary, with their number of
+    samples, as an HTML table"""
+    study_groups = collections.OrderedDict()
+    for item in summary:
+        study_group = ', '.join(
+            '{}: {}'.format(key, value) for key, value in item.items()
+            if key != 'sample_name')
+        study_groups[study_group] = study_groups.get(study_group, 0) + 1
+    fp.write(_HTML_HEAD.format(title='ISA-Tab Factors Summary'))
+    write_html_table(
+        fp, ['Study group', 'Number of samples'], study_groups.items(),
+        len(study_groups), page_size)
+    fp.write(_HTML_TAIL)
+
+
+def build_html_summary(summary, page_size=_HTML_PAGE_SIZE):
+    fp = io.StringIO()
+    write_html_summary(summary, fp, page_size)
+    return fp.getvalue()
 
 
 def get_summary_command(options):
     logger.info("Getting summary for study %s. Writing to %s.",
                 options.study_id, options.json_output.name)
 
-    summary = MTBLS.get_study_variable_summary(options.study_id)
+    with mtbls_study(options.study_id) as study_dir:
+        summary = LoadedStudy(study_dir).variables_summary(True)
     # new_summary = []
     # for item in summary:
     #     new_summary.append(
     #         {k: v for k, v in item.items() if k is not "sample_name"})
     # summary = new_summary
     if summary is not None:
-        json.dump(summary, options.json_output, indent=4)
+        write_results(summary, options.json_output)
         logger.debug("Summary dumped to JSON")
-        html_summary = build_html_summary(summary)
         with options.html_output as html_fp:
-            html_fp.write(html_summary)
+            write_html_summary(summary, html_fp, options.html_page_size)
     else:
         raise RuntimeError("Error getting study summary")
 
 
+def get_outputs_command(options):
+    """Write the chosen outputs of a MetaboLights study, fetching and
+    parsing its tables once for all of them"""
+    if not (options.factors or options.factor_values or options.data_list or
+            options.summary or options.summary_html):
+        raise RuntimeError("No output was chosen")
+    factor_selection = _data_files_factor_selection(options) \
+        if options.data_list else None
+    logger.info("Getting outputs of study %s", options.study_id)
+    with mtbls_study(options.study_id) as study_dir:
+        study = LoadedStudy(study_dir)
+        if options.data_list:
+            with open(options.data_list, 'w') as fp:
+                count = write_results(
+                    study.iter_data_files(factor_selection), fp)
+            logger.info("Wrote the data files of %d samples to %s", count,
+                        options.data_list)
+        if options.summary or options.summary_html:
+            summary = study.variables_summary(True)
+            if options.summary:
+                with open(options.summary, 'w') as fp:
+                    write_results(summary, fp)
+                logger.info("Wrote the summary to %s", options.summary)
+            if options.summary_html:
+                with open(options.summary_html, 'w') as fp:
+                    write_html_summary(summary, fp, options.html_page_size)
+                logger.info("Wrote the HTML summary to %s",
+                            options.summary_html)
+        if options.factors:
+            with open(options.factors, 'w') as fp:
+                write_results(study.factor_names(), fp)
+            logger.info("Wrote the factor names to %s", options.factors)
+        for factor, path in options.factor_values:
+            with open(path, 'w') as fp:
+                write_results(study.factor_values(factor), fp)
+            logger.info("Wrote the values of factor %s to %s", factor, path)
+
+
+# output writers
+
+def _tsv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, separators=(',', ':'))
+    return value
+
+
+def _tsv_rows(values):
+    """The rows of cells of a result, one per item of its lists of strings,
+    as no separator joining them could be told apart from file names"""
+    columns = []
+    for value in values:
+        if isinstance(value, list) and all(
+                isinstance(x, str) for x in value):
+            columns.append(value or [''])
+        else:
+            columns.append([_tsv_value(value)])
+    return itertools.product(*columns)
+
+
+@_timed('output')
+def write_results(results, fp):
+    """Write an iterable of results to fp one at a time, in the output
+    format.
+
+    ``json`` writes the same indented array as ``json.dump(results, fp,
+    indent=4)``. ``compact`` writes the array without whitespace,
+    ``ndjson`` one JSON document per line. ``tsv`` writes rows headed by
+    the keys of the first result if results are dicts, a result taking
+    one row per item of its lists of strings, such as its data files;
+    other nested values are written as JSON.
+    :return: The number of results written
+    """
+    count = 0
+    if output_format == 'tsv':
+        writer = csv.writer(fp, delimiter='\t', lineterminator='\n')
+        fields = None
+        for result in results:
+            if isinstance(result, dict):
+                if fields is None:
+                    fields = list(result)
+                    writer.writerow(fields)
+                row = [result.get(field) for field in fields]
+            else:
+                row = [result]
+            writer.writerows(_tsv_rows(row))
+            count += 1
+    elif output_format == 'ndjson':
+        for result in results:
+            fp.write(json.dumps(result))
+            fp.write('\n')
+            count += 1
+    else:
+        if output_format == 'compact':
+            start, separator, end = '[', ',', ']'
+            dumps = functools.partial(json.dumps, separators=(',', ':'))
+        else:
+            start, separator, end = '[\n    ', ',\n    ', '\n]'
+            dumps = functools.partial(json.dumps, indent=4)
+        for result in results:
+            fp.write(separator if count else start)
+            # JSON strings never hold raw newlines: this indents the lines
+            fp.write(dumps(result).replace('\n', '\n    '))
+            count += 1
+        fp.write(end if count else '[]')
+    return count
+
+
+@_timed('output')
+def write_query_results(query, results, fp):
+    """Write the results of a slicer query in the output format: along
+    with the query in a JSON document, or as results only in the ndjson
+    and tsv formats"""
+    if output_format in ('ndjson', 'tsv'):
+        return write_results(results, fp)
+    if output_format == 'compact':
+        json.dump({'query': query, 'results': results}, fp,
+                  separators=(',', ':'))
+    else:
+        json.dump({'query': query, 'results': results}, fp, indent=4)
+    return len(results)
+
+
+@_timed('parsing')
+def load_investigation(study_dir):
+    """The isatools object model of an ISA-Tab study"""
+    from isatools import isatab
+    return isatab.load(study_dir)
+
+
+# JSON keys of the ISA objects serialized one item at a time, with the
+# attributes holding their items and the keys to stream in these items
+_ISA_JSON_STREAMED = {
+    'Investigation': {'studies': ('studies', 'Study')},
+    'Study': {'processSequence': ('process_sequence', None),
+              'assays': ('assays', 'Assay')},
+    'Assay': {'processSequence': ('process_sequence', None)},
+}
+
+
+def _iter_isa_json(isa_object):
+    """Chunks of the JSON of an isatools object, as json.dump writes
+    isa_object.to_dict(), the lists of _ISA_JSON_STREAMED being serialized
+    one item at a time rather than all at once"""
+    streamed = _ISA_JSON_STREAMED.get(type(isa_object).__name__, {})
+    items = collections.OrderedDict()
+    try:
+        # detached, to be left out of to_dict
+        for key, (attribute, _) in streamed.items():
+            items[key] = getattr(isa_object, attribute)
+            setattr(isa_object, attribute, [])
+        isa_dict = isa_object.to_dict()
+    finally:
+        for key, (attribute, _) in streamed.items():
+            if key in items:
+                setattr(isa_object, attribute, items[key])
+    for i, (key, value) in enumerate(isa_dict.items()):
+        yield '{}{}: '.format(', ' if i else '{', json.dumps(key))
+        if key not in items:
+            yield json.dumps(value)
+            continue
+        yield '['
+        for j, item in enumerate(items[key]):
+            if j:
+                yield ', '
+            if streamed[key][1] is None:
+                yield json.dumps(item.to_dict())
+            else:
+                yield from _iter_isa_json(item)
+        yield ']'
+    yield '}' if isa_dict else '{}'
+
+
+@_timed('output')
+def write_isa_json(investigation, fp):
+    """Write an investigation as ISA-JSON, the same as json.dump of its
+    to_dict() but serializing one process or assay at a time, so that the
+    JSON of the whole investigation is never held in memory. isatools
+    versions without to_dict are serialized at once by ISAJSONEncoder."""
+    if not hasattr(investigation, 'to_dict'):
+        from isatools.isajson import ISAJSONEncoder
+        json.dump(investigation, fp, cls=ISAJSONEncoder)
+        return
+    for chunk in _iter_isa_json(investigation):
+        fp.write(chunk)
+
+
 # isaslicer commands
 
 def isatab_get_data_files_list_command(options):
     logger.info("Getting data files for study %s. Writing to %s.",
                 options.input_path, options.output.name)
-    if options.json_query:
-        logger.debug("This is the specified query:\n%s", options.json_query)
-        json_struct = json.loads(options.json_query)
-    elif options.galaxy_parameters_file:
-        logger.debug("Using input Galaxy JSON parameters from:\n%s",
-                     options.galaxy_parameters_file)
-        with open(options.galaxy_parameters_file) as json_fp:
-            galaxy_json = json.load(json_fp)
-            json_struct = {}
-            for fv_item in galaxy_json['factor_value_series']:
-                json_struct[fv_item['factor_name']] = fv_item['factor_value']
-    else:
-        logger.debug("No query was specified")
-        json_struct = None
-    factor_selection = json_struct
+    factor_selection = _data_files_factor_selection(options)
     input_path = options.input_path
-    result = slice_data_files(input_path, factor_selection=factor_selection)
-    data_files = result
-    logger.debug("Result data files list: %s", data_files)
-    if data_files is None:
-        raise RuntimeError("Error getting data files with isatools")
-
+    data_files = open_study(input_path).iter_data_files(factor_selection)
     logger.debug("dumping data files to %s", options.output.name)
-    json.dump(list(data_files), options.output, indent=4)
+    count = write_results(data_files, options.output)
+    logger.debug("Wrote the data files of %d samples", count)
     logger.info("Finished writing data files to {}".format(options.output))
 
 
 def zip_get_data_files_list_command(options):
     logger.info("Getting data files for study %s. Writing to %s.",
                 options.input_path, options.output.name)
-    if options.json_query:
-        logger.debug("This is the specified query:\n%s", options.json_query)
-        json_struct = json.loads(options.json_query)
-    elif options.galaxy_parameters_file:
-        logger.debug("Using input Galaxy JSON parameters from:\n%s",
-                     options.galaxy_parameters_file)
-        with open(options.galaxy_parameters_file) as json_fp:
-            galaxy_json = json.load(json_fp)
-            json_struct = {}
-            for fv_item in galaxy_json['factor_value_series']:
-                json_struct[fv_item['factor_name']] = fv_item['factor_value']
-    else:
-        logger.debug("No query was specified")
-        json_struct = None
-    factor_selection = json_struct
+    factor_selection = _data_files_factor_selection(options)
     input_path = options.input_path
     with zipfile.ZipFile(input_path) as zfp:
-        tmpdir = tempfile.mkdtemp()
-        zfp.extractall(path=tmpdir)
-        result = slice_data_files(tmpdir, factor_selection=factor_selection)
-        data_files = result
-        logger.debug("Result data files list: %s", data_files)
-    if data_files is None:
-        raise RuntimeError("Error getting data files with isatools")
-    logger.debug("dumping data files to %s", options.output.name)
-    json.dump(list(data_files), options.output, indent=4)
+        data_files = LoadedStudy(input_path, zfp=zfp).iter_data_files(
+            factor_selection)
+        logger.debug("dumping data files to %s", options.output.name)
+        count = write_results(data_files, options.output)
+    logger.debug("Wrote the data files of %d samples", count)
     logger.info("Finished writing data files to {}".format(options.output))
-    shutil.rmtree(tmpdir)
 
 
 def isatab_get_data_files_collection_command(options):
     logger.info("Getting data files for study %s. Writing to %s.",
                 options.input_path, options.output_path)
-    if options.json_query:
-        logger.debug("This is the specified query:\n%s", options.json_query)
-    else:
-        logger.debug("No query was specified")
     input_path = options.input_path
-    if options.json_query is not None:
-        json_struct = json.loads(options.json_query)
-    elif options.galaxy_parameters_file:
-        logger.debug("Using input Galaxy JSON parameters from:\n%s",
-                     options.galaxy_parameters_file)
-        with open(options.galaxy_parameters_file) as json_fp:
-            galaxy_json = json.load(json_fp)
-            json_struct = {}
-            for fv_item in galaxy_json['factor_value_series']:
-                json_struct[fv_item['factor_name']] = fv_item['factor_value']
-    else:
-        logger.debug("No query was specified")
-        json_struct = None
-    factor_selection = json_struct
-    result = slice_data_files(input_path, factor_selection=factor_selection)
+    if is_study_index(input_path):
+        raise IOError('{} is a study index, data files can only be '
+                      'collected from an ISA-Tab directory'.format(input_path))
+    factor_selection = _data_files_factor_selection(options)
+    result = open_study(input_path).slice_data_files(factor_selection)
     data_files = result
     logger.debug("Result data files list: %s", data_files)
     if data_files is None:
         raise RuntimeError("Error getting data files with isatools")
     output_path = options.output_path
-    logger.debug("copying data files to %s", output_path)
-    for result in data_files:
-        for data_file_name in result['data_files']:
-            logging.info("Copying {}".format(data_file_name))
-            shutil.copy(os.path.join(input_path, data_file_name), output_path)
+    logger.debug("materializing data files to %s", output_path)
+    materialize_data_files(
+        [(os.path.join(input_path, data_file_name),
+          os.path.join(output_path, os.path.basename(data_file_name)))
+         for data_file_name in _distinct_data_files(data_files)],
+        link_mode=options.link_mode)
     logger.info("Finished writing data files to {}".format(output_path))
 
 
 def zip_get_data_files_collection_command(options):
     logger.info("Getting data files for study %s. Writing to %s.",
                 options.input_path, options.output_path)
-    if options.json_query:
-        logger.debug("This is the specified query:\n%s", options.json_query)
-    else:
-        logger.debug("No query was specified")
     input_path = options.input_path
     output_path = options.output_path
-    if options.json_query is not None:
-        json_struct = json.loads(options.json_query)
-        factor_selection = json_struct
-    else:
-        factor_selection = None
+    factor_selection = _data_files_factor_selection(options)
     with zipfile.ZipFile(input_path) as zfp:
-        tmpdir = tempfile.mkdtemp()
-        zfp.extractall(path=tmpdir)
-        result = slice_data_files(tmpdir, factor_selection=factor_selection)
+        result = slice_data_files(
+            input_path, factor_selection=factor_selection, zfp=zfp)
         data_files = result
         logger.debug("Result data files list: %s", data_files)
         if data_files is None:
             raise RuntimeError("Error getting data files with isatools")
-        logger.debug("copying data files to %s", output_path)
-        for result in data_files:
-            for data_file_name in result['data_files']:
-                logging.info("Copying {}".format(data_file_name))
-                shutil.copy(os.path.join(tmpdir, data_file_name), output_path)
+    logger.debug("extracting data files to %s", output_path)
+    extract_data_files(input_path, [
+        (data_file_name,
+         os.path.join(output_path, os.path.basename(data_file_name)))
+        for data_file_name in _distinct_data_files(data_files)])
     logger.info("Finished writing data files to {}".format(output_path))
-    shutil.rmtree(tmpdir)
 
 
-def slice_data_files(dir, factor_selection=None):
-    results = []
-    # first collect matching samples
-    for table_file in glob.iglob(os.path.join(dir, '[a|s]_*')):
-        logger.info('Loading {table_file}'.format(table_file=table_file))
+# data files materialization
 
-        with open(os.path.join(dir, table_file)) as fp:
-            df = isatab.load_table(fp)
+_FICLONE = 0x40049409  # linux/fs.h, clones a file sharing its extents
 
-            if factor_selection is None:
-                matches = df['Sample Name'].items()
+_LINK_MODES = collections.OrderedDict([
+    ('auto', ('reflink', 'hardlink', 'copy')),
+    ('reflink', ('reflink', 'copy')),
+    ('hardlink', ('hardlink', 'copy')),
+    ('symlink', ('symlink', 'copy')),
+    ('copy', ('copy',)),
+])
 
-                for indx, match in matches:
-                    sample_name = match
-                    if len([r for r in results if r['sample'] ==
-                            sample_name]) == 1:
-                        continue
-                    else:
-                        results.append(
-                            {
-                                'sample': sample_name,
-                                'data_files': []
-                            }
-                        )
 
-            else:
-                for factor_name, factor_value in factor_selection.items():
-                    if 'Factor Value[{}]'.format(factor_name) in list(
-                            df.columns.values):
-                        matches = df.loc[df['Factor Value[{factor}]'.format(
-                            factor=factor_name)] == factor_value][
-                            'Sample Name'].items()
-
-                        for indx, match in matches:
-                            sample_name = match
-                            if len([r for r in results if r['sample'] ==
-                                    sample_name]) == 1:
-                                continue
-                            else:
-                                results.append(
-                                    {
-                                        'sample': sample_name,
-                                        'data_files': [],
-                                        'query_used': factor_selection
-                                    }
-                                )
-
-    # now collect the data files relating to the samples
-    for result in results:
-        sample_name = result['sample']
-
-        for table_file in glob.iglob(os.path.join(dir, 'a_*')):
-            with open(table_file) as fp:
-                df = isatab.load_table(fp)
-
-                data_files = []
-
-                table_headers = list(df.columns.values)
-                sample_rows = df.loc[df['Sample Name'] == sample_name]
-
-                data_node_labels = [
-                    'Raw Data File',
-                    'Raw Spectral Data File',
-                    'Derived Spectral Data File',
-                    'Derived Array Data File',
-                    'Array Data File',
-                    'Protein Assignment File',
-                    'Peptide Assignment File',
-                    'Post Translational Modification Assignment File',
-                    'Acquisition Parameter Data File',
-                    'Free Induction Decay Data File',
-                    'Derived Array Data Matrix File',
-                    'Image File',
-                    'Derived Data File',
-                    'Metabolite Assignment File']
-                for node_label in data_node_labels:
-                    if node_label in table_headers:
-                        data_files.extend(list(sample_rows[node_label]))
-
-                result['data_files'] = [i for i in list(data_files) if
-                                        str(i) != 'nan']
-    return results
+def _distinct_data_files(results):
+    """The data files of sliced samples, each listed once."""
+    return list(collections.OrderedDict.fromkeys(
+        data_file_name for result in results
+        for data_file_name in result['data_files']))
+
+
+def _reflink(src, dst):
+    import fcntl
+    with open(src, 'rb') as src_fp, open(dst, 'wb') as dst_fp:
+        fcntl.ioctl(dst_fp.fileno(), _FICLONE, src_fp.fileno())
+
+
+def _symlink(src, dst):
+    os.symlink(os.path.abspath(src), dst)
+
+
+_LINKERS = {
+    'reflink': _reflink,
+    'hardlink': os.link,
+    'symlink': _symlink,
+    'copy': shutil.copyfile,
+}
+
+
+def materialize_file(src, dst, link_mode='auto'):
+    """Make ``dst`` a copy of ``src`` as cheaply as ``link_mode`` allows.
+
+    The methods of the mode are tried in turn, an unsupported or cross
+    device link falling back to the next one, down to a plain copy.
+    :return: The name of the method which succeeded
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    methods = _LINK_MODES[link_mode]
+    for method in methods[:-1]:
+        try:
+            _LINKERS[method](src, dst)
+            return method
+        except (OSError, ImportError) as e:
+            if isinstance(e, FileNotFoundError) and not os.path.exists(src):
+                raise
+            logger.debug("Could not %s %s: %s", method, src, e)
+            if os.path.lexists(dst):
+                os.remove(dst)
+    _LINKERS[methods[-1]](src, dst)
+    return methods[-1]
+
+
+def _pool_size(tasks):
+    return max(1, min(jobs or os.cpu_count() or 1, len(tasks)))
+
+
+@_timed('output')
+def materialize_data_files(files, link_mode='auto'):
+    """Materialize ``(src, dst)`` pairs of data files, copying with a pool of
+    ``jobs`` threads the files which cannot be linked."""
+    methods = collections.Counter()
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=_pool_size(files)) as executor:
+        for (src, dst), method in zip(files, executor.map(
+                lambda pair: materialize_file(*pair, link_mode=link_mode),
+                files)):
+            logger.info("Materialized %s (%s)", os.path.basename(dst), method)
+            methods[method] += 1
+    logger.info("Materialized %d data files: %s", len(files), ', '.join(
+        '{} {}'.format(count, method) for method, count in methods.items()))
+
+
+@_timed('extraction')
+def extract_data_files(zip_path, members):
+    """Extract ``(member, dst)`` pairs of a zip archive with a pool of
+    ``jobs`` threads, each thread reading through its own archive handle.
+    """
+    handles = []
+    local = threading.local()
+
+    def extract(member, dst):
+        if not hasattr(local, 'zfp'):
+            local.zfp = zipfile.ZipFile(zip_path)
+            handles.append(local.zfp)
+        with local.zfp.open(member) as src, open(dst, 'wb') as dst_fp:
+            shutil.copyfileobj(src, dst_fp, 1 << 20)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=_pool_size(members)) as executor:
+            for member, _ in zip(members, executor.map(
+                    lambda pair: extract(*pair), members)):
+                logger.info("Extracted %s", member)
+    finally:
+        for zfp in handles:
+            zfp.close()
+
+
+_DATA_NODE_LABELS = [
+    'Raw Data File',
+    'Raw Spectral Data File',
+    'Derived Spectral Data File',
+    'Derived Array Data File',
+    'Array Data File',
+    'Protein Assignment File',
+    'Peptide Assignment File',
+    'Post Translational Modification Assignment File',
+    'Acquisition Parameter Data File',
+    'Free Induction Decay Data File',
+    'Derived Array Data Matrix File',
+    'Image File',
+    'Derived Data File',
+    'Metabolite Assignment File']
+
+
+@_timed('filtering')
+def index_data_files(assay_tables, parameter_selection=None, distinct=False):
+    """Map every sample name to the data files it is linked to in a
+    sequence of assay table DataFrames"""
+    import pandas as pd
+    index = {}
+    for df in assay_tables:
+        if parameter_selection:
+            rows = pd.Series(False, index=df.index)
+            for name, value in parameter_selection.items():
+                column = 'Parameter Value[{}]'.format(name)
+                if column in df.columns:
+                    rows |= df[column] == value
+            df = df[rows]
+        data_columns = [
+            label for label in _DATA_NODE_LABELS if label in df.columns]
+        if not data_columns:
+            continue
+        links = df[['Sample Name'] + data_columns].melt(
+            id_vars='Sample Name', value_name='data_file')
+        links = links[~links['data_file'].fillna('').isin(('nan', ''))]
+        if distinct:
+            links = links.drop_duplicates(['Sample Name', 'data_file'])
+        for sample_name, data_files in links.groupby(
+                'Sample Name', sort=False)['data_file']:
+            index.setdefault(sample_name, []).extend(data_files)
+    return index
+
+
+def slice_data_files(dir, factor_selection=None, zfp=None):
+    return LoadedStudy(dir, zfp=zfp).slice_data_files(factor_selection)
 
 
 def isatab_get_factor_names_command(options):
     input_path = options.input_path
     logger.info("Getting factors for study %s. Writing to %s.",
                 input_path, options.output.name)
-    _RX_FACTOR_VALUE = re.compile(r'Factor Value\[(.*?)\]')
-    factors = set()
-    for table_file in glob.iglob(os.path.join(input_path, '[a|s]_*')):
-        with open(os.path.join(input_path, table_file)) as fp:
-            df = isatab.load_table(fp)
-
-            factors_headers = [header for header in list(df.columns.values)
-                               if _RX_FACTOR_VALUE.match(header)]
-
-            for header in factors_headers:
-                factors.add(header[13:-1])
+    factors = open_study(input_path).factor_names()
     if factors is not None:
-        json.dump(list(factors), options.output, indent=4)
+        write_results(factors, options.output)
         logger.debug("Factor names written")
     else:
         raise RuntimeError("Error reading factors.")
@@ -916,57 +3429,21 @@ def zip_get_factor_names_command(options):
     input_path = options.input_path
     logger.info("Getting factors for study %s. Writing to %s.",
                 input_path, options.output.name)
-    # unpack input_path
     with zipfile.ZipFile(input_path) as zfp:
-        tmpdir = tempfile.mkdtemp()
-        zfp.extractall(path=tmpdir)
-        _RX_FACTOR_VALUE = re.compile(r'Factor Value\[(.*?)\]')
-        factors = set()
-        for table_file in glob.iglob(os.path.join(tmpdir, '[a|s]_*')):
-            logging.info('Searching {}'.format(table_file))
-            with open(os.path.join(tmpdir, table_file)) as fp:
-                df = isatab.load_table(fp)
-
-                factors_headers = [header for header in list(df.columns.values)
-                                   if _RX_FACTOR_VALUE.match(header)]
-
-                for header in factors_headers:
-                    factors.add(header[13:-1])
+        factors = LoadedStudy(input_path, zfp=zfp).factor_names()
     if factors is not None:
-        json.dump(list(factors), options.output, indent=4)
+        write_results(factors, options.output)
         logger.debug("Factor names written")
     else:
         raise RuntimeError("Error reading factors.")
-    shutil.rmtree(tmpdir)
 
 
 def isatab_get_factor_values_command(options):
     logger.info("Getting values for factor {factor} in study {input_path}. Writing to {output_file}."
                 .format(factor=options.factor, input_path=options.input_path, output_file=options.output.name))
-    fvs = set()
-
-    input_path = options.input_path
-    factor_name = options.factor
-
-    for table_file in glob.iglob(os.path.join(input_path, '[a|s]_*')):
-        with open(os.path.join(input_path, table_file)) as fp:
-            df = isatab.load_table(fp)
-
-            if 'Factor Value[{factor}]'.format(factor=factor_name) in \
-                    list(df.columns.values):
-                for _, match in df[
-                    'Factor Value[{factor}]'.format(
-                        factor=factor_name)].iteritems():
-                    try:
-                        match = match.item()
-                    except AttributeError:
-                        pass
-
-                    if isinstance(match, (str, int, float)):
-                        if str(match) != 'nan':
-                            fvs.add(match)
+    fvs = open_study(options.input_path).factor_values(options.factor)
     if fvs is not None:
-        json.dump(list(fvs), options.output, indent=4)
+        write_results(fvs, options.output)
         logger.debug("Factor values written to {}".format(options.output))
     else:
         raise RuntimeError("Error getting factor values")
@@ -980,73 +3457,21 @@ def zip_get_factor_values_command(options):
                 "Writing to {output_file}.".format(
                     factor=options.factor, input_path=options.input_path,
                     output_file=options.output.name))
-    fvs = set()
-    factor_name = options.factor
-
-    # unpack input_path
     with zipfile.ZipFile(input_path) as zfp:
-        tmpdir = tempfile.mkdtemp()
-        zfp.extractall(path=tmpdir)
-        for table_file in glob.glob(os.path.join(tmpdir, '[a|s]_*')):
-            logging.info('Searching {}'.format(table_file))
-            with open(os.path.join(input_path, table_file)) as fp:
-                df = isatab.load_table(fp)
-                if 'Factor Value[{factor}]'.format(factor=factor_name) in \
-                        list(df.columns.values):
-                    for _, match in df[
-                        'Factor Value[{factor}]'.format(
-                            factor=factor_name)].iteritems():
-                        try:
-                            match = match.item()
-                        except AttributeError:
-                            pass
-
-                        if isinstance(match, (str, int, float)):
-                            if str(match) != 'nan':
-                                fvs.add(match)
+        fvs = LoadedStudy(input_path, zfp=zfp).factor_values(options.factor)
     if fvs is not None:
-        json.dump(list(fvs), options.output, indent=4)
+        write_results(fvs, options.output)
         logger.debug("Factor values written to {}".format(options.output))
     else:
         raise RuntimeError("Error getting factor values")
-    shutil.rmtree(tmpdir)
 
 
 def isatab_get_factors_summary_command(options):
     logger.info("Getting summary for study %s. Writing to %s.",
                 options.input_path, options.output.name)
-    input_path = options.input_path
-    ISA = isatab.load(input_path)
-
-    all_samples = []
-    for study in ISA.studies:
-        all_samples.extend(study.samples)
-
-    samples_and_fvs = []
-
-    for sample in all_samples:
-        sample_and_fvs = {
-            'sample_name': sample.name,
-        }
-
-        for fv in sample.factor_values:
-            if isinstance(fv.value, (str, int, float)):
-                fv_value = fv.value
-                sample_and_fvs[fv.factor_name.name] = fv_value
-            elif isinstance(fv.value, OntologyAnnotation):
-                fv_value = fv.value.term
-                sample_and_fvs[fv.factor_name.name] = fv_value
-
-        samples_and_fvs.append(sample_and_fvs)
-
-    df = pd.DataFrame(samples_and_fvs)
-    nunique = df.apply(pd.Series.nunique)
-    cols_to_drop = nunique[nunique == 1].index
-
-    df = df.drop(cols_to_drop, axis=1)
-    summary = df.to_dict(orient='records')
+    summary = open_study(options.input_path).variables_summary()
     if summary is not None:
-        json.dump(summary, options.output, indent=4)
+        write_results(summary, options.output)
         logger.debug("Summary dumped to JSON")
         # html_summary = build_html_summary(summary)
         # with options.html_output as html_fp:
@@ -1060,40 +3485,29 @@ def zip_get_factors_summary_command(options):
                 options.input_path, options.json_output.name)
     input_path = options.input_path
     with zipfile.ZipFile(input_path) as zfp:
-        tmpdir = tempfile.mkdtemp()
-        zfp.extractall(path=tmpdir)
-        ISA = isatab.load(tmpdir)
-        all_samples = []
-        for study in ISA.studies:
-            all_samples.extend(study.samples)
-        samples_and_fvs = []
-        for sample in all_samples:
-            sample_and_fvs = {
-                'sample_name': sample.name,
-            }
-            for fv in sample.factor_values:
-                if isinstance(fv.value, (str, int, float)):
-                    fv_value = fv.value
-                    sample_and_fvs[fv.factor_name.name] = fv_value
-                elif isinstance(fv.value, OntologyAnnotation):
-                    fv_value = fv.value.term
-                    sample_and_fvs[fv.factor_name.name] = fv_value
-            samples_and_fvs.append(sample_and_fvs)
-        df = pd.DataFrame(samples_and_fvs)
-        nunique = df.apply(pd.Series.nunique)
-        cols_to_drop = nunique[nunique == 1].index
-        df = df.drop(cols_to_drop, axis=1)
-        summary = df.to_dict(orient='records')
+        summary = LoadedStudy(input_path, zfp=zfp).variables_summary()
     if summary is not None:
-        json.dump(summary, options.json_output, indent=4)
+        write_results(summary, options.json_output)
         logger.debug("Summary dumped to JSON")
         print(json.dumps(summary, indent=4))
-        html_summary = build_html_summary(summary)
         with options.html_output as html_fp:
-            html_fp.write(html_summary)
+            write_html_summary(summary, html_fp, options.html_page_size)
     else:
         raise RuntimeError("Error getting study summary")
-    shutil.rmtree(tmpdir)
+
+
+def isatab_build_index_command(options):
+    logger.info("Building the index of study %s. Writing to %s.",
+                options.input_path, options.output)
+    if zipfile.is_zipfile(options.input_path):
+        with zipfile.ZipFile(options.input_path) as zfp:
+            header, samples = write_study_index(
+                LoadedStudy(options.input_path, zfp=zfp), options.output)
+    else:
+        header, samples = write_study_index(
+            LoadedStudy(options.input_path), options.output)
+    logger.info("Indexed %d samples of %d tables", len(samples),
+                len(header['tables']))
 
 
 def get_study_groups(input_path):
@@ -1116,6 +3530,7 @@ def get_study_groups_samples_sizes(input_path):
 
 
 def get_sources_for_sample(input_path, sample_name):
+    from isatools import isatab
     ISA = isatab.load(input_path)
     hits = []
 
@@ -1131,6 +3546,7 @@ def get_sources_for_sample(input_path, sample_name):
 
 
 def get_data_for_sample(input_path, sample_name):
+    from isatools import isatab
     ISA = isatab.load(input_path)
     hits = []
     for study in ISA.studies:
@@ -1174,6 +3590,9 @@ def get_characteristics_summary(input_path):
 
 
         """
+    from isatools import isatab
+    from isatools.model import OntologyAnnotation
+    import pandas as pd
     ISA = isatab.load(input_path)
 
     all_samples = []
@@ -1206,58 +3625,18 @@ def get_characteristics_summary(input_path):
 
 
 def get_study_variable_summary(input_path):
-    ISA = isatab.load(input_path)
-
-    all_samples = []
-    for study in ISA.studies:
-        all_samples.extend(study.samples)
-
-    samples_and_variables = []
-    for sample in all_samples:
-        sample_and_vars = {
-            'sample_name': sample.name
-        }
-
-        for fv in sample.factor_values:
-            if isinstance(fv.value, (str, int, float)):
-                fv_value = fv.value
-                sample_and_vars[fv.factor_name.name] = fv_value
-            elif isinstance(fv.value, OntologyAnnotation):
-                fv_value = fv.value.term
-                sample_and_vars[fv.factor_name.name] = fv_value
-
-        for source in sample.derives_from:
-            sample_and_vars['source_name'] = source.name
-            for c in source.characteristics:
-                if isinstance(c.value, (str, int, float)):
-                    c_value = c.value
-                    sample_and_vars[c.category.term] = c_value
-                elif isinstance(c.value, OntologyAnnotation):
-                    c_value = c.value.term
-                    sample_and_vars[c.category.term] = c_value
-
-        samples_and_variables.append(sample_and_vars)
-
-    df = pd.DataFrame(samples_and_variables)
-    nunique = df.apply(pd.Series.nunique)
-    cols_to_drop = nunique[nunique == 1].index
-
-    df = df.drop(cols_to_drop, axis=1)
-    return df.to_dict(orient='records')
+    return open_study(input_path).variables_summary(True)
 
 
 def get_study_group_factors(input_path):
     factors_list = []
 
-    for table_file in glob.iglob(os.path.join(input_path, '[a|s]_*')):
-        with open(os.path.join(input_path, table_file)) as fp:
-            df = isatab.load_table(fp)
-
-            factor_columns = [x for x in df.columns if x.startswith(
-                'Factor Value')]
-            if len(factor_columns) > 0:
-                factors_list = df[factor_columns].drop_duplicates()\
-                    .to_dict(orient='records')
+    for df in read_tables(list_tables(input_path, '[a|s]_*')):
+        factor_columns = [x for x in df.columns if x.startswith(
+            'Factor Value')]
+        if len(factor_columns) > 0:
+            factors_list = df[factor_columns].drop_duplicates()\
+                .to_dict(orient='records')
     return factors_list
 
 
@@ -1277,24 +3656,21 @@ def get_filtered_df_on_factors_list(input_path):
         query_str = ''.join(query_str)[:-4]
         queries.append(query_str)
 
-    for table_file in glob.iglob(os.path.join(input_path, '[a|s]_*')):
-        with open(os.path.join(input_path, table_file)) as fp:
-            df = isatab.load_table(fp)
-
-            cols = df.columns
-            cols = cols.map(
-                lambda x: x.replace(' ', '_') if isinstance(x, str) else x)
-            df.columns = cols
+    for df in read_tables(list_tables(input_path, '[a|s]_*')):
+        cols = df.columns
+        cols = cols.map(
+            lambda x: x.replace(' ', '_') if isinstance(x, str) else x)
+        df.columns = cols
 
-            cols = df.columns
-            cols = cols.map(
-                lambda x: x.replace('[', '_') if isinstance(x, str) else x)
-            df.columns = cols
+        cols = df.columns
+        cols = cols.map(
+            lambda x: x.replace('[', '_') if isinstance(x, str) else x)
+        df.columns = cols
 
-            cols = df.columns
-            cols = cols.map(
-                lambda x: x.replace(']', '_') if isinstance(x, str) else x)
-            df.columns = cols
+        cols = df.columns
+        cols = cols.map(
+            lambda x: x.replace(']', '_') if isinstance(x, str) else x)
+        df.columns = cols
 
         for query in queries:
             # query uses pandas.eval, which evaluates queries like pure Python
@@ -1322,7 +3698,7 @@ def datatype_get_summary_command(options):
     summary = get_study_variable_summary(options.study_id)
     print('summary: ', list(summary))
     if summary is not None:
-        json.dump(summary, options.output, indent=4)
+        write_results(summary, options.output)
         logger.debug("Summary dumped")
     else:
         raise RuntimeError("Error getting study summary")
@@ -1339,6 +3715,66 @@ def _configure_logger(options):
     logger.setLevel(logging_level)  # there's a bug somewhere.  The level set through basicConfig isn't taking effect
 
 
+def _configure_table_cache(options):
+    global table_cache
+    if options.table_cache_dir:
+        table_cache = TableCache(
+            options.table_cache_dir, options.table_cache_size * 1024 * 1024)
+
+
+def _configure_mtbls(options):
+    global mtbls_url, download_jobs, study_cache
+    mtbls_url = options.mtbls_url
+    download_jobs = options.download_jobs
+    if options.study_cache_dir:
+        study_cache = StudyCache(
+            options.study_cache_dir, options.study_cache_size * 1024 * 1024,
+            options.study_cache_ttl)
+
+
+def _configure_jobs(options):
+    global jobs
+    jobs = options.jobs
+
+
+def _configure_output_format(options):
+    global output_format
+    output_format = options.output_format
+
+
+def _configure_sqlite(options):
+    global sqlite_db
+    sqlite_db = options.sqlite_db
+
+
+def _configure_server(options):
+    global server_address
+    if options.server and options.command != 'serve':
+        server_address = options.server
+
+
+def _configure_metrics(options):
+    global metrics
+    if options.metrics_out:
+        metrics = PhaseMetrics()
+        metrics.install()
+
+
+def _write_metrics(options):
+    global metrics
+    if metrics is None:
+        return
+    metrics.uninstall()
+    report = metrics.report(options.command)
+    metrics = None
+    with open(options.metrics_out, 'w') as fp:
+        json.dump(report, fp, indent=4)
+    logger.info("Ran in %.3f s, peak RSS %.1f MB (%s)",
+                report['wall_time'], report['peak_rss_mb'], ', '.join(
+                    '{} {:.3f} s'.format(name, phase['wall_time'])
+                    for name, phase in report['phases'].items()))
+
+
 def _parse_args(args):
     parser = make_parser()
     options = parser.parse_args(args)
@@ -1348,8 +3784,27 @@ def _parse_args(args):
 def main(args):
     options = _parse_args(args)
     _configure_logger(options)
+    _configure_table_cache(options)
+    _configure_mtbls(options)
+    _configure_jobs(options)
+    _configure_output_format(options)
+    _configure_sqlite(options)
+    _configure_server(options)
+    _configure_metrics(options)
     # run subcommand
-    options.func(options)
+    try:
+        if options.profile:
+            import cProfile
+            profiler = cProfile.Profile()
+            try:
+                profiler.runcall(options.func, options)
+            finally:
+                profiler.dump_stats(options.profile)
+                logger.info("Profile written to %s", options.profile)
+        else:
+            options.func(options)
+    finally:
+        _write_metrics(options)
 
 
 if __name__ == '__main__':
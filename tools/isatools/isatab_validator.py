@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
-import glob
+import hashlib
+import html
 import json
 import os
+import posixpath
 import shutil
 import sys
 import tempfile
@@ -12,78 +14,169 @@ json_output_path = sys.argv[2]
 html_output_path = sys.argv[3]
 
 try:
-    from isatools import isatab
+    from importlib.metadata import version
+    ISATOOLS_VERSION = version('isatools')
 except ImportError:
-    raise RuntimeError('Could not import isatools.isatab package')
+    ISATOOLS_VERSION = ''
 
-tmp_dir = tempfile.mkdtemp()
+# Reports are cached under a digest of the investigation, study and assay
+# tables, so that re-validating an unchanged submission is instant. Caching
+# is disabled if unset; entries are small and may be removed at any time.
+CACHE_DIR = os.environ.get('ISATAB_VALIDATOR_CACHE_DIR')
 
+
+def is_table(name):
+    base = posixpath.basename(name)
+    return base[:2] in ('i_', 's_', 'a_') and base.endswith('.txt')
+
+
+def table_members(names):
+    """The names of the investigation file, and of the study and assay
+    tables in the same directory. Archives often hold the ISA-Tab in a
+    subdirectory."""
+    i_files = [name for name in names if is_table(name)
+               and posixpath.basename(name).startswith('i_')]
+    if len(i_files) != 1:
+        raise RuntimeError(
+            'Expected one investigation file i_*.txt in \'{}\', found {}'
+            .format(input_path, len(i_files)))
+    prefix = posixpath.dirname(i_files[0])
+    return i_files[0], sorted(
+        name for name in names
+        if is_table(name) and posixpath.dirname(name) == prefix)
+
+
+def report_digest(tables):
+    sha = hashlib.sha256(ISATOOLS_VERSION.encode('utf-8'))
+    for name, data in sorted(tables.items()):
+        sha.update('{}\0{}\0'.format(name, len(data)).encode('utf-8'))
+        sha.update(data)
+    return sha.hexdigest()
+
+
+def load_report(digest):
+    try:
+        with open(os.path.join(CACHE_DIR, digest + '.json')) as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        print('Ignoring corrupted cached report {}: {}'.format(digest, e))
+        return None
+
+
+def store_report(digest, report):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(report, fp)
+        os.replace(tmp_path, os.path.join(CACHE_DIR, digest + '.json'))
+    except OSError as e:
+        print('Could not cache the report {}: {}'.format(digest, e))
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def validate(isatab_dir, i_file_name):
+    # imported only on a cache miss, importing isatools takes seconds
+    try:
+        from isatools import isatab
+    except ImportError:
+        raise RuntimeError('Could not import isatools.isatab package')
+    with open(os.path.join(isatab_dir, i_file_name)) as in_fp:
+        return isatab.validate(in_fp)
+
+
+if not os.path.exists(input_path):
+    print('File path to ISA files \'{}\' does not exist'.format(input_path))
+    sys.exit(0)
+# Only the tables are read, the raw data files are neither hashed nor
+# extracted
 if os.path.isdir(input_path):
-    isatab_dir = input_path
+    i_file_name, names = table_members(os.listdir(input_path))
+    tables = {}
+    for name in names:
+        with open(os.path.join(input_path, name), 'rb') as fp:
+            tables[name] = fp.read()
 else:
     with zipfile.ZipFile(input_path) as zfp:
-        zfp.extractall(path=tmp_dir)
-    isatab_dir = tmp_dir
-if not os.path.exists(tmp_dir):
-    print('File path to ISA files \'{}\' does not exist'.format(isatab_dir))
-    sys.exit(0)
-report = None
-i_files = glob.glob(os.path.join(isatab_dir, 'i_*.txt'))
-if len(i_files) == 1:
-    i_file_name = next(iter(i_files))
-    with open(i_file_name) as in_fp:
-        json_report = isatab.validate(in_fp)
-        if json_report is not None:
-            with open(json_output_path, 'w') as out_fp:
-                json.dump(json_report, out_fp, indent=4)
-shutil.rmtree(tmp_dir)
-
-
-def build_messages(messages):
-    messages_table = "No messages."
-    if len(messages) > 0:
-        messages_table = "<table>"
-        messages_table += "<tr><th>Code</th><th>Message</th><th>Supplemental information</th></tr>"
-        for message in messages:
-            messages_table += "<tr><td>{code}</td><td>{message}</td><td>{supplemental}</td></tr>".format(
-                code=message['code'], message=message['message'], supplemental=message['supplemental']
-            )
-        messages_table += "</table>"
-    return messages_table
+        i_member, members = table_members(zfp.namelist())
+        # the ISA-Tab is validated from its own directory, flattened
+        i_file_name = posixpath.basename(i_member)
+        tables = {posixpath.basename(name): zfp.read(name)
+                  for name in members}
+digest = report_digest(tables)
+json_report = load_report(digest) if CACHE_DIR else None
+if json_report is None:
+    if os.path.isdir(input_path):
+        json_report = validate(input_path, i_file_name)
+    else:
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            for name, data in tables.items():
+                with open(os.path.join(tmp_dir, name), 'wb') as fp:
+                    fp.write(data)
+            json_report = validate(tmp_dir, i_file_name)
+        finally:
+            shutil.rmtree(tmp_dir)
+    # a validation that crashed is not cached, it may be retried
+    if CACHE_DIR and json_report['validation_finished']:
+        store_report(digest, json_report)
+with open(json_output_path, 'w') as out_fp:
+    json.dump(json_report, out_fp, indent=4)
+
+HTML_PAGE_SIZE = int(sys.argv[4]) if len(sys.argv) > 4 else 1000
+
+
+def write_messages(fp, messages, anchor, page_size=HTML_PAGE_SIZE):
+    """Write the messages as an HTML table, a page of page_size rows at a
+    time. Longer tables are split into pages, linked from a list of pages
+    whose anchors start with anchor."""
+    if len(messages) == 0:
+        fp.write("No messages.")
+        return
+    header = "<tr><th>Code</th><th>Message</th>" \
+             "<th>Supplemental information</th></tr>\n"
+    if page_size <= 0:
+        page_size = len(messages)
+    pages = range(0, len(messages), page_size)
+    if len(pages) > 1:
+        fp.write("<p class=\"pages\">Pages:{}</p>\n".format("".join(
+            " <a href=\"#{0}-{1}\">{1}</a>".format(anchor, page)
+            for page in range(1, len(pages) + 1))))
+    for page, start in enumerate(pages, start=1):
+        fp.write("<div class=\"page\" id=\"{}-{}\">\n<table>\n".format(
+            anchor, page))
+        fp.write(header)
+        fp.write("".join(
+            "<tr><td>{code}</td><td>{message}</td><td>{supplemental}</td>"
+            "</tr>\n".format(**{
+                key: html.escape(str(message[key]), quote=False)
+                for key in ('code', 'message', 'supplemental')})
+            for message in messages[start:start + page_size]))
+        fp.write("</table>\n</div>\n")
 
 
 # now convert to html
-report_html = """
+with open(html_output_path, 'w') as html_fp:
+    html_fp.write("""
 <html>
 <head>
 <title>ISA-Tab validator | Validation report</title>
+<style>.page {{ content-visibility: auto; }}</style>
 </head>
 <body>
 
 <p>Validation completed: {valdation_finished}</p>
-
-<p>Info messages</p>
-<p>
-{info_table}
-</p>
-
-<p>Warning messages</p>
-<p>
-{warnings_table}
-</p>
-
-<p>Error messages</p>
-<p>
-{errors_table}
-</p>
-
+""".format(valdation_finished=json_report['validation_finished']))
+    for title, key in (('Info messages', 'info'),
+                       ('Warning messages', 'warnings'),
+                       ('Error messages', 'errors')):
+        html_fp.write("\n<p>{}</p>\n<p>\n".format(title))
+        write_messages(html_fp, json_report[key], key)
+        html_fp.write("\n</p>\n")
+    html_fp.write("""
 </body>
 </html>
-""".format(
-    valdation_finished=json_report['validation_finished'],
-    info_table=build_messages(json_report['info']),
-    warnings_table=build_messages(json_report['warnings']),
-    errors_table=build_messages(json_report['errors'])
-)
-with open(html_output_path, 'w') as html_fp:
-    html_fp.write(report_html)
+""")